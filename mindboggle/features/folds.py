@@ -264,15 +264,14 @@ def extract_folds(depth_file, depth_threshold=2, min_fold_size=50,
         # --------------------------------------------------------------------
         # Remove small folds
         # --------------------------------------------------------------------
+        indices_folds = np.nonzero(folds != background_value)[0]
+        fold_IDs = folds[indices_folds].astype(int)
+        fold_sizes = np.bincount(fold_IDs)
+        keep = fold_sizes > 0
         if min_fold_size > 1:
             if verbose:
                 print('  Remove folds smaller than {0}'.format(min_fold_size))
-            unique_folds = [x for x in np.unique(folds)
-                            if x != background_value]
-            for nfold in unique_folds:
-                indices_fold = [i for i,x in enumerate(folds) if x == nfold]
-                if len(indices_fold) < min_fold_size:
-                    folds[indices_fold] = background_value
+            keep &= fold_sizes >= min_fold_size
 
         # --------------------------------------------------------------------
         # Find and fill holes in the folds
@@ -287,13 +286,13 @@ def extract_folds(depth_file, depth_threshold=2, min_fold_size=50,
         # NOTE: All vertices are included (-1 for non-fold vertices).
         # --------------------------------------------------------------------
         renumber_folds = background_value * np.ones(npoints)
-        fold_numbers = [x for x in np.unique(folds) if x != background_value]
-        for i_fold, n_fold in enumerate(fold_numbers):
-            fold_indices = [i for i,x in enumerate(folds) if x == n_fold]
-            renumber_folds[fold_indices] = i_fold
+        new_fold_IDs = np.cumsum(keep) - 1
+        keep_indices = keep[fold_IDs]
+        renumber_folds[indices_folds[keep_indices]] = \
+            new_fold_IDs[fold_IDs[keep_indices]]
         folds = renumber_folds
         folds = [int(x) for x in folds]
-        n_folds = i_fold + 1
+        n_folds = int(np.sum(keep))
 
         # Print statement
         if verbose:
@@ -324,6 +323,88 @@ def extract_folds(depth_file, depth_threshold=2, min_fold_size=50,
     return folds, n_folds, folds_file
 
 
+def extract_folds_by_thresholds(depth_file, depth_thresholds,
+                                min_fold_size=50, background_value=-1,
+                                verbose=False):
+    """
+    Extract folds at each of a list of depth thresholds.
+
+    This sweeps depth thresholds (to tune fold extraction) without rerunning
+    extract_folds() for each threshold: vertices are sorted by depth once
+    and merged into a union-find merge tree of the depth values with
+    segment_by_thresholds(), and the folds at each threshold are read from
+    the tree.  Folds at each threshold consist of the same vertices as those
+    of extract_folds(), but are numbered in order of the index of their
+    deepest vertex.
+
+    Parameters
+    ----------
+    depth_file : string
+        surface mesh file in VTK format with faces and depth scalar values
+    depth_thresholds : list of floats
+        depth thresholds for defining folds
+    min_fold_size : integer
+        minimum fold size (number of vertices)
+    background_value : integer or float
+        background value
+    verbose : bool
+        print statements?
+
+    Returns
+    -------
+    folds_per_threshold : list of lists of integers
+        fold numbers for all vertices (-1 for non-fold vertices),
+        for each depth threshold
+    n_folds_per_threshold :  list of integers
+        number of folds for each depth threshold
+
+    Examples
+    --------
+    >>> from mindboggle.features.folds import extract_folds_by_thresholds
+    >>> from mindboggle.mio.fetch_data import prep_tests
+    >>> urls, fetch_data = prep_tests()
+    >>> depth_file = fetch_data(urls['left_travel_depth'], '', '.vtk')
+    >>> depth_thresholds = [2.36089, 4, 6]
+    >>> folds_list, n_folds_list = extract_folds_by_thresholds(depth_file,
+    ...     depth_thresholds, 50)
+    >>> n_folds_list[0]
+    33
+
+    """
+    import numpy as np
+    from time import time
+
+    from mindboggle.mio.vtks import read_vtk
+    from mindboggle.guts.mesh import find_neighbors
+    from mindboggle.guts.segment import segment_by_thresholds
+
+    if verbose:
+        print("Extract folds in surface mesh at {0} depth thresholds".
+              format(len(depth_thresholds)))
+        t0 = time()
+
+    # ------------------------------------------------------------------------
+    # Load depth values and find neighbors for all vertices
+    # ------------------------------------------------------------------------
+    points, indices, lines, faces, depths, scalar_names, npoints, \
+        input_vtk = read_vtk(depth_file, return_first=True, return_array=True)
+    neighbor_lists = find_neighbors(faces, npoints)
+
+    # ------------------------------------------------------------------------
+    # Segment deep vertices at each threshold, removing small folds
+    # ------------------------------------------------------------------------
+    folds_per_threshold, n_folds_per_threshold = segment_by_thresholds(
+        depths, neighbor_lists, depth_thresholds, min_fold_size,
+        background_value, verbose)
+    folds_per_threshold = [[int(x) for x in folds]
+                           for folds in folds_per_threshold]
+
+    if verbose:
+        print('  ...Extracted folds ({0:.2f} seconds)'.format(time() - t0))
+
+    return folds_per_threshold, n_folds_per_threshold
+
+
 # def extract_subfolds(depth_file, folds, min_size=10, depth_factor=0.25,
 #                      depth_ratio=0.1, tolerance=0.01, save_file=False,
 #                      background_value=-1, verbose=False):
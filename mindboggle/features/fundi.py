@@ -12,7 +12,8 @@ Copyright 2016,  Mindboggle team (http://mindboggle.info), Apache v2.0 License
 
 def extract_fundi(folds, curv_file, depth_file, min_separation=10,
                   erode_ratio=0.1, erode_min_size=1, save_file=False,
-                  output_file='', background_value=-1, verbose=False):
+                  output_file='', background_value=-1, verbose=False,
+                  n_jobs=1):
     """
     Extract fundi from folds.
 
@@ -55,6 +56,10 @@ def extract_fundi(folds, curv_file, depth_file, min_separation=10,
     Note ::
         Follow this with segment_by_region() to segment fundi by sulci.
 
+    With n_jobs > 1, folds are processed by a pool of worker processes
+    that share the surface's values and neighbor (CSR) arrays through
+    shared memory, and the fundi are merged in fold order.
+
     Parameters
     ----------
     folds : numpy array or list of integers
@@ -78,6 +83,9 @@ def extract_fundi(folds, curv_file, depth_file, min_separation=10,
         background value
     verbose : bool
         print statements?
+    n_jobs : integer
+        number of processes to extract fundi from folds
+        (None or < 1: number of CPUs)
 
     Returns
     -------
@@ -142,9 +150,6 @@ def extract_fundi(folds, curv_file, depth_file, min_separation=10,
     from mindboggle.guts.compute import median_abs_dev
     from mindboggle.guts.paths import find_max_values
     from mindboggle.guts.mesh import find_neighbors_from_file
-    #from mindboggle.guts.mesh import find_complete_faces
-    from mindboggle.guts.paths import find_outer_endpoints
-    from mindboggle.guts.paths import connect_points_erosion
 
     if isinstance(folds, list):
         folds = np.array(folds)
@@ -164,57 +169,22 @@ def extract_fundi(folds, curv_file, depth_file, min_separation=10,
     thr = np.median(values0) + 2 * median_abs_dev(values0)
     neighbor_lists = find_neighbors_from_file(curv_file)
 
+    # ------------------------------------------------------------------------
+    # Find inner anchor points once for the whole surface
+    # (they are filtered for each fold below):
+    # ------------------------------------------------------------------------
+    inner_anchors_all = np.array(find_max_values(points, values,
+                                                 min_separation, thr),
+                                 dtype=int)
+
     # ------------------------------------------------------------------------
     # Loop through folds:
     # ------------------------------------------------------------------------
     t1 = time()
-    skeletons = []
-    unique_fold_IDs = [x for x in np.unique(folds) if x != background_value]
-
-    if verbose:
-        if len(unique_fold_IDs) == 1:
-            print("Extract a fundus from 1 fold...")
-        else:
-            print("Extract a fundus from each of {0} folds...".
-                  format(len(unique_fold_IDs)))
-
-    for fold_ID in unique_fold_IDs:
-        indices_fold = [i for i,x in enumerate(folds) if x == fold_ID]
-        if indices_fold:
-            if verbose:
-                print('  Fold {0}:'.format(int(fold_ID)))
-
-            # ----------------------------------------------------------------
-            # Find outer anchor points on the boundary of the surface region,
-            # to serve as fundus endpoints:
-            # ----------------------------------------------------------------
-            outer_anchors, tracks = find_outer_endpoints(indices_fold,
-                neighbor_lists, values, depths, min_separation,
-                background_value, verbose)
-
-            # ----------------------------------------------------------------
-            # Find inner anchor points:
-            # ----------------------------------------------------------------
-            inner_anchors = find_max_values(points, values, min_separation,
-                                            thr)
-
-            # ----------------------------------------------------------------
-            # Connect anchor points to create skeleton:
-            # ----------------------------------------------------------------
-            B = background_value * np.ones(npoints)
-            B[indices_fold] = 1
-            skeleton = connect_points_erosion(B, neighbor_lists,
-                outer_anchors, inner_anchors, values, erode_ratio,
-                erode_min_size, [], '', background_value, verbose)
-            if skeleton:
-                skeletons.extend(skeleton)
-
-            ## ---------------------------------------------------------------
-            ## Remove fundus vertices if they make complete triangle faces:
-            ## ---------------------------------------------------------------
-            #Iremove = find_complete_faces(skeletons, faces)
-            #if Iremove:
-            #    skeletons = list(frozenset(skeletons).difference(Iremove))
+    skeletons = fundi_from_folds(folds, neighbor_lists, values, depths,
+                                 inner_anchors_all, min_separation,
+                                 erode_ratio, erode_min_size,
+                                 background_value, verbose, n_jobs)
 
     indices_skel = [x for x in skeletons if folds[x] != background_value]
     fundus_per_fold = background_value * np.ones(npoints)
@@ -249,6 +219,269 @@ def extract_fundi(folds, curv_file, depth_file, min_separation=10,
     return fundus_per_fold,  n_fundi_in_folds, fundus_per_fold_file
 
 
+def fundi_from_folds(folds, neighbor_lists, values, depths, inner_anchors,
+                     min_separation=10, erode_ratio=0.1, erode_min_size=1,
+                     background_value=-1, verbose=False, n_jobs=1):
+    """
+    Extract a fundus from each fold (see extract_fundi()).
+
+    With n_jobs > 1, folds are processed by a pool of worker processes
+    that share the surface's values and neighbor (CSR) arrays through
+    shared memory; the largest folds are started first, and the fundi are
+    merged in fold order, so the result is the same as with n_jobs=1.
+
+    Parameters
+    ----------
+    folds : numpy array of integers
+        fold number for each vertex
+    neighbor_lists : list of lists of integers
+        indices to neighboring vertices for each vertex
+    values : numpy array of floats
+        depth times curvature value for each vertex
+    depths : numpy array of floats
+        depth value for each vertex
+    inner_anchors : numpy array of integers
+        indices of inner anchor vertices (for any fold)
+    min_separation : integer
+        minimum number of edges between inner/outer anchor points
+    erode_ratio : float
+        fraction of indices to test for removal at each iteration
+        in connect_points_erosion()
+    erode_min_size : integer
+        minimum size for eroding in connect_points_erosion()
+    background_value : integer or float
+        background value
+    verbose : bool
+        print statements?
+    n_jobs : integer
+        number of processes to extract fundi from folds
+        (None or < 1: number of CPUs)
+
+    Returns
+    -------
+    skeletons : list of integers
+        indices to fundus vertices, fold by fold
+
+    Examples
+    --------
+    >>> # Two folds along a valley of a synthetic grid mesh:
+    >>> import numpy as np
+    >>> from mindboggle.guts.mesh import find_neighbors
+    >>> from mindboggle.guts.paths import find_max_values
+    >>> from mindboggle.features.fundi import fundi_from_folds
+    >>> nx, ny = 20, 11
+    >>> x, y = np.meshgrid(np.arange(nx), np.arange(ny))
+    >>> points = np.column_stack([x.ravel(), y.ravel(), np.zeros(x.size)])
+    >>> corners = [a for a in range(nx * (ny - 1)) if (a + 1) % nx]
+    >>> faces = ([[a, a+1, a+nx] for a in corners] +
+    ...          [[a+1, a+nx+1, a+nx] for a in corners])
+    >>> neighbor_lists = find_neighbors(faces, len(points))
+    >>> depths = 1 - np.abs(y.ravel() - 5) / 5.0
+    >>> values = depths * np.cos(x.ravel() / 3.0) ** 2
+    >>> folds = np.where(depths > 0.1, 1, -1)
+    >>> folds[(folds == 1) & (x.ravel() >= 10)] = 2
+    >>> inner_anchors = find_max_values(points, values, 3, 0.8)
+    >>> skeletons = fundi_from_folds(folds, neighbor_lists, values, depths,
+    ...                              inner_anchors, 3)
+    >>> sorted(np.unique(folds[skeletons]).tolist())
+    [1, 2]
+    >>> skeletons == fundi_from_folds(folds, neighbor_lists, values, depths,
+    ...                               inner_anchors, 3, n_jobs=2)
+    True
+
+    """
+    import os
+    import numpy as np
+
+    folds = np.asarray(folds)
+    skeletons = []
+    unique_fold_IDs = [x for x in np.unique(folds) if x != background_value]
+
+    if verbose:
+        if len(unique_fold_IDs) == 1:
+            print("Extract a fundus from 1 fold...")
+        else:
+            print("Extract a fundus from each of {0} folds...".
+                  format(len(unique_fold_IDs)))
+
+    if n_jobs is None or n_jobs < 1:
+        n_jobs = os.cpu_count() or 1
+    n_jobs = min(n_jobs, len(unique_fold_IDs))
+
+    if n_jobs > 1:
+        import multiprocessing as mp
+        from mindboggle.guts.utilities import share_arrays, release_arrays
+
+        # Share the surface arrays (neighbors in CSR form) with the workers:
+        sizes = np.array([len(x) for x in neighbor_lists], dtype=int)
+        indptr = np.concatenate(([0], np.cumsum(sizes)))
+        adjacency = np.array([x for y in neighbor_lists for x in y],
+                             dtype=int)
+        specs, blocks = share_arrays({'folds': folds, 'values': values,
+                                      'depths': depths, 'indptr': indptr,
+                                      'adjacency': adjacency,
+                                      'inner_anchors': inner_anchors})
+        try:
+            # Start the largest folds first, and merge in fold order:
+            fold_sizes = [np.sum(folds == x) for x in unique_fold_IDs]
+            with mp.Pool(n_jobs, initializer=_mp_fundi_init,
+                         initargs=(specs,)) as pool:
+                results = {}
+                for i in np.argsort(fold_sizes, kind='mergesort')[::-1]:
+                    results[i] = pool.apply_async(_mp_fundi_worker,
+                        args=(unique_fold_IDs[i], min_separation,
+                              erode_ratio, erode_min_size, background_value,
+                              verbose))
+                for i in range(len(unique_fold_IDs)):
+                    skeletons.extend(results[i].get())
+        finally:
+            release_arrays(blocks)
+    else:
+        for fold_ID in unique_fold_IDs:
+            skeletons.extend(fundus_from_fold(fold_ID, folds, neighbor_lists,
+                values, depths, inner_anchors, min_separation,
+                erode_ratio, erode_min_size, background_value, verbose))
+
+    return skeletons
+
+
+def fundus_from_fold(fold_ID, folds, neighbor_lists, values, depths,
+                     inner_anchors, min_separation=10, erode_ratio=0.1,
+                     erode_min_size=1, background_value=-1, verbose=False):
+    """
+    Extract a fundus from one fold (see extract_fundi()).
+
+    Parameters
+    ----------
+    fold_ID : integer
+        fold number
+    folds : numpy array of integers
+        fold number for each vertex
+    neighbor_lists : list of lists of integers
+        indices to neighboring vertices for each vertex
+    values : numpy array of floats
+        depth times curvature value for each vertex
+    depths : numpy array of floats
+        depth value for each vertex
+    inner_anchors : numpy array of integers
+        indices of inner anchor vertices (for any fold)
+    min_separation : integer
+        minimum number of edges between inner/outer anchor points
+    erode_ratio : float
+        fraction of indices to test for removal at each iteration
+        in connect_points_erosion()
+    erode_min_size : integer
+        minimum size for eroding in connect_points_erosion()
+    background_value : integer or float
+        background value
+    verbose : bool
+        print statements?
+
+    Returns
+    -------
+    skeleton : list of integers
+        indices to fundus vertices in the fold
+
+    Examples
+    --------
+    >>> # Fundus along a valley of a synthetic grid mesh (see extract_fundi()):
+    >>> import numpy as np
+    >>> from mindboggle.guts.mesh import find_neighbors
+    >>> from mindboggle.guts.paths import find_max_values
+    >>> from mindboggle.features.fundi import fundus_from_fold
+    >>> nx, ny = 20, 11
+    >>> x, y = np.meshgrid(np.arange(nx), np.arange(ny))
+    >>> points = np.column_stack([x.ravel(), y.ravel(), np.zeros(x.size)])
+    >>> corners = [a for a in range(nx * (ny - 1)) if (a + 1) % nx]
+    >>> faces = ([[a, a+1, a+nx] for a in corners] +
+    ...          [[a+1, a+nx+1, a+nx] for a in corners])
+    >>> neighbor_lists = find_neighbors(faces, len(points))
+    >>> depths = 1 - np.abs(y.ravel() - 5) / 5.0
+    >>> values = depths * np.cos(x.ravel() / 3.0) ** 2
+    >>> folds = np.where(depths > 0.1, 1, -1)
+    >>> folds[(folds == 1) & (x.ravel() >= 10)] = 2
+    >>> inner_anchors = find_max_values(points, values, 3, 0.8)
+    >>> skeleton = fundus_from_fold(1, folds, neighbor_lists, values, depths,
+    ...                             inner_anchors, 3)
+    >>> len(skeleton)
+    23
+    >>> # The fundus runs along the deepest row of the fold:
+    >>> sorted(i % nx for i in skeleton if depths[i] == 1)
+    [0, 1, 2, 3, 4, 5, 6, 7, 8, 9]
+
+    """
+    import numpy as np
+
+    #from mindboggle.guts.mesh import find_complete_faces
+    from mindboggle.guts.paths import find_outer_endpoints
+    from mindboggle.guts.paths import connect_points_erosion
+
+    indices_fold = np.nonzero(folds == fold_ID)[0].tolist()
+    skeleton = []
+    if indices_fold:
+        if verbose:
+            print('  Fold {0}:'.format(int(fold_ID)))
+
+        # --------------------------------------------------------------------
+        # Find outer anchor points on the boundary of the surface region,
+        # to serve as fundus endpoints:
+        # --------------------------------------------------------------------
+        outer_anchors, tracks = find_outer_endpoints(indices_fold,
+            neighbor_lists, values, depths, min_separation,
+            background_value, verbose)
+
+        # --------------------------------------------------------------------
+        # Find inner anchor points:
+        # --------------------------------------------------------------------
+        inner_anchors = np.asarray(inner_anchors, dtype=int)
+        inner_anchors = inner_anchors[folds[inner_anchors] == fold_ID].tolist()
+
+        # --------------------------------------------------------------------
+        # Connect anchor points to create skeleton:
+        # --------------------------------------------------------------------
+        B = background_value * np.ones(len(folds))
+        B[indices_fold] = 1
+        skeleton = connect_points_erosion(B, neighbor_lists,
+            outer_anchors, inner_anchors, values, erode_ratio,
+            erode_min_size, [], '', background_value, verbose)
+        if not skeleton:
+            skeleton = []
+
+        ## -------------------------------------------------------------------
+        ## Remove fundus vertices if they make complete triangle faces:
+        ## -------------------------------------------------------------------
+        #Iremove = find_complete_faces(skeleton, faces)
+        #if Iremove:
+        #    skeleton = list(frozenset(skeleton).difference(Iremove))
+
+    return skeleton
+
+
+# Surface arrays shared with extract_fundi's worker processes:
+_mp_fundi_arrays = {}
+
+
+def _mp_fundi_init(specs):
+    from mindboggle.guts.utilities import attach_arrays
+
+    arrays, handles = attach_arrays(specs)
+    indptr = arrays['indptr'].tolist()
+    adjacency = arrays['adjacency'].tolist()
+    _mp_fundi_arrays.update(arrays)
+    _mp_fundi_arrays['handles'] = handles
+    _mp_fundi_arrays['neighbor_lists'] = [adjacency[indptr[i]:indptr[i+1]]
+                                          for i in range(len(indptr) - 1)]
+
+
+def _mp_fundi_worker(fold_ID, min_separation, erode_ratio, erode_min_size,
+                     background_value, verbose):
+    A = _mp_fundi_arrays
+    return fundus_from_fold(fold_ID, A['folds'], A['neighbor_lists'],
+                            A['values'], A['depths'], A['inner_anchors'],
+                            min_separation, erode_ratio, erode_min_size,
+                            background_value, verbose)
+
+
 # ============================================================================
 # Doctests
 # ============================================================================
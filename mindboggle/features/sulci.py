@@ -12,7 +12,8 @@ Copyright 2016,  Mindboggle team (http://mindboggle.info), Apache v2.0 License
 
 def extract_sulci(labels_file, folds_or_file, hemi, min_boundary=1,
                   sulcus_names=[], save_file=False, output_file='',
-                  background_value=-1, verbose=False):
+                  background_value=-1, verbose=False,
+                  batch_propagation=False, n_jobs=1):
     """
     Identify sulci from folds in a brain surface according to a labeling
     protocol that includes a list of label pairs defining each sulcus.
@@ -47,6 +48,10 @@ def extract_sulci(labels_file, folds_or_file, hemi, min_boundary=1,
         4. If there are remaining vertices, segment into sets of vertices
            connected to label boundaries, and assign a unique ID to each set.
 
+    Label borders are indexed once for the whole surface, and since folds
+    are independent, they may be processed by a pool of worker processes
+    (n_jobs > 1) with the same result.
+
     Parameters
     ----------
     labels_file : string
@@ -67,6 +72,13 @@ def extract_sulci(labels_file, folds_or_file, hemi, min_boundary=1,
         background value
     verbose : bool
         print statements?
+    batch_propagation : bool
+        instead of propagating labels separately for each shared label
+        of each fold, propagate them for all folds together at the end
+        (see mindboggle.guts.segment.propagate_regions)?
+    n_jobs : integer
+        number of worker processes for identifying sulci in separate folds
+        (None or < 1: use all processors)
 
     Returns
     -------
@@ -157,7 +169,6 @@ def extract_sulci(labels_file, folds_or_file, hemi, min_boundary=1,
 
     from mindboggle.mio.vtks import read_scalars, read_vtk, rewrite_scalars
     from mindboggle.guts.mesh import find_neighbors
-    from mindboggle.guts.segment import extract_borders, propagate, segment_regions
     from mindboggle.mio.labels import DKTprotocol
 
     # Load fold numbers if folds_or_file is a string:
@@ -182,256 +193,18 @@ def extract_sulci(labels_file, folds_or_file, hemi, min_boundary=1,
             input_vtk = read_vtk(labels_file)
     neighbor_lists = find_neighbors(faces, npoints)
 
-    # Array of sulcus IDs for fold vertices, initialized as -1.
-    # Since we do not touch gyral vertices and vertices whose labels
-    # are not in the label list, or vertices having only one label,
-    # their sulcus IDs will remain -1:
-    sulci = background_value * np.ones(npoints)
-
     # ------------------------------------------------------------------------
     # Loop through folds
     # ------------------------------------------------------------------------
-    fold_numbers = [int(x) for x in np.unique(folds) if x != background_value]
-    n_folds = len(fold_numbers)
+    n_folds = len([x for x in np.unique(folds) if x != background_value])
     if verbose:
         print("Extract sulci from {0} folds...".format(n_folds))
     t0 = time()
-    for n_fold in fold_numbers:
-        fold_indices = [i for i,x in enumerate(folds) if x == n_fold]
-        len_fold = len(fold_indices)
-
-        # List the labels in this fold:
-        fold_labels = [labels[x] for x in fold_indices]
-        unique_fold_labels = [int(x) for x in np.unique(fold_labels)
-                              if x != background_value]
 
-        # --------------------------------------------------------------------
-        # NO MATCH -- fold has fewer than two labels
-        # --------------------------------------------------------------------
-        if verbose and len(unique_fold_labels) < 2:
-            # Ignore: sulci already initialized with -1 values:
-            if not unique_fold_labels:
-                print("  Fold {0} ({1} vertices): "
-                      "NO MATCH -- fold has no labels".
-                      format(n_fold, len_fold))
-            else:
-                print("  Fold {0} ({1} vertices): "
-                  "NO MATCH -- fold has only one label ({2})".
-                  format(n_fold, len_fold, unique_fold_labels[0]))
-            # Ignore: sulci already initialized with -1 values
-
-        else:
-            # Find all label boundary pairs within the fold:
-            indices_fold_pairs, fold_pairs, unique_fold_pairs = \
-                extract_borders(fold_indices, labels, neighbor_lists,
-                                ignore_values=[], return_label_pairs=True)
-
-            # Find fold label pairs in the protocol (pairs are already sorted):
-            fold_pairs_in_protocol = [x for x in unique_fold_pairs
-                                      if x in dkt.unique_sulcus_label_pairs]
-
-            if verbose and unique_fold_labels:
-                print("  Fold {0} labels: {1} ({2} vertices)".format(n_fold,
-                      ', '.join([str(x) for x in unique_fold_labels]),
-                      len_fold))
-            # ----------------------------------------------------------------
-            # NO MATCH -- fold has no sulcus label pair
-            # ----------------------------------------------------------------
-            if verbose and not fold_pairs_in_protocol:
-                print("  Fold {0}: NO MATCH -- fold has no sulcus label pair".
-                      format(n_fold, len_fold))
-
-            # ----------------------------------------------------------------
-            # Possible matches
-            # ----------------------------------------------------------------
-            else:
-                if verbose:
-                    print("  Fold {0} label pairs in protocol: {1}".format(n_fold,
-                          ', '.join([str(x) for x in fold_pairs_in_protocol])))
-
-                # Labels in the protocol (includes repeats across label pairs):
-                labels_in_pairs = [x for lst in fold_pairs_in_protocol
-                                   for x in lst]
-
-                # Labels that appear in one or more sulcus label boundary:
-                unique_labels = []
-                nonunique_labels = []
-                for label in np.unique(labels_in_pairs):
-                    if len([x for x in labels_in_pairs if x == label]) == 1:
-                        unique_labels.append(label)
-                    else:
-                        nonunique_labels.append(label)
-
-                # ------------------------------------------------------------
-                # Vertices whose labels are in only one sulcus label pair
-                # ------------------------------------------------------------
-                # Find vertices with a label that is in only one of the fold's
-                # label pairs (the other label in the pair can exist in other
-                # pairs). Assign the vertices the sulcus with the label pair
-                # if they are connected to the label boundary for that pair.
-                # ------------------------------------------------------------
-                if unique_labels:
-
-                    for pair in fold_pairs_in_protocol:
-
-                        # If one or both labels in label pair is/are unique:
-                        unique_labels_in_pair = [x for x in pair
-                                                 if x in unique_labels]
-                        n_unique = len(unique_labels_in_pair)
-                        if n_unique:
-
-                            ID = None
-                            for i, pair_list in enumerate(pair_lists):
-                                if not isinstance(pair_list, list):
-                                    pair_list = [pair_list]
-                                if pair in pair_list:
-                                    ID = i
-                                    break
-                            if ID:
-                                # Seeds from label boundary vertices
-                                # (fold_pairs and pair already sorted):
-                                indices_pair = [x for i,x
-                                    in enumerate(indices_fold_pairs)
-                                    if fold_pairs[i] == pair]
-
-                                # Vertices with unique label(s) in pair:
-                                indices_unique_labels = [fold_indices[i]
-                                     for i,x in enumerate(fold_labels)
-                                     if x in unique_labels_in_pair]
-                                             #dkt.unique_sulcus_label_pairs]
-
-                                # Propagate sulcus ID from seeds to vertices
-                                # with "unique" labels (only exist in one
-                                # label pair in a fold); propagation ensures
-                                # that sulci consist of contiguous vertices
-                                # for each label boundary:
-                                sulci2 = segment_regions(indices_unique_labels,
-                                         neighbor_lists,
-                                         min_region_size=1,
-                                         seed_lists=[indices_pair],
-                                         keep_seeding=False,
-                                         spread_within_labels=True,
-                                         labels=labels,
-                                         label_lists=[],
-                                         values=[], max_steps='',
-                                         background_value=background_value,
-                                         verbose=False)
-
-                                sulci[sulci2 != background_value] = ID
-
-                                # Print statement:
-                                if verbose:
-                                    if n_unique == 1:
-                                        ps1 = 'One label'
-                                    else:
-                                        ps1 = 'Both labels'
-                                    if len(sulcus_names):
-                                        ps2 = sulcus_names[ID]
-                                    else:
-                                        ps2 = ''
-                                    print("    {0} unique to one fold pair: "
-                                          "{1} {2}".
-                                          format(ps1, ps2,
-                                                 unique_labels_in_pair))
-
-                # ------------------------------------------------------------
-                # Vertex labels shared by multiple label pairs
-                # ------------------------------------------------------------
-                # Propagate labels from label borders to vertices with labels
-                # that are shared by multiple label pairs in the fold.
-                # ------------------------------------------------------------
-                if len(nonunique_labels):
-                    # For each label shared by different label pairs:
-                    for label in nonunique_labels:
-                        # Print statement:
-                        if verbose:
-                            print("    Propagate sulcus borders with label {0}".
-                                  format(int(label)))
-
-                        # Construct seeds from label boundary vertices:
-                        seeds = background_value * np.ones(npoints)
-
-                        for ID, pair_list in enumerate(pair_lists):
-                            if not isinstance(pair_list, list):
-                                pair_list = [pair_list]
-                            label_pairs = [x for x in pair_list if label in x]
-                            for label_pair in label_pairs:
-                                indices_pair = [x for i,x
-                                    in enumerate(indices_fold_pairs)
-                                    if np.sort(fold_pairs[i]).
-                                    tolist() == label_pair]
-                                if indices_pair:
-
-                                    # Do not include short boundary segments:
-                                    if min_boundary > 1:
-                                        indices_pair2 = []
-                                        seeds2 = segment_regions(indices_pair,
-                                                    neighbor_lists, 1, [],
-                                                    False, False, [], [],
-                                                    [], '', background_value,
-                                                    verbose)
-
-                                        useeds2 = [x for x in
-                                                   np.unique(seeds2)
-                                                   if x != background_value]
-                                        for seed2 in useeds2:
-                                            iseed2 = [i for i,x
-                                                      in enumerate(seeds2)
-                                                      if x == seed2]
-                                            if len(iseed2) >= min_boundary:
-                                                indices_pair2.extend(iseed2)
-                                            elif verbose:
-                                                if len(iseed2) == 1:
-                                                    print("    Remove "
-                                                          "assignment "
-                                                          "of ID {0} from "
-                                                          "1 vertex".
-                                                          format(seed2))
-                                                else:
-                                                    print("    Remove "
-                                                          "assignment "
-                                                          "of ID {0} from "
-                                                          "{1} vertices".
-                                                          format(seed2,
-                                                                 len(iseed2)))
-                                        indices_pair = indices_pair2
-
-                                    # Assign sulcus IDs to seeds:
-                                    seeds[indices_pair] = ID
-
-                        # Identify vertices with the label:
-                        indices_label = [fold_indices[i] for i,x
-                                         in enumerate(fold_labels)
-                                         if x == label]
-                        if len(indices_label):
-
-                            # Propagate sulcus ID from seeds to vertices
-                            # with a given shared label:
-                            seg_vs_prop = False
-                            if seg_vs_prop:
-                                indices_seeds = []
-                                for seed in [x for x in np.unique(seeds)
-                                             if x != background_value]:
-                                   indices_seeds.append([i for i,x
-                                                         in enumerate(seeds)
-                                                         if x == seed])
-
-                                sulci2 = segment_regions(indices_label,
-                                            neighbor_lists, 50, indices_seeds,
-                                            False, True, labels, [], [], '',
-                                            background_value, verbose)
-                            else:
-                                label_array = background_value * \
-                                              np.ones(npoints)
-                                label_array[indices_label] = 1
-                                sulci2 = propagate(points, faces,
-                                            label_array, seeds, sulci,
-                                            max_iters=10000,
-                                            tol=0.001, sigma=5,
-                                            background_value=background_value,
-                                            verbose=verbose)
-                            sulci[sulci2 != background_value] = \
-                                sulci2[sulci2 != background_value]
+    sulci = sulci_from_folds(folds, labels, points, faces, neighbor_lists,
+                             hemi, min_boundary, sulcus_names,
+                             background_value, verbose, batch_propagation,
+                             n_jobs)
 
     sulcus_numbers = [int(x) for x in np.unique(sulci)
                       if x != background_value]
@@ -487,6 +260,623 @@ def extract_sulci(labels_file, folds_or_file, hemi, min_boundary=1,
     return sulci, n_sulci, sulci_file
 
 
+def label_border_index(labels, neighbor_lists):
+    """
+    Index the sorted, unique labels of the neighbors of each vertex.
+
+    Border vertices have neighbors with two or more labels
+    (see mindboggle.guts.segment.extract_borders()), so indexing the labels
+    of the whole surface once lets each fold look up its label borders.
+
+    Parameters
+    ----------
+    labels : numpy array of integers
+        label number for each vertex
+    neighbor_lists : list of lists of integers
+        indices to neighboring vertices for each vertex
+
+    Returns
+    -------
+    border_indptr : numpy array of integers
+        offsets into border_labels for each vertex (and one past the last)
+    border_labels : numpy array of integers
+        sorted, unique labels of the neighbors of each vertex
+
+    Examples
+    --------
+    >>> from mindboggle.features.sulci import label_border_index
+    >>> labels = [3, 3, 5, 5]
+    >>> neighbor_lists = [[1], [0, 2], [1, 3], [2]]
+    >>> border_indptr, border_labels = label_border_index(labels,
+    ...                                                   neighbor_lists)
+    >>> border_indptr.tolist(), border_labels.tolist()
+    ([0, 1, 3, 5, 6], [3, 3, 5, 3, 5, 5])
+
+    """
+    import numpy as np
+
+    labels = np.asarray(labels)
+    npoints = len(neighbor_lists)
+    sizes = np.array([len(x) for x in neighbor_lists], dtype=int)
+    adjacency = np.array([x for y in neighbor_lists for x in y], dtype=int)
+    rows = np.repeat(np.arange(npoints), sizes)
+    neighbor_labels = labels[adjacency]
+    order = np.lexsort((neighbor_labels, rows))
+    rows = rows[order]
+    neighbor_labels = neighbor_labels[order]
+    first = np.ones(len(rows), dtype=bool)
+    first[1:] = (rows[1:] != rows[:-1]) | \
+                (neighbor_labels[1:] != neighbor_labels[:-1])
+    border_labels = neighbor_labels[first]
+    border_indptr = np.concatenate(([0],
+        np.cumsum(np.bincount(rows[first], minlength=npoints))))
+
+    return border_indptr, border_labels
+
+
+def sulcus_pair_lookups(hemi):
+    """
+    Hashed lookups for the DKT protocol's sulcus label pairs.
+
+    Each label pair maps to the first sulcus ID whose pair list contains it,
+    and each label maps to the (sulcus ID, label pair) entries that contain
+    it, in protocol order.
+
+    Parameters
+    ----------
+    hemi : string
+        hemisphere abbreviation in {'lh', 'rh'} for sulcus labels
+
+    Returns
+    -------
+    lookups : tuple
+        set of protocol label pairs, dictionary of sulcus ID for each
+        label pair, and dictionary of (sulcus ID, label pair) lists
+        for each label
+
+    Examples
+    --------
+    >>> from mindboggle.features.sulci import sulcus_pair_lookups
+    >>> protocol_pairs, pair_IDs, label_pair_IDs = sulcus_pair_lookups('lh')
+    >>> pair_IDs[(1012, 1028)], pair_IDs[(1003, 1028)]
+    (0, 1)
+    >>> label_pair_IDs[1006]
+    [(23, (1006, 1007))]
+
+    """
+    from mindboggle.mio.labels import DKTprotocol
+
+    dkt = DKTprotocol()
+
+    if hemi == 'lh':
+        pair_lists = dkt.left_sulcus_label_pair_lists
+    elif hemi == 'rh':
+        pair_lists = dkt.right_sulcus_label_pair_lists
+    else:
+        raise IOError("Warning: hemisphere not properly specified ('lh' or 'rh').")
+
+    protocol_pairs = set(tuple(x) for x in dkt.unique_sulcus_label_pairs)
+    pair_IDs = {}
+    label_pair_IDs = {}
+    for ID, pair_list in enumerate(pair_lists):
+        if not isinstance(pair_list, list):
+            pair_list = [pair_list]
+        for pair in pair_list:
+            pair_IDs.setdefault(tuple(pair), ID)
+            for label in set(pair):
+                label_pair_IDs.setdefault(label, []).append((ID, tuple(pair)))
+
+    return protocol_pairs, pair_IDs, label_pair_IDs
+
+
+def sulci_from_folds(folds, labels, points, faces, neighbor_lists, hemi,
+                     min_boundary=1, sulcus_names=[], background_value=-1,
+                     verbose=False, batch_propagation=False, n_jobs=1):
+    """
+    Identify sulci in each fold of a surface (see extract_sulci()).
+
+    Since folds are independent, they may be processed by a pool of worker
+    processes (n_jobs > 1) that share the surface arrays through shared
+    memory; the largest folds are started first, and the sulci are merged
+    in fold order, so the result is the same as with n_jobs=1.
+
+    Parameters
+    ----------
+    folds : numpy array or list of integers
+        fold number for each vertex
+    labels : numpy array or list of integers
+        label number for each vertex
+    points : array (or list) of lists of three floats
+        coordinates for all vertices
+    faces : array (or list) of lists of three integers
+        indices to three vertices per face
+    neighbor_lists : list of lists of integers
+        indices to neighboring vertices for each vertex
+    hemi : string
+        hemisphere abbreviation in {'lh', 'rh'} for sulcus labels
+    min_boundary : integer
+        minimum number of vertices for a sulcus label boundary segment
+    sulcus_names : list of strings
+        names of sulci
+    background_value : integer or float
+        background value
+    verbose : bool
+        print statements?
+    batch_propagation : bool
+        propagate labels for all folds together at the end
+        (see extract_sulci())?
+    n_jobs : integer
+        number of worker processes for identifying sulci in separate folds
+        (None or < 1: use all processors)
+
+    Returns
+    -------
+    sulci : numpy array of floats
+        sulcus numbers for all vertices (-1 for non-sulcus vertices)
+
+    Examples
+    --------
+    >>> # Two folds across the borders of sulcus label pairs of a grid mesh:
+    >>> import numpy as np
+    >>> from mindboggle.guts.mesh import find_neighbors
+    >>> from mindboggle.features.sulci import sulci_from_folds
+    >>> nx, ny = 20, 12
+    >>> x, y = np.meshgrid(np.arange(nx), np.arange(ny))
+    >>> x, y = x.ravel(), y.ravel()
+    >>> points = np.column_stack([x, y, np.zeros(x.size)])
+    >>> corners = [a for a in range(nx * (ny - 1)) if (a + 1) % nx]
+    >>> faces = ([[a, a+1, a+nx] for a in corners] +
+    ...          [[a+1, a+nx+1, a+nx] for a in corners])
+    >>> neighbor_lists = find_neighbors(faces, len(points))
+    >>> labels = np.where(y < 6, np.where(x < 10, 1006, 1007),
+    ...                   np.where(x < 10, 1003, 1028))
+    >>> folds = -1 * np.ones(len(points), dtype=int)
+    >>> folds[(x > 3) & (x < 16) & (y > 0) & (y < 5)] = 1
+    >>> folds[(x > 3) & (x < 16) & (y > 6) & (y < 11)] = 2
+    >>> sulci = sulci_from_folds(folds, labels, points, faces,
+    ...                          neighbor_lists, 'lh')
+    >>> [(int(n), int(np.sum(sulci == n))) for n in np.unique(sulci)]
+    [(-1, 144), (1, 48), (23, 48)]
+    >>> np.array_equal(sulci, sulci_from_folds(folds, labels, points, faces,
+    ...                                        neighbor_lists, 'lh', n_jobs=2))
+    True
+
+    """
+    import os
+    import numpy as np
+
+    from mindboggle.guts.segment import propagate_regions
+
+    npoints = len(neighbor_lists)
+    faces_array = np.asarray(faces, dtype=int)
+    folds_array = np.asarray(folds)
+    labels_array = np.asarray(labels)
+
+    # ------------------------------------------------------------------------
+    # Index the label borders of the whole surface once, and look up
+    # the protocol's sulcus label pairs:
+    # ------------------------------------------------------------------------
+    border_indptr, border_labels = label_border_index(labels_array,
+                                                      neighbor_lists)
+    lookups = sulcus_pair_lookups(hemi)
+
+    # Array of sulcus IDs for fold vertices, initialized as -1.
+    # Since we do not touch gyral vertices and vertices whose labels
+    # are not in the label list, or vertices having only one label,
+    # their sulcus IDs will remain -1:
+    sulci = background_value * np.ones(npoints)
+
+    # For batch propagation, number each (fold, shared label) region
+    # and collect its seeds:
+    if batch_propagation:
+        batch_regions = background_value * np.ones(npoints)
+        batch_seeds = background_value * np.ones(npoints)
+        n_batch_regions = 0
+
+    # ------------------------------------------------------------------------
+    # Loop through folds
+    # ------------------------------------------------------------------------
+    fold_numbers = [int(x) for x in np.unique(folds_array)
+                    if x != background_value]
+    n_folds = len(fold_numbers)
+
+    if n_jobs is None or n_jobs < 1:
+        n_jobs = os.cpu_count() or 1
+    n_jobs = min(n_jobs, n_folds)
+
+    if n_jobs > 1:
+        import multiprocessing as mp
+        from mindboggle.guts.utilities import share_arrays, release_arrays
+
+        # Share the surface arrays (neighbors in CSR form) with the workers:
+        sizes = np.array([len(x) for x in neighbor_lists], dtype=int)
+        indptr = np.concatenate(([0], np.cumsum(sizes)))
+        adjacency = np.array([x for y in neighbor_lists for x in y],
+                             dtype=int)
+        specs, blocks = share_arrays({'points': np.asarray(points),
+                                      'faces': faces_array,
+                                      'folds': folds_array,
+                                      'labels': labels_array,
+                                      'indptr': indptr,
+                                      'adjacency': adjacency,
+                                      'border_indptr': border_indptr,
+                                      'border_labels': border_labels})
+        try:
+            # Start the largest folds first, and merge in fold order:
+            fold_sizes = [np.sum(folds_array == x) for x in fold_numbers]
+            with mp.Pool(n_jobs, initializer=_mp_sulci_init,
+                         initargs=(specs, lookups)) as pool:
+                results = {}
+                for i in np.argsort(fold_sizes, kind='mergesort')[::-1]:
+                    results[i] = pool.apply_async(_mp_sulci_worker,
+                        args=(fold_numbers[i], min_boundary, sulcus_names,
+                              batch_propagation, background_value, verbose))
+                fold_results = [results[i].get()
+                                for i in range(len(fold_numbers))]
+        finally:
+            release_arrays(blocks)
+    else:
+        fold_results = [sulci_from_fold(n_fold, folds_array, labels_array,
+                            points, faces_array, neighbor_lists,
+                            border_indptr, border_labels, lookups,
+                            min_boundary, sulcus_names, batch_propagation,
+                            background_value, verbose)
+                        for n_fold in fold_numbers]
+
+    for indices_sulci, fold_sulci, fold_regions in fold_results:
+        sulci[indices_sulci] = fold_sulci
+        if batch_propagation:
+            for indices_label, seeds_label in fold_regions:
+                batch_regions[indices_label] = n_batch_regions
+                batch_seeds[indices_label] = seeds_label
+                n_batch_regions += 1
+
+    # Propagate sulcus IDs within all of the shared-label regions at once:
+    if batch_propagation and n_batch_regions:
+        if verbose:
+            print("  Propagate sulcus borders in {0} regions".
+                  format(n_batch_regions))
+        sulci2 = propagate_regions(points, faces, batch_regions, batch_seeds,
+                                   max_iters=10000, tol=0.001, sigma=5,
+                                   background_value=background_value,
+                                   verbose=verbose)
+        sulci[sulci2 != background_value] = sulci2[sulci2 != background_value]
+
+    return sulci
+
+
+def sulci_from_fold(n_fold, folds, labels, points, faces, neighbor_lists,
+                    border_indptr, border_labels, lookups, min_boundary=1,
+                    sulcus_names=[], batch_propagation=False,
+                    background_value=-1, verbose=False):
+    """
+    Identify sulci in one fold (see extract_sulci()).
+
+    Parameters
+    ----------
+    n_fold : integer
+        fold number
+    folds : numpy array of integers
+        fold number for each vertex
+    labels : numpy array of integers
+        label number for each vertex
+    points : array (or list) of lists of three floats
+        coordinates for all vertices
+    faces : numpy array of integers
+        indices to three vertices per face
+    neighbor_lists : list of lists of integers
+        indices to neighboring vertices for each vertex
+    border_indptr : numpy array of integers
+        offsets into border_labels for each vertex (and one past the last)
+    border_labels : numpy array of integers
+        sorted, unique labels of the neighbors of each vertex
+    lookups : tuple
+        set of protocol label pairs, dictionary of sulcus ID for each
+        label pair, and dictionary of (sulcus ID, label pair) lists
+        for each label (see extract_sulci())
+    min_boundary : integer
+        minimum number of vertices for a sulcus label boundary segment
+    sulcus_names : list of strings
+        names of sulci
+    batch_propagation : bool
+        return shared-label regions instead of propagating within them?
+    background_value : integer or float
+        background value
+    verbose : bool
+        print statements?
+
+    Returns
+    -------
+    indices_sulci : numpy array of integers
+        indices to vertices assigned a sulcus ID
+    fold_sulci : numpy array of floats
+        sulcus ID for each vertex in indices_sulci
+    fold_regions : list of tuples
+        indices to vertices and their seed values for each shared-label
+        region (for batch propagation)
+
+    Examples
+    --------
+    >>> # Fold across the border of a sulcus label pair of a grid mesh
+    >>> # (see extract_sulci()):
+    >>> import numpy as np
+    >>> from mindboggle.guts.mesh import find_neighbors
+    >>> from mindboggle.features.sulci import sulci_from_fold
+    >>> from mindboggle.features.sulci import label_border_index
+    >>> from mindboggle.features.sulci import sulcus_pair_lookups
+    >>> nx, ny = 20, 6
+    >>> x, y = np.meshgrid(np.arange(nx), np.arange(ny))
+    >>> x, y = x.ravel(), y.ravel()
+    >>> points = np.column_stack([x, y, np.zeros(x.size)])
+    >>> corners = [a for a in range(nx * (ny - 1)) if (a + 1) % nx]
+    >>> faces = np.array([[a, a+1, a+nx] for a in corners] +
+    ...                  [[a+1, a+nx+1, a+nx] for a in corners])
+    >>> neighbor_lists = find_neighbors(faces, len(points))
+    >>> labels = np.where(x < 10, 1003, 1028)
+    >>> folds = np.where((x > 3) & (x < 16) & (y > 0) & (y < 5), 1, -1)
+    >>> border_indptr, border_labels = label_border_index(labels,
+    ...                                                   neighbor_lists)
+    >>> lookups = sulcus_pair_lookups('lh')
+    >>> indices_sulci, fold_sulci, fold_regions = sulci_from_fold(1, folds,
+    ...     labels, points, faces, neighbor_lists, border_indptr,
+    ...     border_labels, lookups)
+    >>> len(indices_sulci), np.unique(fold_sulci).tolist()
+    (48, [1.0])
+
+    """
+    import numpy as np
+
+    from mindboggle.guts.segment import propagate, segment_regions
+
+    protocol_pairs, pair_IDs, label_pair_IDs = lookups
+    npoints = len(folds)
+    sulci = background_value * np.ones(npoints)
+    fold_regions = []
+
+    fold_indices = np.nonzero(folds == n_fold)[0]
+    len_fold = len(fold_indices)
+
+    # Faces of the fold (to propagate sulcus IDs within the fold):
+    fold_faces = faces[np.all(folds[faces] == n_fold, axis=1)]
+
+    # List the labels in this fold:
+    fold_labels = labels[fold_indices]
+    unique_fold_labels = [int(x) for x in np.unique(fold_labels)
+                          if x != background_value]
+
+    # ------------------------------------------------------------------------
+    # NO MATCH -- fold has fewer than two labels
+    # ------------------------------------------------------------------------
+    if verbose and len(unique_fold_labels) < 2:
+        # Ignore: sulci already initialized with -1 values:
+        if not unique_fold_labels:
+            print("  Fold {0} ({1} vertices): "
+                  "NO MATCH -- fold has no labels".
+                  format(n_fold, len_fold))
+        else:
+            print("  Fold {0} ({1} vertices): "
+              "NO MATCH -- fold has only one label ({2})".
+              format(n_fold, len_fold, unique_fold_labels[0]))
+        # Ignore: sulci already initialized with -1 values
+
+    else:
+        # Find all label boundary pairs within the fold from the border
+        # index, with the fold's boundary vertices for each pair:
+        nborder_labels = border_indptr[fold_indices + 1] - \
+                         border_indptr[fold_indices]
+        indices_fold_pairs = {}
+        for index in fold_indices[nborder_labels >= 2].tolist():
+            pair = tuple(border_labels[border_indptr[index]:
+                                       border_indptr[index + 1]].tolist())
+            indices_fold_pairs.setdefault(pair, []).append(index)
+        unique_fold_pairs = [list(x) for x in indices_fold_pairs]
+
+        # Find fold label pairs in the protocol (pairs are already sorted):
+        fold_pairs_in_protocol = [x for x in unique_fold_pairs
+                                  if tuple(x) in protocol_pairs]
+
+        if verbose and unique_fold_labels:
+            print("  Fold {0} labels: {1} ({2} vertices)".format(n_fold,
+                  ', '.join([str(x) for x in unique_fold_labels]),
+                  len_fold))
+        # --------------------------------------------------------------------
+        # NO MATCH -- fold has no sulcus label pair
+        # --------------------------------------------------------------------
+        if verbose and not fold_pairs_in_protocol:
+            print("  Fold {0}: NO MATCH -- fold has no sulcus label pair".
+                  format(n_fold, len_fold))
+
+        # --------------------------------------------------------------------
+        # Possible matches
+        # --------------------------------------------------------------------
+        else:
+            if verbose:
+                print("  Fold {0} label pairs in protocol: {1}".format(n_fold,
+                      ', '.join([str(x) for x in fold_pairs_in_protocol])))
+
+            # Labels in the protocol (includes repeats across label pairs):
+            labels_in_pairs = [x for lst in fold_pairs_in_protocol
+                               for x in lst]
+
+            # Labels that appear in one or more sulcus label boundary:
+            unique_labels = []
+            nonunique_labels = []
+            if labels_in_pairs:
+                labels_in_pairs, counts = np.unique(labels_in_pairs,
+                                                    return_counts=True)
+                unique_labels = labels_in_pairs[counts == 1].tolist()
+                nonunique_labels = labels_in_pairs[counts > 1].tolist()
+
+            # ----------------------------------------------------------------
+            # Vertices whose labels are in only one sulcus label pair
+            # ----------------------------------------------------------------
+            # Find vertices with a label that is in only one of the fold's
+            # label pairs (the other label in the pair can exist in other
+            # pairs). Assign the vertices the sulcus with the label pair
+            # if they are connected to the label boundary for that pair.
+            # ----------------------------------------------------------------
+            if unique_labels:
+
+                for pair in fold_pairs_in_protocol:
+
+                    # If one or both labels in label pair is/are unique:
+                    unique_labels_in_pair = [x for x in pair
+                                             if x in unique_labels]
+                    n_unique = len(unique_labels_in_pair)
+                    if n_unique:
+
+                        ID = pair_IDs.get(tuple(pair))
+                        if ID:
+                            # Seeds from label boundary vertices
+                            # (fold pairs and pair already sorted):
+                            indices_pair = indices_fold_pairs[tuple(pair)]
+
+                            # Vertices with unique label(s) in pair:
+                            indices_unique_labels = fold_indices[
+                                np.isin(fold_labels,
+                                        unique_labels_in_pair)].tolist()
+
+                            # Propagate sulcus ID from seeds to vertices
+                            # with "unique" labels (only exist in one
+                            # label pair in a fold); propagation ensures
+                            # that sulci consist of contiguous vertices
+                            # for each label boundary:
+                            sulci2 = segment_regions(indices_unique_labels,
+                                     neighbor_lists,
+                                     min_region_size=1,
+                                     seed_lists=[indices_pair],
+                                     keep_seeding=False,
+                                     spread_within_labels=True,
+                                     labels=labels,
+                                     label_lists=[],
+                                     values=[], max_steps='',
+                                     background_value=background_value,
+                                     verbose=False)
+
+                            sulci[sulci2 != background_value] = ID
+
+                            # Print statement:
+                            if verbose:
+                                if n_unique == 1:
+                                    ps1 = 'One label'
+                                else:
+                                    ps1 = 'Both labels'
+                                if len(sulcus_names):
+                                    ps2 = sulcus_names[ID]
+                                else:
+                                    ps2 = ''
+                                print("    {0} unique to one fold pair: "
+                                      "{1} {2}".
+                                      format(ps1, ps2,
+                                             unique_labels_in_pair))
+
+            # ----------------------------------------------------------------
+            # Vertex labels shared by multiple label pairs
+            # ----------------------------------------------------------------
+            # Propagate labels from label borders to vertices with labels
+            # that are shared by multiple label pairs in the fold.
+            # ----------------------------------------------------------------
+            if len(nonunique_labels):
+                # For each label shared by different label pairs:
+                for label in nonunique_labels:
+                    # Print statement:
+                    if verbose:
+                        print("    Propagate sulcus borders with label {0}".
+                              format(int(label)))
+
+                    # Construct seeds from label boundary vertices:
+                    seeds = background_value * np.ones(npoints)
+
+                    for ID, label_pair in label_pair_IDs.get(label, []):
+                        indices_pair = indices_fold_pairs.get(label_pair, [])
+                        if indices_pair:
+
+                            # Do not include short boundary segments:
+                            if min_boundary > 1:
+                                indices_pair2 = []
+                                seeds2 = segment_regions(indices_pair,
+                                            neighbor_lists, 1, [],
+                                            False, False, [], [],
+                                            [], '', background_value,
+                                            verbose)
+
+                                useeds2 = [x for x in np.unique(seeds2)
+                                           if x != background_value]
+                                for seed2 in useeds2:
+                                    iseed2 = np.nonzero(seeds2 ==
+                                                        seed2)[0].tolist()
+                                    if len(iseed2) >= min_boundary:
+                                        indices_pair2.extend(iseed2)
+                                    elif verbose:
+                                        if len(iseed2) == 1:
+                                            print("    Remove assignment "
+                                                  "of ID {0} from "
+                                                  "1 vertex".
+                                                  format(seed2))
+                                        else:
+                                            print("    Remove assignment "
+                                                  "of ID {0} from "
+                                                  "{1} vertices".
+                                                  format(seed2,
+                                                         len(iseed2)))
+                                indices_pair = indices_pair2
+
+                            # Assign sulcus IDs to seeds:
+                            seeds[indices_pair] = ID
+
+                    # Identify vertices with the label:
+                    indices_label = fold_indices[fold_labels ==
+                                                 label].tolist()
+                    if len(indices_label):
+
+                        # Propagate sulcus ID from seeds to vertices
+                        # with a given shared label:
+                        if batch_propagation:
+                            fold_regions.append((indices_label,
+                                                 seeds[indices_label]))
+                            continue
+                        label_array = background_value * np.ones(npoints)
+                        label_array[indices_label] = 1
+                        sulci2 = propagate(points, fold_faces, label_array,
+                                    seeds, sulci, max_iters=10000, tol=0.001,
+                                    sigma=5,
+                                    background_value=background_value,
+                                    verbose=verbose)
+                        sulci[sulci2 != background_value] = \
+                            sulci2[sulci2 != background_value]
+
+    indices_sulci = np.nonzero(sulci != background_value)[0]
+
+    return indices_sulci, sulci[indices_sulci], fold_regions
+
+
+# Surface arrays and label pair lookups shared with extract_sulci's workers:
+_mp_sulci_arrays = {}
+
+
+def _mp_sulci_init(specs, lookups):
+    from mindboggle.guts.utilities import attach_arrays
+
+    arrays, handles = attach_arrays(specs)
+    indptr = arrays['indptr'].tolist()
+    adjacency = arrays['adjacency'].tolist()
+    _mp_sulci_arrays.update(arrays)
+    _mp_sulci_arrays['handles'] = handles
+    _mp_sulci_arrays['lookups'] = lookups
+    _mp_sulci_arrays['neighbor_lists'] = [adjacency[indptr[i]:indptr[i+1]]
+                                          for i in range(len(indptr) - 1)]
+
+
+def _mp_sulci_worker(n_fold, min_boundary, sulcus_names, batch_propagation,
+                     background_value, verbose):
+    A = _mp_sulci_arrays
+    return sulci_from_fold(n_fold, A['folds'], A['labels'], A['points'],
+                           A['faces'], A['neighbor_lists'],
+                           A['border_indptr'], A['border_labels'],
+                           A['lookups'], min_boundary, sulcus_names,
+                           batch_propagation, background_value, verbose)
+
+
 # ============================================================================
 # Doctests
 # ============================================================================
@@ -4,7 +4,7 @@ Graph operations:
 
     - Diagonal degree matrix
     - Matrix weights and affinity matrix
-    - Graph Laplacian
+    - Graph Laplacian (and a cache of Laplacians of meshes)
 
 Authors:
     - Eliezer Stavsky, 2012 (eli.stavsky@gmail.com)
@@ -13,11 +13,19 @@ Authors:
 Copyright 2016,  Mindboggle team (http://mindboggle.info), Apache v2.0 License
 
 """
-import networkx as nx
+from collections import OrderedDict
 
 from mindboggle.guts.kernels import rbf_kernel
 
 
+# Graph Laplacians keyed by (mesh hash, kernel, sigma, type of Laplacian),
+# most recently used last (see cached_graph_laplacian):
+_laplacian_cache = OrderedDict()
+
+# Default maximum size of the cache, in bytes:
+LAPLACIAN_CACHE_BYTES = 2**28
+
+
 def diagonal_degree_matrix(W, inverse=False, square_root=False):
     """
     Compute diagonal degree matrix.
@@ -65,10 +73,15 @@ def diagonal_degree_matrix(W, inverse=False, square_root=False):
 
 
 def weight_graph(Nodes, Indices, Meshes, kernel=rbf_kernel, add_to_graph=True,
-                 G=nx.Graph(), sigma=20, verbose=False):
+                 G=None, sigma=20, verbose=False):
     """
     Construct weighted edges of a graph and compute an affinity matrix.
 
+    All edges are scored by a single call to the kernel (which accepts
+    arrays of point pairs), and the affinity matrix is assembled directly
+    in sparse "coordinate" format.  With add_to_graph=False, networkx
+    is not imported at all.
+
     Parameters
     ----------
     Nodes : numpy array
@@ -77,18 +90,18 @@ def weight_graph(Nodes, Indices, Meshes, kernel=rbf_kernel, add_to_graph=True,
     kernel : function which determines weights of edges
         - rbf_kernel: Gaussian kernel, with parameter sigma
         - cotangent_kernel: weight calculation for Laplace_Beltrami_Operator
-          (NOTE: option removed until it can be tested)
+          (sigma is not used)
         - inverse_distance: additional kernel where the weight is the inverse
           of the distance between two nodes
     add_to_graph :  boolean (add to graph?)
-    G :  networkx graph
+    G :  networkx graph (new graph if None)
     sigma :  float (parameter for rbf_kernel)
     verbose : bool
         print statements?
 
     Returns
     -------
-    G :  networkx graph
+    G :  networkx graph (only if add_to_graph)
     affinity_matrix :  numpy array (sparse affinity matrix)
 
     Examples
@@ -109,14 +122,19 @@ def weight_graph(Nodes, Indices, Meshes, kernel=rbf_kernel, add_to_graph=True,
     ...                                   add_to_graph, G, sigma, verbose)
     >>> G.size()
     9
-    >>> G.degree()
-    {0.0: 4, 1.0: 4, 2.0: 3, 3.0: 4, 4.0: 3}
+    >>> dict(G.degree())
+    {0: 4, 1: 4, 2: 3, 3: 4, 4: 3}
+    >>> affinity_matrix.nnz
+    18
+    >>> W = weight_graph(Nodes, Indices, Meshes, kernel, False, None, sigma)
+    >>> (W != affinity_matrix).nnz
+    0
 
     """
     import numpy as np
-    from scipy.sparse import lil_matrix
-    from mindboggle.guts.kernels import rbf_kernel, inverse_distance
-                                        #cotangent_kernel
+    from scipy.sparse import coo_matrix
+    from mindboggle.guts.kernels import rbf_kernel, inverse_distance, \
+        cotangent_kernel
 
     if kernel is rbf_kernel or kernel is inverse_distance:
         if verbose:
@@ -128,47 +146,68 @@ def weight_graph(Nodes, Indices, Meshes, kernel=rbf_kernel, add_to_graph=True,
                       '(sigma={0})'.format(sigma))
 
         # Construct matrix of edge lines by breaking triangle into three edges.
+        Meshes = np.asarray(Meshes)
         if Meshes.shape[1] == 3:
             edge_mat = np.vstack((Meshes.T[0:2].T, Meshes.T[1:3].T, Meshes.T[:3:2].T))
         elif Meshes.shape[1] == 2:
             edge_mat = Meshes
-        # Augment matrix to contain edge weight in the third column
-        weighted_edges = np.asarray([[Indices[np.int(i)], Indices[np.int(j)],
-            kernel(Nodes[np.int(Indices[np.int(i)])],
-                   Nodes[np.int(Indices[np.int(j)])], sigma)]
-                   for [i, j] in edge_mat])
+
+        # Map edge vertices to node indices, and keep one copy of each edge:
+        Indices = np.asarray(Indices)
+        edge_mat = Indices[edge_mat.astype(int)].astype(int)
+        edge_mat = np.unique(np.sort(edge_mat, axis=1), axis=0)
+
+        # Compute all edge weights at once:
+        points = np.asarray(Nodes, dtype=float)
+        if points.ndim == 1:
+            points = points[:, np.newaxis]
+        edge_weights = kernel(points[edge_mat[:, 0]], points[edge_mat[:, 1]],
+                              sigma)
 
         # Add weights to graph
         if add_to_graph:
+            import networkx as nx
+
             if verbose:
                 print('Add weighted edges to the graph')
-            G.add_weighted_edges_from(weighted_edges)
+            if G is None:
+                G = nx.Graph()
+            G.add_weighted_edges_from(zip(edge_mat[:, 0].tolist(),
+                                          edge_mat[:, 1].tolist(),
+                                          edge_weights.tolist()))
 
-        # Construct affinity matrix
+        # Construct symmetric affinity matrix (self-edges only once):
         if verbose:
             print('Construct sparse affinity matrix of size {0}'.
-                format(Nodes.shape[0]))
-        affinity_matrix = lil_matrix((Nodes.shape[0], Nodes.shape[0]))
-        for [i, j, edge_weight] in weighted_edges:
-            affinity_matrix[i, j] = affinity_matrix[j, i] = edge_weight
-
-    # elif kernel is cotangent_kernel:
-    #     if verbose:
-    #         print('Compute weights using cotangents')
-    #     affinity_matrix = cotangent_kernel(Nodes, Meshes)
-    #
-    #     # Add weights to graph
-    #     if add_to_graph:
-    #         edges = np.nonzero(affinity_matrix)
-    #         edge_mat = np.hstack((edges[0].T[:, np.newaxis],
-    #                               edges[1].T[:, np.newaxis]))
-    #         weighted_edges = np.asarray([[edge_mat[i,0],
-    #                                       edge_mat[i,1],
-    #                                       affinity_matrix[edge_mat[i]]]
-    #                                       for i in range(affinity_matrix.shape[0])])
-    #         if verbose:
-    #             print('Add weighted edges to the graph')
-    #         G.add_weighted_edges_from(weighted_edges)
+                format(points.shape[0]))
+        off_diagonal = edge_mat[:, 0] != edge_mat[:, 1]
+        rows = np.hstack((edge_mat[:, 0], edge_mat[off_diagonal, 1]))
+        cols = np.hstack((edge_mat[:, 1], edge_mat[off_diagonal, 0]))
+        data = np.hstack((edge_weights, edge_weights[off_diagonal]))
+        affinity_matrix = coo_matrix((data, (rows, cols)),
+                                     shape=(points.shape[0], points.shape[0]))
+
+    elif kernel is cotangent_kernel:
+        if verbose:
+            print('Compute weights using cotangents')
+        Indices = np.asarray(Indices)
+        points = np.asarray(Nodes, dtype=float)
+        affinity_matrix = cotangent_kernel(points,
+            Indices[np.asarray(Meshes).astype(int)].astype(int))
+
+        # Add weights to graph
+        if add_to_graph:
+            import networkx as nx
+            from scipy.sparse import triu
+
+            if verbose:
+                print('Add weighted edges to the graph')
+            if G is None:
+                G = nx.Graph()
+            upper = triu(affinity_matrix).tocoo()
+            G.add_weighted_edges_from(zip(upper.row.tolist(),
+                                          upper.col.tolist(),
+                                          upper.data.tolist()))
 
     # Return the affinity matrix as a "compressed sparse row" matrix
     # (http://docs.scipy.org/doc/scipy/reference/sparse.html)
@@ -182,6 +221,10 @@ def graph_laplacian(W, type_of_laplacian='norm1', verbose=False):
     """
     Compute normalized and unnormalized graph Laplacians.
 
+    The degrees of W are computed once, and normalization scales the
+    rows and columns of the sparse matrix in place rather than multiplying
+    by diagonal degree matrices.
+
     Parameters
     ----------
     W : N x N sparse matrix in csr format (affinity matrix)
@@ -217,42 +260,59 @@ def graph_laplacian(W, type_of_laplacian='norm1', verbose=False):
     >>> type_of_laplacian = 'norm1'
     >>> verbose = False
     >>> Laplacian = graph_laplacian(W, type_of_laplacian, verbose)
-    >>> print(np.array_str(np.array(Laplacian),
+    >>> print(np.array_str(Laplacian.toarray(),
     ...       precision=5, suppress_small=True))
     [[ 0.66667  0.      -0.29814]
      [ 0.       1.      -0.44721]
      [-0.59628 -0.74536  0.6    ]]
 
     """
+    import numpy as np
+    from scipy.sparse import csr_matrix, diags
+
+    # Same stability term as diagonal_degree_matrix():
+    stability_term = 0.000001
 
-    if type_of_laplacian is 'basic':
+    W = csr_matrix(W, dtype=float)
+    degrees = np.asarray(W.sum(axis=1)).ravel()
+
+    def scale(M, row_scales, col_scales=None):
+        # Multiply each nonzero entry of M by its row (and column) scale:
+        M = M.tocsr()
+        rows = np.repeat(np.arange(M.shape[0]), np.diff(M.indptr))
+        M.data *= row_scales[rows]
+        if col_scales is not None:
+            M.data *= col_scales[M.indices]
+        return M
+
+    if type_of_laplacian == 'basic':
         if verbose:
             print("Calculate unnormalized Laplacian")
-        Laplacian = diagonal_degree_matrix(W) - W
+        Laplacian = (diags(degrees) - W).tocsr()
 
-    elif type_of_laplacian is 'norm1':
+    elif type_of_laplacian == 'norm1':
         if verbose:
             print("Normalize the Laplacian")
-        ddmi_sq = diagonal_degree_matrix(W, inverse=True, square_root=True)
-        Laplacian = ddmi_sq * (diagonal_degree_matrix(W, inverse=False, square_root=False) - W) * ddmi_sq
+        ddmi_sq = np.sqrt(1 / (degrees + stability_term))
+        Laplacian = scale(diags(degrees) - W, ddmi_sq, ddmi_sq)
 
-    elif type_of_laplacian is 'norm2':
+    elif type_of_laplacian == 'norm2':
         if verbose:
             print("Normalize the Laplacian")
-        ddmi_sq = diagonal_degree_matrix(W, inverse=True, square_root=True)
-        Laplacian = ddmi_sq * W * ddmi_sq
+        ddmi_sq = np.sqrt(1 / (degrees + stability_term))
+        Laplacian = scale(W.copy(), ddmi_sq, ddmi_sq)
 
-    elif type_of_laplacian is 'norm3':
+    elif type_of_laplacian == 'norm3':
         if verbose:
             print("Normalize the Laplacian")
-        ddmi = diagonal_degree_matrix(W, inverse=True, square_root=False)
-        Laplacian = ddmi * (diagonal_degree_matrix(W, inverse=False, square_root=False) - W)
+        ddmi = 1 / (degrees + stability_term)
+        Laplacian = scale(diags(degrees) - W, ddmi)
 
-    elif type_of_laplacian is 'random_walk':
+    elif type_of_laplacian == 'random_walk':
         if verbose:
             print("Compute Random Walk Laplacian")
-        ddmi = diagonal_degree_matrix(W, inverse=True, square_root=False)
-        Laplacian = ddmi * W
+        ddmi = 1 / (degrees + stability_term)
+        Laplacian = scale(W.copy(), ddmi)
 
     else:
         if verbose:
@@ -262,6 +322,91 @@ def graph_laplacian(W, type_of_laplacian='norm1', verbose=False):
     return Laplacian
 
 
+def cached_graph_laplacian(Nodes, Indices, Meshes, kernel=rbf_kernel,
+                           sigma=20, type_of_laplacian='norm1',
+                           max_bytes=None, verbose=False):
+    """
+    Compute (or reuse) the graph Laplacian of a weighted mesh.
+
+    Repeated propagations over the same fold or region rebuild the
+    same operator, so assembled Laplacians are kept in an in-process cache
+    keyed by a hash of the mesh (Nodes, Indices, Meshes), the kernel,
+    sigma and the type of Laplacian.  The least recently used operators
+    are dropped when the cache exceeds max_bytes, and a copy of the
+    cached operator is returned so that callers may modify it.
+
+    Parameters
+    ----------
+    Nodes : numpy array
+    Indices : list of integers
+    Meshes : numpy array
+    kernel : function which determines weights of edges (see weight_graph)
+    sigma :  float (parameter for rbf_kernel)
+    type_of_laplacian : string (see graph_laplacian)
+    max_bytes : integer (or None)
+        maximum size of the cache (None: LAPLACIAN_CACHE_BYTES)
+    verbose : bool
+        print statements?
+
+    Returns
+    -------
+    Laplacian : N x N sparse matrix in csr format
+               (Graph Laplacian of affinity matrix)
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> from mindboggle.guts.kernels import rbf_kernel
+    >>> from mindboggle.guts.graph import cached_graph_laplacian
+    >>> Nodes = np.array([[0,0,0], [1,0,0], [0,1,0], [0,0,1], [1,1,1]])
+    >>> Indices = [0,1,2,3,4]
+    >>> Meshes = np.array([[1,2,3],[0,1,2],[0,1,3],[0,1,4],[0,2,3],[0,3,4]])
+    >>> L1 = cached_graph_laplacian(Nodes, Indices, Meshes, rbf_kernel, 20,
+    ...                             'random_walk')
+    >>> L2 = cached_graph_laplacian(Nodes, Indices, Meshes, rbf_kernel, 20,
+    ...                             'random_walk')
+    >>> L1 is L2, (L1 != L2).nnz
+    (False, 0)
+    >>> print('{0:0.5f}'.format(L1.sum(axis=1).max()))
+    1.00000
+
+    """
+    import hashlib
+    import numpy as np
+    from scipy.sparse import issparse
+
+    if max_bytes is None:
+        max_bytes = LAPLACIAN_CACHE_BYTES
+
+    nbytes = lambda A: A.data.nbytes + A.indices.nbytes + A.indptr.nbytes
+
+    mesh_hash = hashlib.sha1()
+    for array in (Nodes, Indices, Meshes):
+        array = np.ascontiguousarray(array)
+        mesh_hash.update(str((array.dtype, array.shape)).encode())
+        mesh_hash.update(array.tobytes())
+    key = (mesh_hash.hexdigest(), kernel, sigma, type_of_laplacian)
+
+    if key in _laplacian_cache:
+        if verbose:
+            print('Reuse cached graph Laplacian')
+        _laplacian_cache.move_to_end(key)
+        return _laplacian_cache[key].copy()
+
+    W = weight_graph(Nodes, Indices, Meshes, kernel=kernel,
+                     add_to_graph=False, sigma=sigma, verbose=verbose)
+    Laplacian = graph_laplacian(W, type_of_laplacian, verbose)
+
+    if not issparse(Laplacian) or nbytes(Laplacian) > max_bytes:
+        return Laplacian
+
+    _laplacian_cache[key] = Laplacian
+    while sum(nbytes(x) for x in _laplacian_cache.values()) > max_bytes:
+        _laplacian_cache.popitem(last=False)
+
+    return Laplacian.copy()
+
+
 # ============================================================================
 # Doctests
 # ============================================================================
@@ -13,17 +13,20 @@ Copyright 2016,  Mindboggle team (http://mindboggle.info), Apache v2.0 License
 
 def rbf_kernel(x1, x2, sigma):
     """
-    Compute normalized and unnormalized graph Laplacians.
+    Compute Gaussian (radial basis function) weights.
+
+    The last axis holds coordinates, so arrays of E pairs of points
+    (each E x N) are scored at once, returning E weights.
 
     Parameters
     ----------
-    x1 : Nx1 numpy array
-    x2 : Nx1 numpy array
+    x1 : numpy array of N floats (or E x N array)
+    x2 : numpy array of N floats (or E x N array)
     sigma : float
 
     Returns
     -------
-    rbf : float
+    rbf : float (or numpy array of E floats)
 
     Examples
     --------
@@ -35,61 +38,88 @@ def rbf_kernel(x1, x2, sigma):
     >>> rbf = rbf_kernel(x1, x2, sigma)
     >>> print('{0:0.5f}'.format(rbf))
     0.96079
+    >>> x1 = np.array([[0,0,0], [0,0,0]])
+    >>> x2 = np.array([[0,0,0], [1,1,1]])
+    >>> rbf = rbf_kernel(x1, x2, 1)
+    >>> print(['{0:0.5f}'.format(x) for x in rbf])
+    ['1.00000', '0.22313']
 
     """
     import numpy as np
 
-    return np.exp(-np.linalg.norm(x1 - x2) ** 2 / (2 * sigma ** 2))
-
-
-# def cotangent_kernel(Nodes, Meshes):
-#     """
-#     This function constructs weighted edges of a graph.
-#
-#     Parameters
-#     ----------
-#     Nodes : numpy array
-#     Meshes : numpy array
-#
-#     Returns
-#     -------
-#     W : N x N matrix
-#         weight matrix
-#
-#     Examples
-#     --------
-#     >>> import numpy as np
-#     >>> from mindboggle.guts.kernels import cotangent_kernel
-#     >>> Nodes = np.array([0,1,2,3,4])
-#     >>> Meshes = np.array([[1,2,3],[0,1,2],[0,1,3],[0,1,4],[0,2,3],[0,3,4]])
-#     >>> cotangent_kernel(Nodes, Meshes)
-#     ValueError: 'axisa' out of bounds
-#
-#     """
-#     import numpy as np
-#     from scipy.sparse import lil_matrix
-#
-#     num_nodes = Nodes.shape[0]
-#     W = lil_matrix((num_nodes, num_nodes))
-#     #print('Constructing sparse affinity matrix...')
-#     for c in Meshes:
-#         # Obtain vertices which comprise face
-#         v0, v1, v2 = Nodes[c[0]], Nodes[c[1]], Nodes[c[2]]
-#
-#         # Obtain cotangents of angles
-#         cot0 = np.dot(v1-v0, v2-v0) / np.linalg.norm(np.cross(v1-v0, v2-v0))
-#         cot1 = np.dot(v2-v1, v0-v1) / np.linalg.norm(np.cross(v2-v1, v0-v1))
-#         cot2 = np.dot(v0-v2, v1-v2) / np.linalg.norm(np.cross(v0-v2, v1-v2))
-#
-#         # Update weight matrix accordingly
-#         W[c[1], c[2]] += cot0
-#         W[c[2], c[1]] += cot0
-#         W[c[0], c[2]] += cot1
-#         W[c[2], c[0]] += cot1
-#         W[c[0], c[1]] += cot2
-#         W[c[1], c[0]] += cot2
-#
-#     return W
+    d = np.asarray(x1, dtype=float) - np.asarray(x2, dtype=float)
+
+    return np.exp(-(d ** 2).sum(axis=-1) / (2 * sigma ** 2))
+
+
+def cotangent_kernel(Nodes, Meshes):
+    """
+    This function constructs weighted edges of a graph from cotangents.
+
+    The cotangent of the angle at each corner of each triangle is computed
+    for all faces at once and added to the weight of the edge opposite
+    that corner (as used by the Laplace-Beltrami operator).
+
+    Parameters
+    ----------
+    Nodes : numpy array
+        coordinates of N nodes (N x 3)
+    Meshes : numpy array
+        indices to three nodes per triangle
+
+    Returns
+    -------
+    W : N x N sparse matrix in csr format
+        weight matrix
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> from mindboggle.guts.kernels import cotangent_kernel
+    >>> Nodes = np.array([[0,0,0], [1,0,0], [0,1,0], [0,0,1]])
+    >>> Meshes = np.array([[0,1,2], [0,1,3], [0,2,3], [1,2,3]])
+    >>> W = cotangent_kernel(Nodes, Meshes)
+    >>> W.nnz
+    12
+    >>> print('{0:0.5f} {1:0.5f}'.format(W[0, 1], W[1, 2]))
+    2.00000 0.57735
+
+    """
+    import numpy as np
+    from scipy.sparse import coo_matrix
+
+    Nodes = np.asarray(Nodes, dtype=float)
+    Meshes = np.asarray(Meshes, dtype=int)
+    num_nodes = Nodes.shape[0]
+
+    # Obtain vertices which comprise each face:
+    v0 = Nodes[Meshes[:, 0]]
+    v1 = Nodes[Meshes[:, 1]]
+    v2 = Nodes[Meshes[:, 2]]
+
+    # Obtain cotangents of angles (zero for degenerate faces):
+    def cotangent(a, b):
+        dots = (a * b).sum(axis=1)
+        norms = np.sqrt((np.cross(a, b) ** 2).sum(axis=1))
+        cots = np.zeros(len(dots))
+        nonzero = norms > 0
+        cots[nonzero] = dots[nonzero] / norms[nonzero]
+        return cots
+
+    cot0 = cotangent(v1 - v0, v2 - v0)
+    cot1 = cotangent(v2 - v1, v0 - v1)
+    cot2 = cotangent(v0 - v2, v1 - v2)
+
+    # Add each cotangent to both directions of the opposite edge
+    # (duplicate entries are summed when converting to csr format):
+    rows = np.hstack((Meshes[:, 1], Meshes[:, 2], Meshes[:, 0],
+                      Meshes[:, 2], Meshes[:, 0], Meshes[:, 1]))
+    cols = np.hstack((Meshes[:, 2], Meshes[:, 1], Meshes[:, 2],
+                      Meshes[:, 0], Meshes[:, 1], Meshes[:, 0]))
+    data = np.hstack((cot0, cot0, cot1, cot1, cot2, cot2))
+    W = coo_matrix((data, (rows, cols)), shape=(num_nodes, num_nodes))
+
+    return W.tocsr()
 
 
 def inverse_distance(x1, x2, epsilon):
@@ -97,15 +127,18 @@ def inverse_distance(x1, x2, epsilon):
     This function constructs weighted edges of a graph,
     where the weight is the inverse of the distance between two nodes.
 
+    As with rbf_kernel, arrays of E pairs of points (each E x N)
+    are scored at once.
+
     Parameters
     ----------
-    x1 : Nx1 numpy array
-    x2 : Nx1 numpy array
+    x1 : numpy array of N floats (or E x N array)
+    x2 : numpy array of N floats (or E x N array)
     epsilon : float
 
     Returns
     -------
-    d : float
+    d : float (or numpy array of E floats)
 
     Examples
     --------
@@ -117,11 +150,18 @@ def inverse_distance(x1, x2, epsilon):
     >>> d = inverse_distance(x1, x2, epsilon)
     >>> print('{0:0.5f}'.format(d))
     5.22408
+    >>> x1 = np.array([[0,0,0], [0,0,0]])
+    >>> x2 = np.array([[0,0,0], [0,3,4]])
+    >>> d = inverse_distance(x1, x2, 0.05)
+    >>> print(['{0:0.5f}'.format(x) for x in d])
+    ['20.00000', '0.19802']
 
     """
     import numpy as np
 
-    return 1.0/(np.linalg.norm(x1 - x2) + epsilon)
+    d = np.asarray(x1, dtype=float) - np.asarray(x2, dtype=float)
+
+    return 1.0/(np.sqrt((d ** 2).sum(axis=-1)) + epsilon)
 
 
 # ============================================================================
@@ -240,6 +240,144 @@ def find_neighborhood(neighbor_lists, indices, nedges=1):
     return neighborhood
 
 
+def extract_submesh(indices, neighbor_lists, nrings=1):
+    """
+    Extract the neighbors of a mesh region (with rings of vertices around it).
+
+    The submesh consists of the given vertices and of the vertices within
+    nrings edges of them.  Submesh vertices are numbered in the order of their
+    mesh indices, and neighbor lists only contain submesh vertices, so that
+    they are complete for all but the outermost ring (or, if nrings is 0, for
+    the vertices whose neighbors are all in indices).  Algorithms that only
+    look nrings - 1 edges beyond a region, such as those run per fold,
+    can then run on arrays proportional to the size of the region
+    rather than of the whole mesh.
+
+    Parameters
+    ----------
+    indices : list of integers
+        indices of surface mesh vertices (such as a fold)
+    neighbor_lists : list of lists of integers
+        each list contains indices to neighboring vertices for each vertex
+    nrings : integer
+        number of rings of vertices around indices to include
+
+    Returns
+    -------
+    local_to_global : numpy array of integers
+        mesh index for each (sorted) submesh vertex
+    global_to_local : dictionary
+        submesh index for the mesh index of each submesh vertex
+    local_neighbor_lists : list of lists of integers
+        submesh indices to neighboring submesh vertices for each submesh vertex
+    indptr : numpy array of integers
+        local_neighbor_lists in compressed sparse row (CSR) form:
+        neighbors of submesh vertex i are adjacency[indptr[i]:indptr[i+1]]
+    adjacency : numpy array of integers
+        concatenated local_neighbor_lists
+
+    Examples
+    --------
+    >>> from mindboggle.guts.mesh import extract_submesh
+    >>> neighbor_lists = [[1],[0,2],[1,3],[2,4],[3]]
+    >>> submesh = extract_submesh([3,2], neighbor_lists, 1)
+    >>> local_to_global, global_to_local, local_neighbor_lists = submesh[0:3]
+    >>> indptr, adjacency = submesh[3:5]
+    >>> local_to_global.tolist()
+    [1, 2, 3, 4]
+    >>> local_neighbor_lists
+    [[1], [0, 2], [1, 3], [2]]
+    >>> indptr.tolist(), adjacency.tolist()
+    ([0, 1, 3, 5, 6], [1, 0, 2, 1, 3, 2])
+
+    """
+    import numpy as np
+
+    # Gather the vertices within nrings edges of the indices:
+    ball = set(int(x) for x in indices)
+    seed_list = list(ball)
+    for iring in range(nrings):
+        local_neighbors = set()
+        for x in seed_list:
+            local_neighbors.update(neighbor_lists[x])
+        seed_list = list(local_neighbors.difference(ball))
+        if not seed_list:
+            break
+        ball.update(seed_list)
+
+    # Renumber the vertices and their neighbors:
+    local_to_global = np.array(sorted(ball), dtype=int)
+    global_to_local = dict(zip(local_to_global.tolist(),
+                               range(len(local_to_global))))
+    local_neighbor_lists = [[global_to_local[y] for y in neighbor_lists[x]
+                             if y in global_to_local]
+                            for x in local_to_global]
+    sizes = [len(x) for x in local_neighbor_lists]
+    indptr = np.concatenate(([0], np.cumsum(sizes))).astype(int)
+    adjacency = np.array([y for x in local_neighbor_lists for y in x],
+                         dtype=int)
+
+    return local_to_global, global_to_local, local_neighbor_lists, \
+        indptr, adjacency
+
+
+def find_hop_distances(neighbor_lists, indices, nedges=1):
+    """
+    Find the number of edges between each pair of given mesh vertices.
+
+    The vertices within nedges edges of the given vertices (which contain
+    every path of up to nedges edges between them) are gathered with
+    extract_submesh(), and shortest paths are computed only within this
+    submesh.
+
+    Parameters
+    ----------
+    neighbor_lists : list of lists of integers
+        each list contains indices to neighboring vertices for each vertex
+    indices : list of integers
+        indices of surface vertices
+    nedges : integer
+        maximum number of edges to propagate from indices
+
+    Returns
+    -------
+    distances : numpy array of floats
+        number of edges from each vertex in indices (rows) to each vertex
+        in indices (columns); inf if more than nedges edges apart
+
+    Examples
+    --------
+    >>> from mindboggle.guts.mesh import find_hop_distances
+    >>> neighbor_lists = [[1],[0,2],[1,3],[2,4],[3]]
+    >>> distances = find_hop_distances(neighbor_lists, [0,2,4], 2)
+    >>> distances.tolist()
+    [[0.0, 2.0, inf], [2.0, 0.0, 2.0], [inf, 2.0, 0.0]]
+
+    """
+    import numpy as np
+    from scipy.sparse import csr_matrix
+    from scipy.sparse.csgraph import dijkstra
+
+    from mindboggle.guts.mesh import extract_submesh
+
+    indices = [int(x) for x in indices]
+    if not indices:
+        return np.zeros((0, 0))
+
+    # Build a sparse adjacency matrix for the neighborhood:
+    local_to_global, global_to_local, local_neighbor_lists, indptr, \
+        adjacency = extract_submesh(indices, neighbor_lists, nedges)
+    A = csr_matrix((np.ones(len(adjacency)), adjacency, indptr),
+                   shape=(len(local_to_global), len(local_to_global)))
+
+    # Compute the number of edges between the indices:
+    I = [global_to_local[x] for x in indices]
+    distances = dijkstra(A, directed=True, indices=I, unweighted=True,
+                         limit=nedges)
+
+    return distances[:, I]
+
+
 def find_endpoints(indices, neighbor_lists):
     """
     Extract endpoints from connected set of vertices.
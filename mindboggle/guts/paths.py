@@ -14,13 +14,18 @@ Copyright 2016,  Mindboggle team (http://mindboggle.info), Apache v2.0 License
 def connect_points_erosion(S, neighbor_lists, outer_anchors, inner_anchors=[],
                            values=[], erode_ratio=0.1, erode_min_size=10,
                            save_steps=[], save_vtk='', background_value=-1,
-                           verbose=False):
+                           verbose=False, frontier=False):
     """
     Connect mesh vertices with a skeleton of 1-vertex-thick curves by erosion.
 
     This algorithm iteratively removes simple topological points and endpoints,
     optionally in order of lowest to highest values.
 
+    With frontier=True, connect_points_frontier() erodes the region
+    from a priority queue of edge vertices instead of re-extracting
+    and re-segmenting the region's edge at every iteration
+    (erode_ratio, erode_min_size and save_steps are then not used).
+
     Parameters
     ----------
     S : numpy array of integers
@@ -46,6 +51,8 @@ def connect_points_erosion(S, neighbor_lists, outer_anchors, inner_anchors=[],
         background value
     verbose : bool
         print statements?
+    frontier : bool
+        erode with connect_points_frontier()?
 
     Returns
     -------
@@ -123,7 +130,12 @@ def connect_points_erosion(S, neighbor_lists, outer_anchors, inner_anchors=[],
     import numpy as np
 
     from mindboggle.guts.mesh import topo_test, extract_edge, find_endpoints
-    from mindboggle.guts.segment import segment_regions
+    from mindboggle.guts.segment import segment_region_lists
+
+    if frontier:
+        return connect_points_frontier(S, neighbor_lists, outer_anchors,
+                                       inner_anchors, values,
+                                       background_value, verbose)
 
     # Make sure arguments are numpy arrays:
     if not isinstance(S, np.ndarray):
@@ -142,6 +154,10 @@ def connect_points_erosion(S, neighbor_lists, outer_anchors, inner_anchors=[],
         from mindboggle.mio.vtks import rewrite_scalars
         S0 = S.copy()
 
+    # Vertices of the region, in mesh order (the region only loses vertices,
+    # so that each iteration only needs to look at these):
+    region = np.nonzero(S != background_value)[0]
+
     # ------------------------------------------------------------------------
     # Iteratively remove simple points:
     # ------------------------------------------------------------------------
@@ -160,7 +176,8 @@ def connect_points_erosion(S, neighbor_lists, outer_anchors, inner_anchors=[],
         # Only consider updating vertices that are on the edge of the
         # region and are not among the indices to keep or known simple points:
         # --------------------------------------------------------------------
-        indices = np.where(S != background_value)[0].tolist()
+        region = region[S[region] != background_value]
+        indices = region.tolist()
         edge = extract_edge(indices, neighbor_lists)
         if edge:
             edge = np.array(list(set(edge).difference(complex)))
@@ -168,24 +185,23 @@ def connect_points_erosion(S, neighbor_lists, outer_anchors, inner_anchors=[],
             if len_edge:
 
                 # ------------------------------------------------------------
-                # Segment edge vertices into separate connected groups:
+                # Segment edge vertices into separate connected groups
+                # (in order of segment number, each in mesh order):
                 # ------------------------------------------------------------
-                edge_segs = segment_regions(edge, neighbor_lists, 1, [],
-                                            False, False, [], [], [], '',
-                                            background_value, verbose)
-
-                edge_seg_numbers = [x for x in np.unique(edge_segs)
-                                    if x != background_value]
+                edge_seg_lists, edge_seg_numbers = segment_region_lists(edge,
+                    neighbor_lists, 1, [], False, False, [], [], [], '',
+                    False)
+                edge_segs = [np.sort(x) for i, x in enumerate(edge_seg_lists)
+                             if edge_seg_numbers[i] != background_value]
                 if verbose:
-                    len_numbers = len(edge_seg_numbers)
+                    len_numbers = len(edge_segs)
                     if len_numbers > 1:
                         print('    {0}: {1} edge points in {2} segments'.
                               format(count, len_edge, len_numbers))
                     else:
                         print('    {0}: {1} edge points'.format(count, len_edge))
                 first_seg = True
-                for edge_seg_number in edge_seg_numbers:
-                    edge_seg = np.where(edge_segs == edge_seg_number)[0]
+                for edge_seg in edge_segs:
                     edge_seg = np.array(list(set(edge_seg).difference(keep)))
                     len_edge_seg = np.shape(edge_seg)[0]
                     if len_edge_seg:
@@ -243,7 +259,8 @@ def connect_points_erosion(S, neighbor_lists, outer_anchors, inner_anchors=[],
                 # Remove branches by iteratively removing endpoints:
                 # ------------------------------------------------------------
                 if remove_endpoints:
-                    indices = np.where(S != background_value)[0].tolist()
+                    region = region[S[region] != background_value]
+                    indices = region.tolist()
                     endpts = True
                     while endpts:
                         endpts = find_endpoints(indices, neighbor_lists)
@@ -258,9 +275,157 @@ def connect_points_erosion(S, neighbor_lists, outer_anchors, inner_anchors=[],
     return skeleton
 
 
+def connect_points_frontier(S, neighbor_lists, outer_anchors,
+                            inner_anchors=[], values=[], background_value=-1,
+                            verbose=False):
+    """
+    Connect mesh vertices with a skeleton of 1-vertex-thick curves by
+    eroding from a priority queue of edge vertices.
+
+    Like connect_points_erosion(), this algorithm removes simple topological
+    points and then endpoints, in order of lowest to highest values,
+    until neither remain.  Rather than scanning the whole mesh for the
+    region's edge at every iteration, the edge vertices are kept in a heap
+    keyed by value, and only the neighbors of removed vertices are added to
+    it, so that a region is thinned in O(region size * log(region size)).
+    Vertices found not to be simple points (complex) and vertices to keep
+    are stored as boolean masks.
+
+    Parameters
+    ----------
+    S : numpy array of integers
+        values for all vertices (disregard background values)
+    neighbor_lists : list of lists of integers
+        each list contains indices to neighboring vertices for each vertex
+    outer_anchors : list of integers
+        indices of vertices to connect
+    inner_anchors : list of integers
+        more vertices to connect; they are removed if they result in endpoints
+    values : numpy array of floats
+        values for S elements, to remove points
+        in order of lowest to highest values
+    background_value : integer or float
+        background value
+    verbose : bool
+        print statements?
+
+    Returns
+    -------
+    skeleton : list of integers
+        indices to vertices of skeleton
+
+    Examples
+    --------
+    >>> # Connect two anchors through a 5-vertex-wide band:
+    >>> import numpy as np
+    >>> from mindboggle.guts.mesh import find_neighbors
+    >>> from mindboggle.guts.paths import connect_points_frontier
+    >>> nx, ny = 12, 7
+    >>> faces = [[y*nx+x, y*nx+x+1, (y+1)*nx+x] for y in range(ny-1)
+    ...          for x in range(nx-1)]
+    >>> faces += [[y*nx+x+1, (y+1)*nx+x+1, (y+1)*nx+x] for y in range(ny-1)
+    ...           for x in range(nx-1)]
+    >>> neighbor_lists = find_neighbors(faces, nx * ny)
+    >>> S = -1 * np.ones(nx * ny)
+    >>> S[[y*nx+x for y in range(1, ny-1) for x in range(1, nx-1)]] = 1
+    >>> values = np.array([abs(y - 3) for y in range(ny) for x in range(nx)])
+    >>> skeleton = connect_points_frontier(S, neighbor_lists, [37, 46], [],
+    ...                                    -values)
+    >>> skeleton
+    [37, 38, 39, 40, 41, 42, 43, 44, 45, 46]
+
+    """
+    import heapq
+    import numpy as np
+
+    from mindboggle.guts.mesh import topo_test
+
+    # Make sure arguments are numpy arrays:
+    if not isinstance(S, np.ndarray):
+        S = np.array(S)
+    npoints = len(S)
+    if len(values):
+        values = np.asarray(values)
+    else:
+        values = np.zeros(npoints)
+
+    inside = S != background_value
+    keep = np.zeros(npoints, dtype=bool)
+    keep[list(outer_anchors) + list(inner_anchors)] = True
+    outer = np.zeros(npoints, dtype=bool)
+    outer[list(outer_anchors)] = True
+    complex = np.zeros(npoints, dtype=bool)
+    queued = np.zeros(npoints, dtype=bool)
+
+    def on_edge(index):
+        return not all(inside[neighbor_lists[index]])
+
+    def push(heap, index):
+        if inside[index] and not (keep[index] or complex[index] or
+                                  queued[index]) and on_edge(index):
+            heapq.heappush(heap, (values[index], index))
+            queued[index] = True
+
+    # Initialize the heap with the region's edge vertices:
+    heap = []
+    for index in np.nonzero(inside)[0]:
+        push(heap, index)
+
+    nremoved = 0
+    candidates = []
+    while heap or candidates:
+
+        # --------------------------------------------------------------------
+        # Remove topologically simple points in order of lowest to highest
+        # values, adding each removed vertex's neighbors to the heap:
+        # --------------------------------------------------------------------
+        while heap:
+            value, index = heapq.heappop(heap)
+            queued[index] = False
+            simple, d = topo_test(index, S, neighbor_lists)
+            if simple:
+                S[index] = background_value
+                inside[index] = False
+                nremoved += 1
+                candidates.extend(neighbor_lists[index])
+                for neighbor in neighbor_lists[index]:
+                    push(heap, neighbor)
+            # Else store to exclude in future:
+            else:
+                complex[index] = True
+
+        # --------------------------------------------------------------------
+        # Remove branches by iteratively removing endpoints (starting
+        # from the neighbors of removed vertices):
+        # --------------------------------------------------------------------
+        while candidates:
+            candidates = np.unique(candidates)
+            endpts = [x for x in candidates if inside[x] and not outer[x] and
+                      inside[neighbor_lists[x]].sum() == 1]
+            candidates = []
+            if endpts:
+                S[endpts] = background_value
+                inside[endpts] = False
+                nremoved += len(endpts)
+                for endpt in endpts:
+                    candidates.extend(neighbor_lists[endpt])
+                for neighbor in set(candidates):
+                    push(heap, neighbor)
+            else:
+                break
+
+    skeleton = np.nonzero(inside)[0].tolist()
+    if verbose:
+        print('  Removed {0} vertices to leave a skeleton of {1} vertices'.
+              format(nremoved, len(skeleton)))
+
+    return skeleton
+
+
 def connect_points_hmmf(indices_points, indices, L, neighbor_lists,
                         wN_max=1.0, do_erode=True, background_value=-1,
-                        verbose=False):
+                        verbose=False, min_count=50, max_count=300,
+                        return_telemetry=False):
     """
     Connect mesh vertices with a skeleton of 1-vertex-thick curves using HMMF.
 
@@ -301,11 +466,22 @@ def connect_points_hmmf(indices_points, indices, L, neighbor_lists,
         background value
     verbose : bool
         print statements?
+    min_count : integer
+        minimum number of iterations (to overcome initial increasing costs)
+    max_count : integer
+        maximum number of iterations (in case no convergence)
+    return_telemetry : bool
+        also return per-iteration costs?
 
     Returns
     -------
     skeleton : list of integers
         indices to vertices connecting the points
+    telemetry : dictionary of lists (if return_telemetry)
+        for each iteration: 'cost' (sum of costs), 'delta_cost'
+        (mean decrease in cost), 'delta_points' (decrease in the number of
+        vertices above threshold), 'topo_tests' (number of topology tests),
+        'wN' and 'gradient_factor' (None for the first deltas)
 
     Examples
     --------
@@ -365,9 +541,96 @@ def connect_points_hmmf(indices_points, indices, L, neighbor_lists,
     ...                 folds, 'skeleton', folds, -1) # doctest: +SKIP
     >>> plot_surfaces('connect_points_hmmf.vtk') # doctest: +SKIP
 
+    """
+    from mindboggle.guts.paths import connect_points_hmmf_batch
+
+    skeletons, telemetries = connect_points_hmmf_batch([indices_points],
+        [indices], L, neighbor_lists, wN_max, do_erode, background_value,
+        verbose, min_count, max_count, mask_likelihoods=False,
+        return_telemetry=True)
+
+    if return_telemetry:
+        return skeletons[0], telemetries[0]
+    else:
+        return skeletons[0]
+
+
+def connect_points_hmmf_batch(indices_points_list, indices_list, L,
+                              neighbor_lists, wN_max=1.0, do_erode=True,
+                              background_value=-1, verbose=False,
+                              min_count=50, max_count=300,
+                              mask_likelihoods=True, return_telemetry=False):
+    """
+    Connect mesh vertices with skeletons using HMMF, for several sets at once.
+
+    This runs connect_points_hmmf() for each set of vertices (such as the
+    dilated skeleton segments of all folds) in one vectorized HMMF over the
+    union of their submeshes.  Each set has its own copy of its vertices,
+    costs and termination, so sets do not influence each other and each
+    skeleton is the same as connect_points_hmmf() would return for the set.
+    Topology tests are batched across sets.
+
+    Parameters
+    ----------
+    indices_points_list : list of lists of integers
+        indices of vertices to connect, for each set
+    indices_list : list of lists of integers
+        indices of vertices through which to connect points, for each set
+    L : numpy array of floats
+        likelihood values for all vertices in mesh
+    neighbor_lists : list of lists of integers
+        indices to neighboring vertices for each vertex in mesh
+    wN_max : float
+        maximum neighborhood weight (trust prior more for smoother fundi)
+    do_erode : bool
+        erode to create skeleton?
+    background_value : integer
+        background value
+    verbose : bool
+        print statements?
+    min_count : integer
+        minimum number of iterations (to overcome initial increasing costs)
+    max_count : integer
+        maximum number of iterations (in case no convergence)
+    mask_likelihoods : bool
+        use likelihood values only at each set's indices, and
+        background_value elsewhere (as smooth_skeletons() sets them up)?
+    return_telemetry : bool
+        also return per-iteration costs for each set?
+
+    Returns
+    -------
+    skeletons : list of lists of integers
+        indices to vertices connecting the points, for each set
+    telemetries : list of dictionaries of lists (if return_telemetry)
+        per-iteration costs for each set (see connect_points_hmmf())
+
+    Examples
+    --------
+    >>> # Two sets of vertices on a grid, each with a ridge of high
+    >>> # likelihood values between two anchor points:
+    >>> import numpy as np
+    >>> from mindboggle.guts.paths import connect_points_hmmf_batch
+    >>> n = 20
+    >>> neighbor_lists = [[j*n + i for j, i in
+    ...                    [(r-1, c), (r+1, c), (r, c-1), (r, c+1),
+    ...                     (r-1, c-1), (r+1, c+1)]
+    ...                    if 0 <= j < n and 0 <= i < n]
+    ...                   for r in range(n) for c in range(n)]
+    >>> L = np.zeros(n * n)
+    >>> L[[5*n + c for c in range(2, 18)]] = 0.9
+    >>> L[[14*n + c for c in range(2, 18)]] = 0.9
+    >>> indices_list = [[r*n + c for r in range(3, 8) for c in range(1, 19)],
+    ...                 [r*n + c for r in range(12, 17) for c in range(1, 19)]]
+    >>> indices_points_list = [[5*n + 2, 5*n + 17], [14*n + 2, 14*n + 17]]
+    >>> skeletons = connect_points_hmmf_batch(indices_points_list,
+    ...     indices_list, L, neighbor_lists, do_erode=False)
+    >>> [len(x) for x in skeletons]
+    [16, 16]
+
     """
     import numpy as np
-    from mindboggle.guts.mesh import topo_test
+    from mindboggle.guts.mesh import topo_test, extract_submesh
     from mindboggle.guts.paths import connect_points_erosion
 
     # Make sure argument is a numpy array
@@ -389,14 +652,12 @@ def connect_points_hmmf(indices_points, indices, L, neighbor_lists,
     rate_factor = 0.9
     min_cost_change = 0.0001  # minimum change in the sum of costs
     n_tries_no_change = 3  # number of loops without sufficient change
-    min_count = 50  # min. iterations (to overcome initial increasing costs)
-    max_count = 300  # maximum number of iterations (in case no convergence)
 
     # Miscellaneous parameters:
     print_interval = 10
 
-    def compute_costs(likelihoods, hmmfs, hmmfs_neighbors, numbers_of_neighbors,
-                      wN, Z=[]):
+    def compute_costs(likelihoods, hmmfs, hmmfs_neighbors, rows,
+                      numbers_of_neighbors, wN):
         """
         Cost function for penalizing unlikely fundus curve vertices.
 
@@ -420,13 +681,13 @@ def connect_points_hmmf(indices_points, indices, L, neighbor_lists,
         hmmf : numpy array of floats
             HMMF values
         hmmf_neighbors : numpy array of floats
-            HMMF values of neighboring vertices for each vertex
+            HMMF values of the (CSR-ordered) neighbors of all vertices
+        rows : numpy array of integers
+            vertex (row) for each element of hmmf_neighbors
         numbers_of_neighbors : numpy array of integers
             number of neighbors for each vertex
         wN : float
             weight influence of neighbors on cost (term 2)
-        Z : numpy array of integers in {0,1} (same shape as hmmf_neighbors)
-            to remove zero-padded neighborhood elements after hmmf subtraction
 
         Returns
         -------
@@ -438,125 +699,186 @@ def connect_points_hmmf(indices_points, indices, L, neighbor_lists,
 
         if all(numbers_of_neighbors):
 
-            # Subtract each HMMF value from its neighbors:
-            diff = abs(hmmfs - hmmfs_neighbors)
-
-            # Since the above neighbors may have been padded,
-            # remove the extra differences by multiplying them times zero:
-            diff = diff * Z
+            # Subtract each HMMF value from its neighbors,
+            # and sum the differences for each vertex:
+            diff = np.abs(hmmfs[rows] - hmmfs_neighbors)
+            diff = np.bincount(rows, weights=diff, minlength=len(hmmfs))
 
             # Compute the cost for each vertex:
             costs = hmmfs * (1.1 - likelihoods) + \
-                    wN * np.sum(diff, axis=0) / numbers_of_neighbors
+                    wN * diff / numbers_of_neighbors
         else:
             raise IOError('No HMMF neighbors to compute cost.')
 
         return costs
 
+    # ------------------------------------------------------------------------
+    # Restrict arrays to the submesh of the vertices through which to connect
+    # points and the two rings of vertices around them that topo_test()
+    # looks at.  The submeshes of all sets are stacked, each with its own
+    # copy of its vertices, so that sets do not interact.  The vertices
+    # through which to connect points (in their input order, set by set)
+    # are the stacked submesh vertices in fold, with their neighbors stored
+    # in CSR form (local_neighbors[indptr[i]:indptr[i+1]] for vertex fold[i]):
+    # ------------------------------------------------------------------------
+    N = neighbor_lists
+    nsets = len(indices_list)
+    indices_list = [np.asarray(x, dtype=int) for x in indices_list]
+    locals_list = []
+    fold_list = []
+    anchors = []
+    N_local = []
+    L_local = []
+    offset = 0
+    for indices_points, indices in zip(indices_points_list, indices_list):
+        local, global_to_local, N_set, foo1, foo2 = \
+            extract_submesh(indices, N, 2)
+        fold_set = np.array([global_to_local[x] for x in indices], dtype=int)
+        if mask_likelihoods:
+            L_set = background_value * np.ones(len(local))
+            L_set[fold_set] = L[indices]
+        else:
+            L_set = L[local]
+        locals_list.append(local)
+        fold_list.append(fold_set + offset)
+        anchors.extend([global_to_local[x] + offset for x in indices_points
+                        if x in global_to_local])
+        N_local.extend([[y + offset for y in x] for x in N_set])
+        L_local.append(L_set)
+        offset += len(local)
+    nVs = np.array([len(x) for x in indices_list], dtype=int)
+    bounds = np.concatenate(([0], np.cumsum(nVs)))
+    sets = np.repeat(np.arange(nsets), nVs)
+    fold = np.concatenate(fold_list + [np.zeros(0, dtype=int)])
+    is_anchor = np.concatenate([np.isin(x, y) for x, y in
+                                zip(indices_list, indices_points_list)] +
+                               [np.zeros(0, dtype=bool)])
+    N_sizes = np.array([len(N_local[x]) for x in fold], dtype=int)
+    local_neighbors = np.array([x for i in fold for x in N_local[i]],
+                               dtype=int)
+    rows = np.repeat(np.arange(len(fold)), N_sizes)
+
     # ------------------------------------------------------------------------
     # Initialize all Hidden Markov Measure Field (HMMF) values with
     # likelihood values (except 0) normalized to the interval (0.5, 1.0]
     # (to guarantee correct topology). Assign a 1 for each anchor point.
     # This influences surrounding vertex neighborhoods.
     # Note: 0.5 is the class boundary threshold for the HMMF values.
-    H = np.zeros(len(L))
-    H_new = (L + 1.000001) / 2
-    H_new[L == 0.0] = 0
+    L_local = np.concatenate(L_local + [np.zeros(0)])
+    H = np.zeros(len(L_local))
+    H_new = (L_local + 1.000001) / 2
+    H_new[L_local == 0.0] = 0
     H_new[H_new > 1.0] = 1
     H[H_new > 0.5] = H_new[H_new > 0.5]
-    H[indices_points] = 1
-    H_new = H.copy()
-    H_tests = H.copy()
-
-    # Find the HMMF values for the neighbors of each vertex:
-    N = neighbor_lists
-    N_sizes = np.array([len(x) for x in N])
-    max_num_neighbors = max(N_sizes[indices])
-    N_array = np.zeros((max_num_neighbors, len(L)))
-    for index in indices:
-        N_array[0:N_sizes[index], index] = N[index]
-    N_array_shape = np.shape(N_array)
-    N_flat = np.ravel(N_array)
-    N_flat_list = N_flat.tolist()
-    H_N = np.reshape(H[[np.int(x) for x in N_flat_list]], N_array_shape)
-    ind_flat = [i for i,x in enumerate(N_flat_list) if x > 0]
-    len_flat = len(N_flat_list)
-
-    # A zero in N calls H[0], so remove zero-padded neighborhood elements:
-    Z = np.zeros((max_num_neighbors, len(L)))
-    for index in indices:
-        Z[0:N_sizes[index], index] = 1
+    H[anchors] = 1
+    L_local = L_local[fold]
 
     # Assign cost values to each vertex (for indices):
-    C = np.zeros(len(L))
-    C[indices] = compute_costs(L[indices], H[indices], H_N[:,indices],
-                               N_sizes[indices], wN_max, Z[:,indices])
-    npoints = len(indices)
+    H_N = H[local_neighbors]
+    C = compute_costs(L_local, H[fold], H_N, rows, N_sizes, wN_max)
+
+    # Record per-iteration costs (to tune min_count and max_count):
+    telemetries = [{'cost': [], 'delta_cost': [], 'delta_points': [],
+                    'topo_tests': [], 'wN': [], 'gradient_factor': []}
+                   for x in range(nsets)]
 
     # Loop until count reaches max_count or until end_flag equals zero
-    # (end_flag allows the loop to continue a few times even if no change):
+    # for every set (end_flag allows the loop to continue a few times even
+    # if no change); sets that end stop being updated:
     count = 0
-    end_flag = 0
+    end_flags = np.zeros(nsets, dtype=int)
+    counts = np.zeros(nsets, dtype=int)
+    costs = np.zeros(nsets)
+    npoints_thr = np.zeros(nsets, dtype=int)
     wN = wN_max
     gradient_factor = grad_min
-    while end_flag < n_tries_no_change and count < max_count:
+    while np.any(end_flags < n_tries_no_change) and count < max_count:
+        active = np.nonzero(end_flags < n_tries_no_change)[0]
 
-        # Select indices with a positive HMMF value:
-        V = [indices[i] for i,x in enumerate(H[indices]) if x > 0.0]
+        # Select indices with a positive HMMF value (of unfinished sets):
+        V = (H[fold] > 0.0) & (end_flags < n_tries_no_change)[sets]
 
         # Update neighborhood H values:
-        #H_N = np.reshape(H[N_flat_list], N_array_shape)
-        H_N = np.zeros(len_flat)
-        H_N[ind_flat] = H[[np.int(x) for x in N_flat[ind_flat]]]
-        H_N = np.reshape(H_N, N_array_shape)
+        H_N = H[local_neighbors]
 
         # Compute the cost gradient for the HMMF values:
-        H_decr = H - H_step
+        H_decr = H[fold] - H_step
         H_decr[H_decr < 0] = 0.0
-        C_decr = compute_costs(L[V], H_decr[V], H_N[:,V], N_sizes[V], wN, Z[:,V])
-        H_tests[V] = H[V] - gradient_factor * (C[V] - C_decr)
+        C_decr = compute_costs(L_local, H_decr, H_N, rows, N_sizes, wN)
+        H_tests = H[fold] - gradient_factor * (C - C_decr)
         H_tests[H_tests < 0] = 0.0
         H_tests[H_tests > 1] = 1.0
 
-        # For each index:
-        for index in V:
-
-            # Do not update anchor point costs:
-            if index not in indices_points:
-
-                # Update a vertex HMMF value if it is away from the threshold:
-                update = True
-                # Or if it crosses the threshold and is a topologically
-                # "simple point" (0.5 not considered part of the fundus):
-                if H[index] > 0.5 >= H_tests[index]:
-                    update, n_in = topo_test(index, H_new, N)
-                elif H[index] <= 0.5 < H_tests[index]:
-                    update, n_in = topo_test(index, 1 - H_new, N)
-                if update:
-                    H_new[index] = H_tests[index]
+        # Do not update anchor point costs:
+        update = V & ~is_anchor
+
+        # A vertex's HMMF value may cross the threshold only if it is
+        # a topologically "simple point" (0.5 not considered part of the
+        # fundus).  Updates that do not change which side of the threshold
+        # a vertex is on (as seen by topo_test() of H or of 1 - H) do not
+        # affect any topology test, so only the others are made in order:
+        H_now = H[fold]
+        cross_down = update & (H_now > 0.5) & (0.5 >= H_tests)
+        cross_up = update & (H_now <= 0.5) & (0.5 < H_tests)
+        reclass = ((1 - H_now) > 0.5) != ((1 - H_tests) > 0.5)
+        serial = np.nonzero(cross_down | cross_up | (update & reclass))[0]
+        parallel = update.copy()
+        parallel[serial] = False
+        H[fold[parallel]] = H_tests[parallel]
+        ntests = np.zeros(nsets, dtype=int)
+        for i in serial:
+            if cross_down[i]:
+                simple, n_in = topo_test(fold[i], H, N_local)
+                ntests[sets[i]] += 1
+            elif cross_up[i]:
+                simple, n_in = topo_test(fold[i], 1 - H, N_local)
+                ntests[sets[i]] += 1
+            else:
+                simple = True
+            if simple:
+                H[fold[i]] = H_tests[i]
 
         # Update the cost values:
-        C[V] = compute_costs(L[V], H_new[V], H_N[:,V], N_sizes[V], wN, Z[:,V])
+        C[V] = compute_costs(L_local, H[fold], H_N, rows, N_sizes, wN)[V]
 
-        # Sum the cost values across all vertices and tally the number
-        # of HMMF values greater than the threshold.
+        # Sum the cost values across all vertices of each set and tally
+        # the number of HMMF values greater than the threshold.
         # After iteration 1, compare current and previous values.
         # If the values are similar, increment end_flag:
-        costs = sum(C[V].tolist())
-        npoints_thr = len([x for x in H[V].tolist() if x > 0.5])
-
-        # Terminate the loop if there are insufficient changes:
+        costs_previous = costs.copy()
+        npoints_thr_previous = npoints_thr.copy()
+        H_fold = H[fold]
+        for iset in active:
+            V_set = V[bounds[iset]:bounds[iset + 1]]
+            costs[iset] = np.sum(C[bounds[iset]:bounds[iset + 1]][V_set])
+            npoints_thr[iset] = np.sum(
+                H_fold[bounds[iset]:bounds[iset + 1]][V_set] > 0.5)
+            telemetry = telemetries[iset]
+            telemetry['cost'].append(float(costs[iset]))
+            telemetry['topo_tests'].append(int(ntests[iset]))
+            telemetry['wN'].append(wN)
+            telemetry['gradient_factor'].append(gradient_factor)
+        counts[active] += 1
+
+        # Terminate the loop for a set if there are insufficient changes:
         if count > 0:
-            delta_cost = (costs_previous - costs) / npoints
-            delta_points = npoints_thr_previous - npoints_thr
-            if delta_points == 0:
-                if delta_cost < min_cost_change and count > min_count:
-                    end_flag += 1
-            else:
-                end_flag = 0
+            for iset in active:
+                delta_cost = (costs_previous[iset] - costs[iset]) / nVs[iset]
+                delta_points = npoints_thr_previous[iset] - npoints_thr[iset]
+                if delta_points == 0:
+                    if delta_cost < min_cost_change and count > min_count:
+                        end_flags[iset] += 1
+                else:
+                    end_flags[iset] = 0
+                telemetries[iset]['delta_cost'].append(float(delta_cost))
+                telemetries[iset]['delta_points'].append(int(delta_points))
 
             # Display information every n_mod iterations:
             if verbose and not np.mod(count, print_interval):
+                delta_cost = np.sum(costs_previous[active] - costs[active]) / \
+                             np.sum(nVs[active])
+                delta_points = np.sum(npoints_thr_previous[active] -
+                                      npoints_thr[active])
                 print('      Iteration {0}: {1} crossing threshold '
                       '(wN={2:0.3f}, grad={3:0.3f}, cost={4:0.3f})'.
                       format(count, delta_points, wN, gradient_factor,
@@ -569,54 +891,63 @@ def connect_points_hmmf(indices_points, indices, L, neighbor_lists,
                 gradient_factor = factor * (grad_max - grad_min) + grad_min
             if wN > wN_min:
                 wN = wN_max - factor * (wN_max - wN_min)
-
-        # Reset for next iteration:
-        costs_previous = costs
-        npoints_thr_previous = npoints_thr
-        H = H_new
+        else:
+            for iset in active:
+                telemetries[iset]['delta_cost'].append(None)
+                telemetries[iset]['delta_points'].append(None)
 
         count += 1
 
-    if verbose:
-        print('      Updated hidden Markov measure field (HMMF) values')
-
-    # Skeletonize:
-    if do_erode:
-        # Threshold the resulting array:
-        S = background_value * np.ones(len(L))
-        S[indices] = H[indices]
-        S[S > 0.5] = 1.0
-        S[S <= 0.5] = background_value
-
-        skeleton = connect_points_erosion(S, neighbor_lists=N,
-                                          outer_anchors=indices_points,
-                                          inner_anchors=[],
-                                          values=H, erode_ratio=0.5,
-                                          erode_min_size=10, save_steps=[],
-                                          save_vtk='',
-                                          background_value=background_value,
-                                          verbose=verbose)
-        if verbose:
-            npoints_thr = len([x for x in S if x != background_value])
-            print('      Removed {0} points to create one-vertex-thin '
-                  'skeletons'.format(int(npoints_thr - len(skeleton))))
-    else:
-        # Threshold the resulting array:
-        S = np.zeros(len(L))
-        S[indices] = H[indices]
-        S[S > 0.5] = 1.0
-        S[S <= 0.5] = 0.0
-        skeleton = [i for i,x in enumerate(S.tolist()) if x == 1]
+    # ------------------------------------------------------------------------
+    # Skeletonize each set:
+    # ------------------------------------------------------------------------
+    skeletons = []
+    offset = 0
+    for iset, indices in enumerate(indices_list):
+        local = locals_list[iset]
+        H_set = H[fold[bounds[iset]:bounds[iset + 1]]]
         if verbose:
-            print('      Removed {0} points to create one-vertex-thin '
-                  'skeletons'.format(int(sum(S.tolist()) - len(skeleton))))
+            print('      Updated hidden Markov measure field (HMMF) values '
+                  'in {0} iterations ({1} topology tests)'.
+                  format(counts[iset],
+                         sum(telemetries[iset]['topo_tests'])))
+
+        if do_erode:
+            # Threshold the resulting array:
+            S = background_value * np.ones(len(L))
+            S[indices] = H_set
+            S[S > 0.5] = 1.0
+            S[S <= 0.5] = background_value
+            values = np.zeros(len(L))
+            values[local] = H[offset:offset + len(local)]
+
+            skeleton = connect_points_erosion(S, neighbor_lists=N,
+                                    outer_anchors=indices_points_list[iset],
+                                    inner_anchors=[],
+                                    values=values, erode_ratio=0.5,
+                                    erode_min_size=10, save_steps=[],
+                                    save_vtk='',
+                                    background_value=background_value,
+                                    verbose=verbose)
+            if verbose:
+                npoints_thr = len([x for x in S if x != background_value])
+                print('      Removed {0} points to create one-vertex-thin '
+                      'skeletons'.format(int(npoints_thr - len(skeleton))))
+        else:
+            # Threshold the resulting array:
+            skeleton = np.sort(indices[H_set > 0.5]).tolist()
+        skeletons.append(skeleton)
+        offset += len(local)
 
-    return skeleton
+    if return_telemetry:
+        return skeletons, telemetries
+    else:
+        return skeletons
 
 
 def smooth_skeletons(skeletons, bounds, vtk_file, likelihoods, wN_max=1.0,
                      do_erode=True, save_file=False, output_file='',
-                     background_value=-1, verbose=False):
+                     background_value=-1, verbose=False, batch=False):
     """
     Smooth skeleton by dilation followed by connect_points_hmmf().
 
@@ -627,6 +958,9 @@ def smooth_skeletons(skeletons, bounds, vtk_file, likelihoods, wN_max=1.0,
         4. Connect endpoints through dilated segment by connect_points_hmmf().
         5. Store smoothed output from #4.
 
+    With batch=True, steps 4 and 5 are run once for all skeleton segments
+    of all skeletons, by connect_points_hmmf_batch(), with the same result.
+
     Parameters
     ----------
     skeletons : list of integers
@@ -649,6 +983,8 @@ def smooth_skeletons(skeletons, bounds, vtk_file, likelihoods, wN_max=1.0,
         background value
     verbose : bool
         print statements?
+    batch : bool
+        smooth all skeleton segments together?
 
     Returns
     -------
@@ -722,7 +1058,8 @@ def smooth_skeletons(skeletons, bounds, vtk_file, likelihoods, wN_max=1.0,
     from mindboggle.guts.mesh import find_neighbors_from_file, find_endpoints
     from mindboggle.guts.segment import segment_regions
     from mindboggle.guts.mesh import dilate
-    from mindboggle.guts.paths import connect_points_hmmf
+    from mindboggle.guts.paths import connect_points_hmmf, \
+        connect_points_hmmf_batch
 
     t0 = time()
 
@@ -743,6 +1080,9 @@ def smooth_skeletons(skeletons, bounds, vtk_file, likelihoods, wN_max=1.0,
         print("Smooth {0} skeleton{1}...".format(n_skeletons, sdum))
     Z = background_value * np.ones(npoints)
     smoothed_skeletons = Z.copy()
+    batch_IDs = []
+    batch_endpoints = []
+    batch_dilated = []
     for ID in unique_IDs:
         skeleton = [i for i,x in enumerate(skeletons) if x == ID]
         if verbose:
@@ -776,7 +1116,11 @@ def smooth_skeletons(skeletons, bounds, vtk_file, likelihoods, wN_max=1.0,
                 print('    Dilate skeleton within bounds...')
             dilated = dilate(skel_seg, nedges, neighbor_lists)
             dilated = list(set(dilated).intersection(indices))
-            if dilated:
+            if dilated and batch:
+                batch_IDs.append(ID)
+                batch_endpoints.append(endpoints)
+                batch_dilated.append(dilated)
+            elif dilated:
     
                 # ------------------------------------------------------------
                 # Set undilated likelihoods to background to keep neighbors:
@@ -804,6 +1148,21 @@ def smooth_skeletons(skeletons, bounds, vtk_file, likelihoods, wN_max=1.0,
                 # Store skeleton:
                 # ------------------------------------------------------------
                 smoothed_skeletons[new_skeleton] = ID
+
+    # ------------------------------------------------------------------------
+    # Smoothly re-skeletonize all dilated skeleton segments at once
+    # (each with likelihoods only within its dilated segment):
+    # ------------------------------------------------------------------------
+    if batch_IDs:
+        if verbose:
+            print('  Smoothly re-skeletonize {0} dilated skeleton segments...'.
+                  format(len(batch_IDs)))
+        new_skeletons = connect_points_hmmf_batch(batch_endpoints,
+            batch_dilated, np.asarray(likelihoods), neighbor_lists, wN_max,
+            do_erode, background_value, verbose, mask_likelihoods=True)
+        for ID, new_skeleton in zip(batch_IDs, new_skeletons):
+            smoothed_skeletons[new_skeleton] = ID
+
     if verbose:
         print('  ...Smoothed {0} skeleton{1} ({2:.2f} seconds)'.
               format(n_skeletons, sdum, time() - t0))
@@ -1054,7 +1413,23 @@ def find_outer_endpoints(indices, neighbor_lists, values, values_seeding,
     from mindboggle.guts.segment import extract_borders
     from mindboggle.guts.segment import segment_rings
     from mindboggle.guts.paths import track_segments
-    from mindboggle.guts.mesh import find_neighborhood
+    from mindboggle.guts.mesh import find_hop_distances, extract_submesh
+
+    # ------------------------------------------------------------------------
+    # Borders of the region (or of vertices in it) are within one edge of
+    # the region, so they are extracted from the submesh of the region and
+    # the two rings around it, in time proportional to the region's size
+    # (submesh vertices are in mesh order, so borders are in the same order):
+    # ------------------------------------------------------------------------
+    local_to_global, global_to_local, local_neighbor_lists, foo1, foo2 = \
+        extract_submesh(indices, neighbor_lists, 2)
+
+    def extract_region_borders(indices_inside):
+        B = np.ones(len(local_to_global))
+        B[[global_to_local[x] for x in indices_inside]] = 2
+        borders, foo1, foo2 = extract_borders(list(range(len(B))), B,
+                                              local_neighbor_lists)
+        return local_to_global[borders].tolist()
 
     # ------------------------------------------------------------------------
     # Settings:
@@ -1073,10 +1448,7 @@ def find_outer_endpoints(indices, neighbor_lists, values, values_seeding,
     # ------------------------------------------------------------------------
     # Extract region boundary:
     # ------------------------------------------------------------------------
-    B = np.ones(len(V))
-    B[indices] = 2
-    borders, foo1, foo2 = extract_borders(list(range(len(B))), B,
-                                          neighbor_lists)
+    borders = extract_region_borders(indices)
 
     # ------------------------------------------------------------------------
     # Initialize seeds with vertices at the median-depth boundary:
@@ -1102,10 +1474,7 @@ def find_outer_endpoints(indices, neighbor_lists, values, values_seeding,
 
     # Extract threshold boundary vertices as seeds:
     indices_high = [x for x in indices if S[x] >= thresholdS]
-    B = np.ones(len(S))
-    B[indices_high] = 2
-    seeds, foo1, foo2 = extract_borders(list(range(len(S))), B,
-                                        neighbor_lists)
+    seeds = extract_region_borders(indices_high)
 
     # ------------------------------------------------------------------------
     # Segment the mesh from the seeds iteratively toward the boundary:
@@ -1129,7 +1498,8 @@ def find_outer_endpoints(indices, neighbor_lists, values, values_seeding,
     # 1. Keep tracks that have a high median track value.
     # 2. Filter tracks so that there are no two track endpoint vertices
     # within a given number of edges between each other.  We select the track
-    # with higher median value when their endpoints are close.
+    # with higher median value when their endpoints are close
+    # (computing the number of edges between all endpoints at once).
     # ------------------------------------------------------------------------
     if do_filter_tracks and T:
 
@@ -1147,39 +1517,31 @@ def find_outer_endpoints(indices, neighbor_lists, values, values_seeding,
         T = [T[i] for i in Ihigh]
         Tvalues = [Tvalues[i] for i in Ihigh]
 
-        # Gather endpoint vertex indices:
+        # Gather endpoint vertex indices, and find the number of edges
+        # between each pair of endpoints:
         E = [x[-1] for x in T]
-
-        # Loop through endpoints:
+        Tvalues = np.array(Tvalues)
+        Eunique, Einverse = np.unique(E, return_inverse=True)
+        D = find_hop_distances(neighbor_lists, Eunique, min_separation)
+        D = D[Einverse][:, Einverse]
+        same = Einverse[:, np.newaxis] == Einverse[np.newaxis, :]
+        near = (D <= min_separation) & ~same
+
+        # Loop through endpoints, clustering each remaining endpoint with
+        # the remaining endpoints close to it (or the same vertex):
         E2 = []
         T2 = []
-        while E:
-
-            # Find endpoints close to the first endpoint:
-            near = find_neighborhood(neighbor_lists, [E[0]], min_separation)
-            Isame = [i for i,x in enumerate(E) if x == E[0]]
-            Inear = [i for i,x in enumerate(E) if x in near]
-            if Inear or len(Isame) > 1:
-                Inear.extend(Isame)
+        remaining = np.ones(len(E), dtype=bool)
+        for i in range(len(E)):
+            if remaining[i]:
+                Inear = np.concatenate((np.nonzero(remaining & near[i])[0],
+                                        np.nonzero(remaining & same[i])[0]))
 
                 # Select endpoint with the maximum median track value:
-                Imax = Inear[np.argmax([Tvalues[i] for i in Inear])]
+                Imax = Inear[np.argmax(Tvalues[Inear])]
                 E2.append(E[Imax])
                 T2.append(T[Imax])
-
-                # Keep data for points that are not nearby for the next loop:
-                Ikeep = [i for i in range(len(E)) if i not in Inear]
-                E = [E[i] for i in Ikeep]
-                T = [T[i] for i in Ikeep]
-                Tvalues = [Tvalues[i] for i in Ikeep]
-
-            # If nothing nearby, simply keep the endpoint:
-            else:
-                E2.append(E[0])
-                T2.append(T[0])
-                del(E[0])
-                del(T[0])
-                del(Tvalues[0])
+                remaining[Inear] = False
 
         endpoints = E2
         endtracks = T2
@@ -1213,6 +1575,10 @@ def find_max_values(points, values, min_separation=10, thr=0.5):
         3. If there are no nearby special points,
            assign the maximum value vertex as a special point.
 
+    Nearby points are found with a k-d tree of the vertices above threshold
+    and suppressed as each special point is assigned
+    (greedy non-maximum suppression).
+
     Parameters
     ----------
     points : numpy array of floats
@@ -1252,6 +1618,9 @@ def find_max_values(points, values, min_separation=10, thr=0.5):
     >>> inner_anchors = find_max_values(points, values, min_separation, thr)
     >>> inner_anchors[0:10]
     [61455, 41761, 67978, 72621, 78546, 40675, 73745, 98736, 125536, 119813]
+    >>> find_max_values([[0,0,0], [1,0,0], [3,0,0], [4,0,0], [9,0,0]],
+    ...                 [0.6, 0.9, 0.7, 0.8, 0.2], min_separation=2, thr=0.5)
+    [1, 3]
 
     View anchors in surface fold (skip test):
 
@@ -1264,52 +1633,34 @@ def find_max_values(points, values, min_separation=10, thr=0.5):
 
     """
     import numpy as np
-    from operator import itemgetter
+    from scipy.spatial import cKDTree
 
     # Make sure arguments are numpy arrays:
     if not isinstance(points, np.ndarray):
         points = np.array(points)
-
-    # Sort values and find indices for values above the threshold:
-    L_table = [[i,x] for i,x in enumerate(values)]
-    L_table_sort = np.transpose(sorted(L_table, key=itemgetter(1)))[:, ::-1]
-    IL = [int(L_table_sort[0,i]) for i,x in enumerate(L_table_sort[1,:])
-          if x > thr]
-
-    # Initialize special points list with the index of the maximum value,
-    # remove this value, and loop through the remaining high values:
-    if IL:
-        highest = [IL.pop(0)]
-        for imax in IL:
-
-            # Determine if there are any special points
-            # near to the current maximum value vertex:
-            i = 0
-            found = 0
-            while i < len(highest) and found == 0:
-
-                # Compute Euclidean distance between points:
-                D = np.linalg.norm(points[highest[i]] - points[imax])
-
-                # If distance less than threshold, consider the point found:
-                if D < min_separation:
-                    found = 1
-                ## Compute directional distance between points if close:
-                #elif D < max_distance:
-                #    dirV = np.dot(points[indices_special[i]] - points[imax],
-                #               min_directions[highest[i]])
-                #    # If distance less than threshold, consider point found:
-                #    if np.linalg.norm(dirV) < min_separation:
-                #        found = 1
-
-                i += 1
-
-            # If there are no nearby special points,
-            # assign the maximum value vertex as a special point:
-            if not found:
-                highest.append(imax)
-    else:
-        highest = []
+    values = np.asarray(values)
+
+    # Sort values (from highest to lowest, ties by decreasing index)
+    # and find indices for values above the threshold:
+    IL = np.argsort(values, kind='mergesort')[::-1]
+    IL = IL[values[IL] > thr]
+
+    # Greedily assign each remaining maximum value vertex as a special point
+    # if there are no nearby special points, suppressing all vertices
+    # within min_separation of each new special point:
+    highest = []
+    if len(IL):
+        candidates = points[IL]
+        tree = cKDTree(candidates)
+        suppressed = np.zeros(len(IL), dtype=bool)
+        for i, imax in enumerate(IL):
+            if not suppressed[i]:
+                highest.append(int(imax))
+                near = np.array(tree.query_ball_point(candidates[i],
+                                                      min_separation),
+                                dtype=int)
+                D = np.linalg.norm(candidates[near] - candidates[i], axis=1)
+                suppressed[near[D < min_separation]] = True
 
     return highest
 
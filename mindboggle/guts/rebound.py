@@ -17,7 +17,7 @@ Copyright 2016,  Mindboggle team (http://mindboggle.info), Apache v2.0 License
 import os
 import numpy as np
 from time import time
-from scipy.sparse import csr_matrix, lil_matrix
+from scipy.sparse import csr_matrix, coo_matrix
 
 from mindboggle.mio.vtks import write_vtk
 import mindboggle.guts.graph as go
@@ -107,8 +107,7 @@ class Bounds:
                     print('Please enter a fractional number less than or '
                           'equal to 1.')
                 return
-            randoms = np.array([np.mod(i, int(1.0/fraction))
-                                for i in range(self.num_points)])
+            randoms = np.mod(np.arange(self.num_points), int(1.0/fraction))
             self.seed_labels[randoms==0] = 1
 
         # Replace the 1s in self.seed_labels with the seed label values
@@ -128,6 +127,10 @@ class Bounds:
         """
         Construct a vertices x labels array of vertex label assignment values.
 
+        The column of each seed vertex is found with a binary search
+        (np.searchsorted) in the sorted array of unique labels, so the matrix
+        is filled with fancy indexing rather than a loop over vertices.
+
         Parameters
         ----------
         array of n labels; -1 corresponds to no label
@@ -140,26 +143,41 @@ class Bounds:
            -1 indicates that it does not have that label
             0 indicates that there is no label assigned
 
+        Examples
+        --------
+        >>> import numpy as np
+        >>> from mindboggle.guts.rebound import Bounds
+        >>> B = Bounds()
+        >>> B.Labels = np.array([0, 0, 0, 0, 0])
+        >>> B.seed_labels = np.array([-1, 5, 2, -1, 5])
+        >>> B.build_label_matrix()
+        array([[ 0.,  0.],
+               [-1.,  1.],
+               [ 1., -1.],
+               [ 0.,  0.],
+               [-1.,  1.]])
+        >>> B.unique_labels
+        array([2, 5])
+
         """
+        seed_labels = np.asarray(self.seed_labels)
 
-        # Get the unique (sorted) set of labels
-        self.unique_labels = np.sort(np.asarray(list(set(self.seed_labels))))
+        # Get the unique (sorted) set of labels:
+        is_seed = seed_labels >= self.min_label
+        self.unique_labels = np.unique(seed_labels[is_seed])
 
-        # Number of labels and vertices
-        self.unique_labels = [x for x in self.unique_labels if x >= self.min_label]
+        # Number of labels and vertices:
         C = len(self.unique_labels)
         n = len(self.Labels)
 
-        # Construct n x C matrix
-        self.label_matrix = np.zeros((n, C))
+        # Column of each seed vertex's label:
+        rows = np.nonzero(is_seed)[0]
+        columns = np.searchsorted(self.unique_labels, seed_labels[rows])
 
-        # Populate the label assignment matrix with -1s and 1s for seed labels
-        # For each row...
-        for i in range(n):
-            if self.seed_labels[i] >= self.min_label:
-                self.label_matrix[i, :] = -1
-                unique_label_index = np.where(self.unique_labels == self.seed_labels[i])[0]
-                self.label_matrix[i, unique_label_index] = 1
+        # Construct n x C matrix with -1s and 1s for seed labels:
+        self.label_matrix = np.zeros((n, C))
+        self.label_matrix[rows, :] = -1
+        self.label_matrix[rows, columns] = 1
 
         self.num_labels = C
 
@@ -191,11 +209,13 @@ class Bounds:
                                        that vertex has a given label)
         """
 
-        # Step 1. Construct affinity matrix - compute edge weights
+        # Step 1. Construct affinity matrix - compute edge weights,
+        # and the random walk Laplacian used to propagate labels
+        # (reused if the same mesh has already been propagated over)
         if self.Points.shape and self.Indices.shape and self.Faces.shape:
-            self.affinity_matrix = go.weight_graph(self.Points, self.Indices,
-                self.Faces, kernel=kernel, sigma=sigma, add_to_graph=False,
-                verbose=False)
+            self.transition_matrix = go.cached_graph_laplacian(self.Points,
+                self.Indices, self.Faces, kernel=kernel, sigma=sigma,
+                type_of_laplacian='random_walk', verbose=False)
         else:
             if verbose:
                 raise IOError("  Missing data!")
@@ -248,13 +268,10 @@ class Bounds:
                 print('First call graph_based_learning().')
             return
 
-        # Define an array called max_prob_label to store the final values
-        self.max_prob_labels = np.zeros(self.num_points)
-
         # Use the array of unique, sorted labels to convert this matrix
         # back to the original labeling; max_col[i] is the temporary label number
-        for i in range(self.num_points):
-            self.max_prob_labels[i] = self.unique_labels[max_col[i]]
+        self.max_prob_labels = np.asarray(self.unique_labels,
+                                          dtype=float)[max_col]
 
         return self.max_prob_labels
 
@@ -293,9 +310,10 @@ class Bounds:
         l of which are labeled, and u unlabeled.
         The algorithm takes as its input the affinity matrix W (self.affinity_matrix).
         From the affinity matrix, one may construct the diagonal degree matrix,
-        which is a measure of the total weight (or number of edges) attached to a vertex."""
-
-        self.DDM = go.diagonal_degree_matrix(self.affinity_matrix, inverse=True)
+        which is a measure of the total weight (or number of edges) attached to a vertex.
+        The product of the inverse degree matrix and the affinity matrix
+        (the random walk Laplacian) is assembled once, as self.transition_matrix,
+        in graph_based_learning."""
 
         """ Next, we must initialize a vector to represent the results of the label
         propagation algorithm. It will contain l labels and u 0's.
@@ -367,7 +385,7 @@ class Bounds:
                 restore_indices = np.hstack((self.label_boundary,self.polyline_elements))
                 restore_values = column[restore_indices]
 
-            Y_hat_now = csr_matrix(column).transpose()
+            Y_hat_now = np.array(column, dtype=float)
             converged = False
             counter = 0
             while not converged and counter < max_iters:
@@ -409,20 +427,20 @@ class Bounds:
 
                     if not np.mod(counter,1000):
                         LABELS = np.zeros(self.num_points)
-                        LABELS[:] = Y_hat_now.todense().T.flatten()
+                        LABELS[:] = Y_hat_now
                         write_vtk(filename, self.Points, self.Vertices,
                                   [], self.Faces, [LABELS], scalar_type='int')
 
                 # column matrix
-                Y_hat_next = (self.DDM * self.affinity_matrix * Y_hat_now).todense()
+                Y_hat_next = self.transition_matrix.dot(Y_hat_now)
                 # reset
-                Y_hat_next[restore_indices, 0] = restore_values
+                Y_hat_next[restore_indices] = restore_values
                 # check convergence
-                converged = (np.sum(np.abs(Y_hat_now.todense() - Y_hat_next)) < tol)
+                converged = (np.sum(np.abs(Y_hat_now - Y_hat_next)) < tol)
                 # if verbose:
                 # print('Iteration number {0}, convergence = {1}'.
                 # format(counter,np.sum(np.abs(column.todense() - tmp)))
-                Y_hat_now = csr_matrix(Y_hat_next)
+                Y_hat_now = Y_hat_next
                 counter += 1
 
             # Print out the number of iterations, so that we get a sense for future runs.
@@ -436,7 +454,7 @@ class Bounds:
                     print('Done in {0:.2f} seconds ({1} iterations)'.
                         format(time()-t0, counter))
 
-            self.learned_matrix[:,i] = Y_hat_now.todense().flatten()
+            self.learned_matrix[:,i] = Y_hat_now
 
             #if verbose:
             #print('There were {0} initial seed vertices for this label'.
@@ -495,37 +513,28 @@ class Bounds:
 
         """
         if not realigned_labels:
-            self.label_boundary = np.zeros(self.num_points)
+            labels = np.asarray(self.Labels)
         else:
-            self.Rlabel_boundary = np.zeros(self.num_points)
-
-        # Loop through triangles
-        for triangle in self.Faces:
-            v0, v1, v2 = triangle[0], triangle[1], triangle[2]
-            # If they are not all the same...
-            if not realigned_labels:
-                same_labels = [self.Labels[v1]==self.Labels[v2],
-                               self.Labels[v0]==self.Labels[v2],
-                               self.Labels[v0]==self.Labels[v1]]
-            else:
-                same_labels = [self.RLabels[v1]==self.RLabels[v2],
-                               self.RLabels[v0]==self.RLabels[v2],
-                               self.RLabels[v0]==self.RLabels[v1]]
-
-            # Did it this way for option to modify it later. Perhaps reconsider 'not all' statement.
-            if not all(same_labels):
-                # Then label those vertices as part of the boundary.
-                if not realigned_labels:
-                    self.label_boundary[triangle] = 1
-                else:
-                    self.Rlabel_boundary[triangle] = 1
+            labels = np.asarray(self.RLabels)
+
+        # Compare the labels of the three vertices of every triangle,
+        # and label the vertices of triangles whose labels are not all
+        # the same as part of the boundary:
+        faces = np.asarray(self.Faces)
+        face_labels = labels[faces]
+        mixed = np.logical_or(face_labels[:, 0] != face_labels[:, 1],
+                              face_labels[:, 0] != face_labels[:, 2])
+        boundary = np.zeros(self.num_points)
+        boundary[faces[mixed].ravel()] = 1
 
         # We can now output a file to show the boundary.
         if not realigned_labels:
+            self.label_boundary = boundary
             write_vtk(output_filename, self.Points, self.Vertices,
-                               self.Faces, [self.label_boundary], scalar_type='int')
+                      [], self.Faces, [self.label_boundary], scalar_type='int')
             self.label_boundary_file = output_filename
         else:
+            self.Rlabel_boundary = boundary
             write_vtk(output_filename, self.Points, self.Vertices,
                       [], self.Faces, [self.Rlabel_boundary], scalar_type='int')
             self.Rlabel_boundary_file = output_filename
@@ -779,7 +788,8 @@ class Bounds:
     def determine_appropriate_segments(self, proportion = 1, dist_threshold = 8,
                                        lb_fundus_threshold = 16,
                                        num_good_vertices = 5, eps=1E-7,
-                                       spread_tol = 6, verbose=False):
+                                       spread_tol = 6, num_neighbors = 5,
+                                       verbose=False):
         """
         Determine which label boundary segments should propagate their labels.
 
@@ -791,7 +801,8 @@ class Bounds:
         dist_threshold: float (threshold of absolute distance between polylines and boundary, above which propagation is prohibited)
         num_good_vertices: int (threshold above which a label boundary segment will be preserved)
         eps: float (numerical stability - avoid division by zero)
-        pickled_filename: str (pkl file storing the distance matrix. Saves time.)
+        spread_tol: float (maximum spread of the label boundary vertices closest to a polyline vertex)
+        num_neighbors: int (number of nearest label boundary vertices per polyline vertex used to measure spread)
 
         Returns
         -------
@@ -805,9 +816,14 @@ class Bounds:
 
         We should also preserve the shape of the label boundary.
         And the polylines should run somewhat parallel to the label boundary.
+
+        Rather than a dense matrix of distances between every polyline vertex
+        and every label boundary vertex, k-d trees of the two sets of vertices
+        return only the nearest neighbors (and their distances) needed here.
         """
+        from scipy.spatial import cKDTree
 
-        # Step 0. Construct num_polylines_vertices x num_label_boundary_vertices np array of distances:
+        # Step 0. Construct k-d trees of polyline and label boundary vertices:
         if verbose:
             print('Beginning determine_appropriate_segments()...')
         t0 = time()
@@ -816,25 +832,22 @@ class Bounds:
             print(self.polyline_elements.shape)
             print(self.label_boundary.shape)
 
-        distance_matrix = np.asarray([np.linalg.norm(self.Points[x1] -
-                                                     self.Points[x2])
-            for x1 in self.polyline_elements
-            for x2 in self.label_boundary]).\
-            reshape((self.polyline_elements.size, -1))
-
-        if verbose:
-            print('Distance Matrix has been constructed in {0}. '
-                  'Bounds is {1}.'.format(time() - t0, distance_matrix.shape))
-
-        # Step 1. For each fundus vertex, find the closest and
-        # second closest label boundary vertices,
-
-        sorted_distances = np.argsort(distance_matrix)
+        polylines_points = self.Points[self.polyline_elements]
+        lb_points = self.Points[self.label_boundary]
+        k = min(max(num_neighbors, 2), self.label_boundary.size)
+
+        # Step 1. For each fundus vertex, find the k closest
+        # label boundary vertices (sorted by distance):
+        sorted_distances, sorted_lb = cKDTree(lb_points).query(polylines_points,
+                                                               k=k)
+        sorted_distances = sorted_distances.reshape(self.polyline_elements.size,
+                                                    -1)
+        sorted_lb = sorted_lb.reshape(self.polyline_elements.size, -1)
         if verbose:
-            print('Got sorted distances. Bounds is {0}'.
-                  format(sorted_distances.shape))
+            print('Nearest neighbors found in {0}. '
+                  'Bounds is {1}.'.format(time() - t0, sorted_lb.shape))
 
-        closest_label_boundary = sorted_distances[:,0]
+        closest_label_boundary = sorted_lb[:,0]
         if verbose:
             print('Got closest label boundary. Bounds is {0}. '
                   'First few values are {1}'.format(
@@ -844,37 +857,31 @@ class Bounds:
         self.highlight_vtk_vertices(self.label_boundary[closest_label_boundary],
                                     dir + '/close_vertices.vtk')
 
-        closest_polylines = np.argsort(distance_matrix, 0)[0,:]
-
-        closest_distances = np.amin(distance_matrix, 1)
+        closest_distances = sorted_distances[:,0]
         if verbose:
             print('Got closest_distances. Bounds is {0}. '
                   'First few values are {1}'.format(closest_distances.shape,
                                                     closest_distances[:10]))
 
-        second_closest_distances = np.asarray([distance_matrix[i,sorted_distances[i,1]]
-                                               for i in range(self.polyline_elements.size)])
+        second_closest_distances = sorted_distances[:,1]
         if verbose:
             print('Got second closest distances. Bounds is {0}. '
                   'First few values are {1}'.format(
                     second_closest_distances.shape,
                     second_closest_distances[:10]))
 
-        # Let's try using a dictionary to express the mapping relationship.
-        # We will have one which maps polylines vertices to nearest label boundary vertices.
-        # And we'll have one which maps lb vertices to nearest polylines vertices.
-
-        polylines_lb = dict((self.polyline_elements[i],
-                             (self.label_boundary[closest_label_boundary[i]],
-                              distance_matrix[i,closest_label_boundary[i]]))
-                                              for i in range(self.polyline_elements.size))
-        lb_polylines = dict((self.label_boundary[i],
-                             (self.polyline_elements[closest_polylines[i]],
-                              distance_matrix[closest_polylines[i],i])) for i in range(self.label_boundary.size))
+        # For each label boundary vertex, find the closest fundus vertex.
+        # Together with closest_label_boundary, this expresses the mapping
+        # from polylines vertices to nearest label boundary vertices,
+        # and from lb vertices to nearest polylines vertices.
+        lb_distances, closest_polylines = \
+            cKDTree(polylines_points).query(lb_points, k=1)
 
         if verbose:
-            print('The polylines to label boundary mapping is: {0}'.format(polylines_lb))
-            print('The label boundary to polylines mapping is: {0}'.format(lb_polylines))
+            print('The polylines to label boundary mapping is: {0}'.format(
+                self.label_boundary[closest_label_boundary]))
+            print('The label boundary to polylines mapping is: {0}'.format(
+                self.polyline_elements[closest_polylines]))
 
         # Step 2. Determine which obey proper proportions and distances, using parameters
         within_distance = (closest_distances < dist_threshold)
@@ -896,9 +903,10 @@ class Bounds:
         self.highlight_vtk_vertices([self.label_boundary[closest_label_boundary[within_proportion==1]]],
                                 dir + '/good_proportion.vtk')
 
-        # The following array stores the indices of the label boundary vertices which satisfy the above properties.
-        satisfy_distances = self.label_boundary[closest_label_boundary[np.nonzero(np.bitwise_and(within_distance,
-                                                                                                 within_proportion))]]
+        # The following array stores the indices (to self.label_boundary) of the label boundary vertices which satisfy the above properties.
+        satisfy_lb = closest_label_boundary[np.nonzero(np.bitwise_and(within_distance,
+                                                                      within_proportion))]
+        satisfy_distances = self.label_boundary[satisfy_lb]
         if verbose:
             print('Got satisfy distances. Bounds is {0}. They are {1}'.
                   format(satisfy_distances.shape, satisfy_distances))
@@ -915,26 +923,17 @@ class Bounds:
         # For pruning, we will eliminate any lb vertex whose closest fundus vertex has a large spread among the lb vertices.
         # For augmenting, we will add any vertex which maps to a fundus which maps to a qualified lb vertex on the same label boundary.
 
-        # Pruning...
-        for lbvertex in satisfy_distances:
-            fundus_vertex = lb_polylines[lbvertex][0]
-            fundus_index = np.nonzero(self.polyline_elements == fundus_vertex)[0]
-            top_five_indices = sorted_distances[fundus_index,:5].flatten()
-            top_five_lbvertices = self.label_boundary[top_five_indices]
-            spread_matrix = np.zeros((top_five_lbvertices.size,top_five_lbvertices.size))
-            for i in range(top_five_lbvertices.size):
-                for j in range(top_five_lbvertices.size):
-                    v1 = top_five_lbvertices[i]
-                    v2 = top_five_lbvertices[j]
-                    spread_matrix[i,j] = np.linalg.norm(self.Points[v1] - self.Points[v2])
-
-            spread = np.max(spread_matrix)
-            if spread > spread_tol:
-                satisfy_distances = np.delete(satisfy_distances,np.nonzero(satisfy_distances == lbvertex))
-                if verbose:
-                    print('deleted vertex: {0}'.format(lbvertex))
-
-                #### AH! I'm changing that over which I'm iterating! Fix.
+        # Pruning (spread is the maximum distance between any two of
+        # the nearest label boundary vertices of each fundus vertex)...
+        top_points = lb_points[sorted_lb[:, :num_neighbors]]
+        spread = np.sqrt(((top_points[:, :, np.newaxis] -
+                           top_points[:, np.newaxis, :]) ** 2).sum(axis=3))
+        spread = spread.max(axis=2).max(axis=1)
+        prune = spread[closest_polylines[satisfy_lb]] > spread_tol
+        if verbose:
+            for lbvertex in satisfy_distances[prune]:
+                print('deleted vertex: {0}'.format(lbvertex))
+        satisfy_distances = satisfy_distances[~prune]
 
         self.highlight_vtk_vertices(satisfy_distances, dir + '/satisfy_distance_pruned.vtk')
 
@@ -943,14 +942,18 @@ class Bounds:
                   format(satisfy_distances.size))
 
         # Augmenting...
-        for lbvertex in self.label_boundary:
-            fundus_vertex, distance = lb_polylines[lbvertex]
-            if distance < lb_fundus_threshold:
-                mapped_lbvertex = polylines_lb[fundus_vertex][0]
-                if mapped_lbvertex in satisfy_distances and self.same_boundary(mapped_lbvertex,lbvertex):
-                    satisfy_distances = np.append(satisfy_distances,lbvertex)
-                    if verbose:
-                        print('added vertex: {0}'.format(lbvertex))
+        satisfied = np.zeros(self.num_points, dtype=bool)
+        satisfied[satisfy_distances] = True
+        mapped_lbvertices = self.label_boundary[
+            closest_label_boundary[closest_polylines]]
+        for i in np.nonzero(lb_distances < lb_fundus_threshold)[0]:
+            lbvertex = self.label_boundary[i]
+            mapped_lbvertex = mapped_lbvertices[i]
+            if satisfied[mapped_lbvertex] and self.same_boundary(mapped_lbvertex,lbvertex):
+                satisfy_distances = np.append(satisfy_distances,lbvertex)
+                satisfied[lbvertex] = True
+                if verbose:
+                    print('added vertex: {0}'.format(lbvertex))
 
         self.highlight_vtk_vertices(satisfy_distances, dir + '/satisfy_distance_pruned_augmented.vtk')
         if verbose:
@@ -1070,14 +1073,14 @@ class Bounds:
             if verbose:
                 print('Constructing neighborhood function.')
 
-            self.Neighbors = lil_matrix((self.num_points, self.num_points))
-
-            for row in self.Faces:
-                self.Neighbors[row[0], row[1]] = self.Neighbors[row[1], row[0]] = 1
-                self.Neighbors[row[0], row[2]] = self.Neighbors[row[2], row[0]] = 1
-                self.Neighbors[row[1], row[2]] = self.Neighbors[row[2], row[1]] = 1
-
-            self.Neighbors = self.Neighbors.tocsr()
+            faces = np.asarray(self.Faces)
+            rows = np.hstack((faces[:, 0], faces[:, 1], faces[:, 0],
+                              faces[:, 2], faces[:, 1], faces[:, 2]))
+            cols = np.hstack((faces[:, 1], faces[:, 0], faces[:, 2],
+                              faces[:, 0], faces[:, 2], faces[:, 1]))
+            self.Neighbors = coo_matrix((np.ones(rows.size), (rows, cols)),
+                shape=(self.num_points, self.num_points)).tocsr()
+            self.Neighbors.data[:] = 1
             self.found_neighbors = 1
 
         return np.nonzero(self.Neighbors[vertex])[1]
@@ -1284,12 +1287,12 @@ class Bounds:
 
         self.polylines_flanks_indices = np.zeros(self.Labels.shape)
 
-        for triangles in self.Faces:
-            vertex0, vertex1, vertex2 = triangles[0], triangles[1], triangles[2]
-            num_points_in_polylines = (vertex0 in self.polyline_elements) + \
-                                        (vertex1 in self.polyline_elements) + (vertex2 in self.polyline_elements)
-            if num_points_in_polylines > 0:
-                self.polylines_flanks_indices[triangles] = 1
+        # Mark the vertices of triangles with at least one polyline vertex:
+        faces = np.asarray(self.Faces)
+        in_polylines = np.zeros(self.Labels.shape, dtype=bool)
+        in_polylines[self.polyline_elements] = True
+        triangles = faces[in_polylines[faces].any(axis=1)]
+        self.polylines_flanks_indices[triangles.ravel()] = 1
         self.polylines_flanks_indices[self.polyline_elements] = 0
 
         self.polylines_flanks_indices = np.nonzero(self.polylines_flanks_indices)[0]
@@ -25,7 +25,9 @@ def propagate(points, faces, region, seeds, labels,
     points : array (or list) of lists of three integers
         coordinates for all vertices
     faces : list of lists of three integers
-        indices to three vertices per face (indices start from zero)
+        indices to three vertices per face (indices start from zero);
+        only faces whose vertices are all in the region are used, so these
+        may be limited to the faces of a fold containing the region
     region : list (or array) of integers
         values > background_value: inclusion in a region for all vertices
     seeds : numpy array of integers
@@ -110,7 +112,6 @@ def propagate(points, faces, region, seeds, labels,
 
     """
     import numpy as np
-    from mindboggle.guts.mesh import keep_faces
     import mindboggle.guts.kernels as kernels
     import mindboggle.guts.rebound as rebound
 
@@ -122,10 +123,10 @@ def propagate(points, faces, region, seeds, labels,
     if not isinstance(points, np.ndarray):
         points = np.array(points)
 
-    if points.size and faces:
+    if points.size and len(faces):
         segments = background_value * np.ones(len(points))
-        indices_region = [i for i,x in enumerate(region)
-                          if x != background_value]
+        in_region = np.asarray(region) != background_value
+        indices_region = np.nonzero(in_region)[0].tolist()
         if indices_region:
             local_indices_region = background_value * np.ones(labels.shape)
             local_indices_region[indices_region] = list(range(len(indices_region)))
@@ -141,12 +142,13 @@ def propagate(points, faces, region, seeds, labels,
                           'vertices'.format(len(indices_region), n_sets))
 
             # Remove faces whose 3 vertices are not among specified indices:
-            refaces = keep_faces(faces, indices_region)
+            faces = np.asarray(faces, dtype=int)
+            refaces = faces[np.all(in_region[faces], axis=1)]
 
             # Set up rebound Bounds class instance:
             B = rebound.Bounds()
-            if refaces:
-                B.Faces = np.array(refaces)
+            if len(refaces):
+                B.Faces = refaces
                 B.Indices = local_indices_region
                 B.Points = points[indices_region]
                 B.Labels = labels[indices_region]
@@ -178,6 +180,178 @@ def propagate(points, faces, region, seeds, labels,
     return segments
 
 
+def propagate_regions(points, faces, regions, seeds, max_iters=500,
+                      tol=0.001, sigma=10, background_value=-1,
+                      verbose=False):
+    """
+    Propagate labels from seed vertices within many regions at once.
+
+    This gives the same segmentation as calling propagate() once for each
+    region (each unique value in regions), but the edge weights of the
+    whole mesh are computed once, and the regions' graphs are assembled
+    as one block-diagonal random walk operator.  The label propagation
+    problems of all the regions are then solved together: each region's
+    seed numbers occupy the first columns of one label matrix, and each
+    region's columns stop updating once they converge.
+
+    Parameters
+    ----------
+    points : array (or list) of lists of three integers
+        coordinates for all vertices
+    faces : list of lists of three integers
+        indices to three vertices per face (indices start from zero)
+    regions : list (or array) of integers
+        region number for all vertices (background_value if none)
+    seeds : numpy array of integers
+        seed numbers for all vertices
+    max_iters : integer
+        maximum number of iterations to run graph-based learning algorithm
+    tol: float
+        threshold to assess convergence of the algorithm
+    sigma: float
+        gaussian kernel parameter
+    background_value : integer
+        background value
+    verbose : bool
+        print statements?
+
+    Returns
+    -------
+    segments : numpy array of integers
+        seed numbers propagated to all vertices of the regions
+
+    Examples
+    --------
+    >>> # Two 2x4-vertex strips, each with seeds at both ends:
+    >>> import numpy as np
+    >>> from mindboggle.guts.segment import propagate_regions
+    >>> points = [[x, y, 0] for y in range(4) for x in range(4)]
+    >>> faces = [[4*y+x, 4*y+x+1, 4*y+x+4] for y in range(3) for x in range(3)]
+    >>> faces += [[4*y+x+1, 4*y+x+5, 4*y+x+4] for y in range(3) for x in range(3)]
+    >>> regions = [1,1,1,1, 1,1,1,1, 2,2,2,2, 2,2,2,2]
+    >>> seeds = -1 * np.ones(16)
+    >>> seeds[[0, 7, 8, 15]] = [3, 4, 5, 6]
+    >>> segments = propagate_regions(points, faces, regions, seeds)
+    >>> [int(x) for x in segments]
+    [3, 3, 4, 4, 3, 3, 4, 4, 5, 5, 6, 6, 5, 5, 6, 6]
+
+    """
+    import numpy as np
+    from scipy.sparse import coo_matrix
+    from mindboggle.guts.kernels import rbf_kernel
+    from mindboggle.guts.graph import graph_laplacian
+
+    points = np.asarray(points, dtype=float)
+    faces = np.asarray(faces, dtype=int)
+    regions = np.asarray(regions)
+    seeds = np.asarray(seeds)
+    npoints = len(points)
+    segments = background_value * np.ones(npoints)
+    if not npoints or not faces.size or np.all(regions == background_value):
+        return segments
+
+    # Order region vertices by region, and find each region's span:
+    in_region = regions != background_value
+    indices_regions = np.nonzero(in_region)[0]
+    indices_regions = indices_regions[np.argsort(regions[indices_regions],
+                                                 kind='mergesort')]
+    unique_regions, starts, region_sizes = np.unique(
+        regions[indices_regions], return_index=True, return_counts=True)
+    n = len(indices_regions)
+    local = -np.ones(npoints, dtype=int)
+    local[indices_regions] = np.arange(n)
+    region_of_row = np.repeat(np.arange(len(unique_regions)), region_sizes)
+
+    # Keep faces whose three vertices are in the same region:
+    face_regions = regions[faces]
+    keep = np.logical_and(in_region[faces[:, 0]],
+                          np.logical_and(face_regions[:, 0] == face_regions[:, 1],
+                                         face_regions[:, 0] == face_regions[:, 2]))
+
+    # Weight each unique edge of the kept faces (computed once for the mesh),
+    # forming a block-diagonal affinity matrix over the regions' vertices:
+    kept = local[faces[keep]]
+    edges = np.vstack((kept[:, [0, 1]], kept[:, [1, 2]], kept[:, [0, 2]]))
+    edges = np.unique(np.sort(edges, axis=1), axis=0)
+    local_points = points[indices_regions]
+    weights = rbf_kernel(local_points[edges[:, 0]], local_points[edges[:, 1]],
+                         sigma)
+    W = coo_matrix((np.hstack((weights, weights)),
+                    (np.hstack((edges[:, 0], edges[:, 1])),
+                     np.hstack((edges[:, 1], edges[:, 0])))), shape=(n, n))
+    transition_matrix = graph_laplacian(W, 'random_walk')
+
+    # Regions without faces are left as background (as in propagate()):
+    has_faces = np.zeros(len(unique_regions), dtype=bool)
+    has_faces[region_of_row[kept[:, 0]]] = True
+
+    # Columns of the label matrix: the sorted seed numbers of each region:
+    local_seeds = seeds[indices_regions]
+    is_seed = local_seeds != background_value
+    seed_rows = np.nonzero(is_seed)[0]
+    seed_regions = region_of_row[seed_rows]
+    seed_keys, seed_keys_index = np.unique(
+        np.vstack((seed_regions, local_seeds[seed_rows])), axis=1,
+        return_inverse=True)
+    seed_keys_index = np.ravel(seed_keys_index)
+    n_columns = np.bincount(seed_keys[0].astype(int),
+                            minlength=len(unique_regions))
+    first_column = np.hstack(([0], np.cumsum(n_columns)[:-1]))
+    ncolumns = max(n_columns.max(), 1)
+
+    if verbose:
+        print('Segment {0} vertices in {1} regions from {2} sets of seed '
+              'vertices'.format(n, len(unique_regions), seed_keys.shape[1]))
+
+    # Label matrix (1: seed number of column, -1: other seed number, 0: none):
+    seed_columns = seed_keys_index - first_column[seed_regions]
+    valid = np.arange(ncolumns)[np.newaxis, :] < n_columns[:, np.newaxis]
+    Y = np.zeros((n, ncolumns))
+    Y[seed_rows] = -1 * valid[seed_regions]
+    Y[seed_rows, seed_columns] = 1
+
+    # Iterate until every region's columns converge (or max_iters).
+    # The operator is block diagonal, so once all of a region's columns
+    # have converged, its rows are dropped from the system:
+    active = valid.copy()
+    counter = 0
+    while active.any() and counter < max_iters:
+        rows = np.nonzero(active.any(axis=1)[region_of_row])[0]
+        T = transition_matrix[rows][:, rows]
+        Y_rows = Y[rows]
+        row_regions = region_of_row[rows]
+        is_restored = is_seed[rows]
+        row_starts = np.nonzero(np.hstack(([True], np.diff(row_regions) != 0)))[0]
+        n_active = active.any(axis=1).sum()
+        while counter < max_iters:
+            Y_next = T.dot(Y_rows)
+            Y_next[is_restored] = Y_rows[is_restored]
+            changes = np.add.reduceat(np.abs(Y_next - Y_rows), row_starts,
+                                      axis=0)
+            region_numbers = row_regions[row_starts]
+            Y_rows = np.where(active[row_regions], Y_next, Y_rows)
+            active[region_numbers] = np.logical_and(active[region_numbers],
+                                                    changes >= tol)
+            counter += 1
+            if active.any(axis=1).sum() < n_active:
+                break
+        Y[rows] = Y_rows
+
+    if verbose:
+        print('  Done in {0} iterations ({1} columns did not converge)'.
+              format(counter, active.sum()))
+
+    # Assign maximum probability seed numbers to each vertex:
+    Y[~valid[region_of_row]] = -np.inf
+    max_col = np.argmax(Y, axis=1)
+    assigned = np.logical_and(has_faces[region_of_row],
+                              n_columns[region_of_row] > 0)
+    columns = first_column[region_of_row] + max_col
+    segments[indices_regions[assigned]] = seed_keys[1, columns[assigned]]
+
+    return segments
+
+
 def segment_regions(vertices_to_segment, neighbor_lists, min_region_size=1,
                     seed_lists=[], keep_seeding=False,
                     spread_within_labels=False, labels=[], label_lists=[],
@@ -296,10 +470,83 @@ def segment_regions(vertices_to_segment, neighbor_lists, min_region_size=1,
     ...     'segments_from_seeds', [], -1) # doctest: +SKIP
     >>> plot_surfaces('segment_regions.vtk') # doctest: +SKIP
 
+    """
+    import numpy as np
+    from mindboggle.guts.segment import segment_region_lists
+
+    segment_lists, segment_IDs = segment_region_lists(vertices_to_segment,
+        neighbor_lists, min_region_size, seed_lists, keep_seeding,
+        spread_within_labels, labels, label_lists, values, max_steps,
+        verbose=False)
+
+    segments = background_value * np.ones(len(neighbor_lists))
+    for segment_list, segment_ID in zip(segment_lists, segment_IDs):
+        segments[segment_list] = segment_ID
+
+    return segments
+
+
+def segment_region_lists(vertices_to_segment, neighbor_lists,
+                         min_region_size=1, seed_lists=[], keep_seeding=False,
+                         spread_within_labels=False, labels=[],
+                         label_lists=[], values=[], max_steps='',
+                         verbose=False):
+    """
+    Segment vertices of surface into contiguous regions by seed growing,
+    returning the vertices and number of each region.
+
+    This is segment_regions() without an array of region numbers for all
+    vertices, so that it takes time proportional to the number of vertices
+    to segment rather than to the size of the mesh.
+
+    Parameters
+    ----------
+    vertices_to_segment : list of integers
+        indices to mesh vertices to be segmented
+    neighbor_lists : list of lists of integers
+        each list contains indices to neighboring vertices for each vertex
+    min_region_size : integer
+        minimum size of segmented set of vertices
+    seed_lists : list of lists, or empty list
+        each list contains indices to seed vertices to segment vertices_to_segment
+    keep_seeding : bool
+        grow from new seeds even after all seed lists have fully grown
+    spread_within_labels : bool
+        grow seeds only by vertices with labels in the seed labels?
+    labels : list of integers (required only if spread_within_labels)
+        label numbers for all vertices
+    label_lists : list of lists of integers (required only if spread_within_labels)
+        List of unique labels for each seed list to grow into
+        (If empty, set to unique labels for each seed list)
+    values : list of floats (default empty)
+        values for all vertices for use in preferentially directed segmentation
+        (segment in direction of lower values)
+    max_steps : integer (or empty string for infinity)
+        maximum number of segmentation steps to take for each seed list
+    verbose : bool
+        print statements?
+
+    Returns
+    -------
+    segment_lists : list of lists of integers
+        indices to the vertices of each segmented region, in the order
+        in which segment_regions() numbers vertices
+    segment_IDs : list of integers
+        region number of each list in segment_lists
+
+    Examples
+    --------
+    >>> from mindboggle.guts.segment import segment_region_lists
+    >>> neighbor_lists = [[1], [0, 2], [1], [4], [3], [6], [5]]
+    >>> segment_region_lists([0, 1, 2, 4, 3, 6], neighbor_lists)
+    ([[0, 1, 2], [3, 4], [6]], [0, 1, 2])
+    >>> segment_region_lists([0, 1, 2, 4, 3, 6], neighbor_lists, 1, [[3]],
+    ...                      True)
+    ([[3, 4], [0, 1, 2], [6]], [0, 1, 2])
+
     """
     import numpy as np
 
-    verbose = False
 
     # Make sure arguments are lists:
     if isinstance(vertices_to_segment, np.ndarray):
@@ -334,7 +581,8 @@ def segment_regions(vertices_to_segment, neighbor_lists, min_region_size=1,
     # vertex indices for all regions, and Boolean list indicating which regions
     # are fully grown, number of segments, etc.:
     # ------------------------------------------------------------------------
-    segments = background_value * np.ones(len(neighbor_lists))
+    segment_lists = []
+    segment_IDs = []
     region_lists = [[] for x in seed_lists]
     all_regions = []
     fully_grown = [False for x in seed_lists]
@@ -426,7 +674,8 @@ def segment_regions(vertices_to_segment, neighbor_lists, min_region_size=1,
                             counter += 1
                         else:
                             new_segment_index = ilist
-                        segments[region_lists[ilist]] = new_segment_index
+                        segment_lists.append(region_lists[ilist])
+                        segment_IDs.append(new_segment_index)
 
                         # Display current number and size of region:
                         if verbose and size_region > 1:
@@ -490,7 +739,8 @@ def segment_regions(vertices_to_segment, neighbor_lists, min_region_size=1,
                 if size_region >= min_region_size:
 
                     # Assign ID to segmented region and increment ID:
-                    segments[region] = new_segment_index
+                    segment_lists.append(region)
+                    segment_IDs.append(new_segment_index)
                     new_segment_index += 1
 
                     # Display current number and size of region:
@@ -503,7 +753,137 @@ def segment_regions(vertices_to_segment, neighbor_lists, min_region_size=1,
                     seed_list = [vertices_to_segment[0]]
                     region = []
 
-    return segments
+    return segment_lists, segment_IDs
+
+
+def segment_by_thresholds(values, neighbor_lists, thresholds,
+                          min_region_size=1, background_value=-1,
+                          verbose=False):
+    """
+    Segment vertices at or above each of a list of thresholds into connected
+    regions, using a merge tree of the values.
+
+    Vertices are sorted by value once and added from highest to lowest value
+    to a union-find structure, which merges regions as vertices join them and
+    so builds the join (merge) tree of the values.  Each region is represented
+    by its highest-value vertex (when two regions meet, the region with the
+    higher peak absorbs the other), and the regions are read off the tree
+    each time the sweep passes a threshold.  Regions smaller than
+    min_region_size are removed, and the remaining regions are numbered
+    in order of their peak vertex's index, using bincount.
+
+    For a single threshold, the regions are those of segment_regions()
+    applied to the vertices at or above the threshold (with fewer than
+    min_region_size vertices removed), numbered in a different order.
+
+    Parameters
+    ----------
+    values : numpy array of floats
+        values for all vertices (such as depth)
+    neighbor_lists : list of lists of integers
+        each list contains indices to neighboring vertices for each vertex
+    thresholds : list of floats
+        thresholds (in any order)
+    min_region_size : integer
+        minimum number of vertices in a region
+    background_value : integer or float
+        background value
+    verbose : bool
+        print statements?
+
+    Returns
+    -------
+    segments_per_threshold : list of numpy arrays of integers
+        region numbers for all vertices, for each threshold
+    nregions_per_threshold : list of integers
+        number of regions for each threshold
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> from mindboggle.guts.segment import segment_by_thresholds
+    >>> values = np.array([5, 1, 4, 2, 6, 0, 3, 3])
+    >>> neighbor_lists = [[1], [0,2], [1,3], [2,4], [3,5], [4,6], [5,7], [6]]
+    >>> segments, nregions = segment_by_thresholds(values, neighbor_lists,
+    ...                                            [4, 1, 3], 2)
+    >>> [[int(y) for y in x] for x in segments]
+    [[-1, -1, -1, -1, -1, -1, -1, -1], [0, 0, 0, 0, 0, -1, 1, 1], [-1, -1, -1, -1, -1, -1, 0, 0]]
+    >>> nregions
+    [0, 2, 1]
+    >>> segment_by_thresholds(values, neighbor_lists, [4], 0)[1]
+    [3]
+
+    """
+    import numpy as np
+
+    values = np.asarray(values)
+    npoints = len(values)
+
+    # Sort vertices from highest to lowest value, and thresholds likewise:
+    order = np.argsort(-values, kind='mergesort')
+    rank = np.empty(npoints, dtype=int)
+    rank[order] = np.arange(npoints)
+    sorted_values = values[order].tolist()
+    ithresholds = np.argsort(-np.asarray(thresholds, dtype=float),
+                             kind='mergesort')
+
+    parent = list(range(npoints))
+    added = [False] * npoints
+    rank = rank.tolist()
+
+    def find(x):
+        root = x
+        while parent[root] != root:
+            root = parent[root]
+        while parent[x] != root:
+            parent[x], x = root, parent[x]
+        return root
+
+    segments_per_threshold = [None] * len(thresholds)
+    nregions_per_threshold = [0] * len(thresholds)
+    nadded = 0
+    for ithreshold in ithresholds:
+        threshold = thresholds[ithreshold]
+
+        # --------------------------------------------------------------------
+        # Add vertices at or above the threshold, merging regions:
+        # --------------------------------------------------------------------
+        while nadded < npoints and sorted_values[nadded] >= threshold:
+            index = int(order[nadded])
+            added[index] = True
+            for neighbor in neighbor_lists[index]:
+                if added[neighbor]:
+                    root1 = find(neighbor)
+                    root2 = find(index)
+                    if root1 != root2:
+                        # The region with the higher peak survives:
+                        if rank[root1] < rank[root2]:
+                            parent[root2] = root1
+                        else:
+                            parent[root1] = root2
+            nadded += 1
+
+        # --------------------------------------------------------------------
+        # Label regions by their peaks, remove small regions, and renumber:
+        # --------------------------------------------------------------------
+        segments = background_value * np.ones(npoints)
+        if nadded:
+            indices = order[:nadded]
+            roots = np.array([find(int(x)) for x in indices])
+            sizes = np.bincount(roots, minlength=npoints)
+            # (vertices other than peaks have no size, and are never kept):
+            keep = sizes >= max(min_region_size, 1)
+            numbers = np.cumsum(keep) - 1
+            keep_indices = keep[roots]
+            segments[indices[keep_indices]] = numbers[roots[keep_indices]]
+            nregions_per_threshold[ithreshold] = int(np.sum(keep))
+        segments_per_threshold[ithreshold] = segments
+
+        if verbose:
+            print('  {0} regions at or above {1}'.
+                  format(nregions_per_threshold[ithreshold], threshold))
+
+    return segments_per_threshold, nregions_per_threshold
 
 
 def segment_by_region(data, regions=[], surface_file='', save_file=False,
@@ -583,13 +963,12 @@ def segment_by_region(data, regions=[], surface_file='', save_file=False,
     # ------------------------------------------------------------------------
     # Segment data with overlapping regions:
     # ------------------------------------------------------------------------
-    indices = [i for i,x in enumerate(data)
-               if x != background_value]
-    if indices and np.size(regions):
+    indices = np.nonzero(np.asarray(data) != background_value)[0]
+    if indices.size and np.size(regions):
         segment_per_region = background_value * np.ones(len(regions))
         segment_per_region[indices] = regions[indices]
-        n_segments = len([x for x in np.unique(segment_per_region)
-                          if x != background_value])
+        region_numbers = np.unique(segment_per_region[indices])
+        n_segments = int(np.sum(region_numbers != background_value))
     else:
         segment_per_region = []
         n_segments = 0
@@ -624,7 +1003,7 @@ def segment_by_region(data, regions=[], surface_file='', save_file=False,
 
 
 def segment_by_filling_borders(regions, neighbor_lists, background_value=-1,
-                               verbose=False):
+                               verbose=False, grouped=False):
     """
     Fill borders (contours) on a surface mesh
     to segment vertices into contiguous regions.
@@ -638,6 +1017,15 @@ def segment_by_filling_borders(regions, neighbor_lists, background_value=-1,
             6. Find the interior (smaller) sets of neighbors
             7. Fill the contours formed by the interior neighbors
 
+    With grouped=True, the steps are carried out for all borders at once:
+    connected components are found in one pass over the border vertices,
+    one pass over the non-border vertices, and one pass over the neighbors
+    of all borders (each paired with its border), and the components are
+    mapped back to borders, without a flood fill of the mesh per border.
+    The segments are the same, but borders are numbered in order of their
+    lowest vertex index, and of two equally large sets of neighbors of a
+    border, the one with the lowest vertex index is taken as exterior.
+
     Parameters
     ----------
     regions : numpy array of integers
@@ -648,6 +1036,8 @@ def segment_by_filling_borders(regions, neighbor_lists, background_value=-1,
         background value
     verbose : bool
         print statements?
+    grouped : bool
+        segment all borders together with connected components?
 
     Returns
     -------
@@ -656,6 +1046,21 @@ def segment_by_filling_borders(regions, neighbor_lists, background_value=-1,
 
     Examples
     --------
+    >>> # Small example -- a square contour on a grid, with its interior
+    >>> # filled (as region number 0) and exterior left as background:
+    >>> import numpy as np
+    >>> from mindboggle.guts.segment import segment_by_filling_borders
+    >>> n = 9
+    >>> neighbor_lists = [[j*n + i for j in range(r-1, r+2)
+    ...                    for i in range(c-1, c+2) if (j, i) != (r, c)
+    ...                    and 0 <= j < n and 0 <= i < n]
+    ...                   for r in range(n) for c in range(n)]
+    >>> regions = -1 * np.ones(n * n)
+    >>> regions[[r*n + c for r in range(2, 7) for c in range(2, 7)]] = 1
+    >>> segments = segment_by_filling_borders(regions, neighbor_lists,
+    ...                                       grouped=True)
+    >>> [int(x) for x in segments[4*n:5*n]]
+    [-1, -1, -1, 0, 0, 0, -1, -1, -1]
     >>> # Segment folds by extracting their borders and filling them in separately:
     >>> import numpy as np
     >>> from mindboggle.guts.segment import segment_by_filling_borders
@@ -703,6 +1108,102 @@ def segment_by_filling_borders(regions, neighbor_lists, background_value=-1,
     if verbose:
         print('Segment vertices using region borders')
 
+    if grouped:
+        from scipy.sparse import csr_matrix
+        from scipy.sparse.csgraph import connected_components
+
+        npoints = len(regions)
+        sizes = np.array([len(x) for x in neighbor_lists], dtype=int)
+        indptr = np.concatenate(([0], np.cumsum(sizes)))
+        adjacency = np.array([x for y in neighbor_lists for x in y],
+                             dtype=int)
+        rows = np.repeat(np.arange(npoints), sizes)
+
+        # Extract region borders (vertices whose neighbors do not share
+        # the same region number):
+        if verbose:
+            print('  Extract region borders')
+        neighbor_regions = regions[adjacency]
+        first = np.ones(len(rows), dtype=bool)
+        first[1:] = rows[1:] != rows[:-1]
+        same = np.ones(npoints, dtype=bool)
+        starts = indptr[:-1][sizes > 0]
+        same[sizes > 0] = np.minimum.reduceat(neighbor_regions, starts) == \
+                          np.maximum.reduceat(neighbor_regions, starts)
+        border = ~same
+
+        # Segment borders into separate, contiguous borders, and the
+        # non-border vertices into contiguous sets (components are numbered
+        # in order of their lowest vertex index):
+        if verbose:
+            print('  Segment borders and non-border vertices')
+        graph = csr_matrix((np.ones(len(adjacency), dtype=np.int8),
+                            adjacency, indptr), shape=(npoints, npoints))
+        indices_border = np.nonzero(border)[0]
+        indices_inner = np.nonzero(~border)[0]
+        n_borders, borders = connected_components(
+            graph[indices_border][:, indices_border], directed=False)
+        n_inner, inner = connected_components(
+            graph[indices_inner][:, indices_inner], directed=False)
+        border_number = np.full(npoints, -1)
+        border_number[indices_border] = borders
+        inner_number = np.full(npoints, -1)
+        inner_number[indices_inner] = inner
+
+        # Pair each border with its non-border neighbors, and segment the
+        # neighbors of each border into contiguous sets:
+        if verbose:
+            print('  Segment the neighbors of each border')
+        edges = border[rows] & ~border[adjacency]
+        keys = np.unique(border_number[rows[edges]] * npoints +
+                         adjacency[edges])
+        pair_borders = keys // npoints
+        pair_vertices = keys % npoints
+        counts = sizes[pair_vertices]
+        pair_rows = np.repeat(np.arange(len(keys)), counts)
+        pair_neighbors = adjacency[np.repeat(indptr[pair_vertices] -
+                                             np.cumsum(np.concatenate(
+                                                 ([0], counts[:-1]))),
+                                             counts) +
+                                   np.arange(np.sum(counts))]
+        neighbor_keys = pair_borders[pair_rows] * npoints + pair_neighbors
+        pair_cols = np.minimum(np.searchsorted(keys, neighbor_keys),
+                               len(keys) - 1)
+        linked = keys[pair_cols] == neighbor_keys
+        n_sets, sets = connected_components(
+            csr_matrix((np.ones(np.sum(linked), dtype=np.int8),
+                        (pair_rows[linked], pair_cols[linked])),
+                       shape=(len(keys), len(keys))), directed=False)
+
+        # Find the interior (smaller) sets of neighbors: all but the largest
+        # set of each border, with more than two vertices:
+        if verbose:
+            print('  Find the interior (smaller) sets of neighbors')
+        set_sizes = np.bincount(sets, minlength=n_sets)
+        set_borders = np.zeros(n_sets, dtype=int)
+        set_borders[sets] = pair_borders
+        set_first = np.full(n_sets, npoints)
+        np.minimum.at(set_first, sets, pair_vertices)
+        order = np.lexsort((set_first, -set_sizes, set_borders))
+        exterior = np.zeros(n_sets, dtype=bool)
+        exterior[order[np.concatenate(([True], set_borders[order][1:] !=
+                                       set_borders[order][:-1]))]] = True
+        interior = ~exterior & (set_sizes > 2)
+        seeds = interior[sets]
+
+        # Fill the contours formed by the interior neighbors (as do later
+        # borders over earlier borders):
+        if verbose:
+            print('  Fill the contours formed by the interior neighbors')
+        fill = np.full(n_inner, -1)
+        np.maximum.at(fill, inner_number[pair_vertices[seeds]],
+                      pair_borders[seeds])
+        segments = background_value * np.ones(npoints)
+        filled = fill[inner] != -1
+        segments[indices_inner[filled]] = fill[inner][filled]
+
+        return segments
+
     # Extract region borders (assumed to be closed contours)
     if verbose:
         print('  Extract region borders (assumed to be closed contours)')
@@ -869,18 +1370,21 @@ def segment_rings(region, seeds, neighbor_lists, step=1, background_value=-1,
     >>> plot_surfaces('segment_rings.vtk') # doctest: +SKIP
 
     """
-    from mindboggle.guts.segment import segment_regions
+    from mindboggle.guts.segment import segment_region_lists
 
     segments = []
     while seeds:
 
-        # Segment step-wise starting from seeds and through the region:
-        seeds_plus_new = segment_regions(region, neighbor_lists, 1, [seeds],
-                                         False, False, [], [], [],
-                                         step, background_value, verbose)
-
-        seeds_plus_new = [i for i,x in enumerate(seeds_plus_new)
-                          if x != background_value]
+        # Segment step-wise starting from seeds and through the region
+        # (as vertex lists, in mesh order, rather than as numbers for all
+        # vertices of the mesh):
+        segment_lists, segment_IDs = segment_region_lists(region,
+            neighbor_lists, 1, [seeds], False, False, [], [], [], step,
+            False)
+        seeds_plus_new = sorted(set(x for segment_list, segment_ID
+                                    in zip(segment_lists, segment_IDs)
+                                    if segment_ID != background_value
+                                    for x in segment_list))
 
         # Store the new segment after removing the previous segment:
         region = list(frozenset(region).difference(seeds))
@@ -1265,7 +1769,8 @@ def watershed(depths, points, indices, neighbor_lists, min_size=1,
 
 
 def select_largest(points, faces, exclude_labels=[-1], areas=None,
-                   reindex=True, background_value=-1, verbose=False):
+                   reindex=True, background_value=-1, verbose=False,
+                   return_face_indices=False):
     """
     Select the largest segment (connected set of indices) in a surface mesh.
 
@@ -1288,6 +1793,8 @@ def select_largest(points, faces, exclude_labels=[-1], areas=None,
         background value
     verbose : bool
         print statements?
+    return_face_indices : bool
+        also return indices to the input faces that are kept?
 
     Returns
     -------
@@ -1295,6 +1802,8 @@ def select_largest(points, faces, exclude_labels=[-1], areas=None,
         x,y,z coordinates for each vertex of the structure
     faces : list of lists of 3 integers
         3 indices to vertices that form a triangle on the mesh
+    face_indices : numpy array of integers (if return_face_indices)
+        indices to the input faces that are kept
 
     Examples
     --------
@@ -1352,8 +1861,7 @@ def select_largest(points, faces, exclude_labels=[-1], areas=None,
     """
     import numpy as np
 
-    from mindboggle.guts.mesh import find_neighbors, keep_faces, \
-        reindex_faces_points
+    from mindboggle.guts.mesh import find_neighbors, reindex_faces_points
     from mindboggle.guts.segment import segment_regions
 
     # Areas:
@@ -1425,7 +1933,15 @@ def select_largest(points, faces, exclude_labels=[-1], areas=None,
             # ----------------------------------------------------------------
             # Renumber faces for the selected indices:
             # ----------------------------------------------------------------
-            faces = keep_faces(faces, select_indices)
+            # (as keep_faces(), keep faces with three distinct vertices
+            # that are all in the selected segment):
+            faces = np.reshape(faces, (-1, 3))
+            keep = np.all(np.isin(faces, select_indices), axis=1) & \
+                   (faces[:, 0] != faces[:, 1]) & \
+                   (faces[:, 1] != faces[:, 2]) & \
+                   (faces[:, 0] != faces[:, 2])
+            face_indices = np.nonzero(keep)[0]
+            faces = faces[face_indices].tolist()
             if faces:
                 # ------------------------------------------------------------
                 # Reindex indices in faces:
@@ -1435,10 +1951,14 @@ def select_largest(points, faces, exclude_labels=[-1], areas=None,
                 else:
                     points = np.array(points)
                     points = points[select_indices].tolist()
+                if return_face_indices:
+                    return points, faces, face_indices
                 return points, faces
             else:
                 return None
         else:
+            if return_face_indices:
+                return points, faces, np.arange(len(faces))
             return points, faces
 
 
@@ -113,6 +113,169 @@ def list_strings(string1='', string2='', string3='', string4=''):
     return string_list
 
 
+def share_arrays(arrays):
+    """
+    Copy numpy arrays into shared memory blocks for worker processes.
+
+    Worker processes attach to the blocks with attach_arrays(), so that
+    large arrays (such as mesh coordinates, per-vertex values or adjacency)
+    are not pickled for every task.  The caller is responsible for
+    releasing the blocks with release_arrays() when the workers are done.
+
+    Parameters
+    ----------
+    arrays : dictionary of numpy arrays
+        arrays to share, keyed by name
+
+    Returns
+    -------
+    specs : dictionary of tuples
+        (shared memory block name, shape, dtype string) for each array
+    blocks : list of multiprocessing.shared_memory.SharedMemory objects
+        shared memory blocks (to release)
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> from mindboggle.guts.utilities import share_arrays
+    >>> from mindboggle.guts.utilities import attach_arrays, release_arrays
+    >>> specs, blocks = share_arrays({'x': np.arange(4.0), 'y': np.ones(0)})
+    >>> arrays, handles = attach_arrays(specs)
+    >>> arrays['x'].tolist(), arrays['y'].tolist()
+    ([0.0, 1.0, 2.0, 3.0], [])
+    >>> release_arrays(handles, unlink=False)
+    >>> release_arrays(blocks)
+
+    """
+    import numpy as np
+    from multiprocessing import shared_memory
+
+    specs = {}
+    blocks = []
+    try:
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            block = shared_memory.SharedMemory(create=True,
+                                               size=max(array.nbytes, 1))
+            blocks.append(block)
+            shared = np.ndarray(array.shape, dtype=array.dtype,
+                                buffer=block.buf)
+            shared[...] = array
+            specs[name] = (block.name, array.shape, array.dtype.str)
+    except Exception:
+        release_arrays(blocks)
+        raise
+
+    return specs, blocks
+
+
+def attach_arrays(specs):
+    """
+    Attach to numpy arrays in shared memory created by share_arrays().
+
+    Parameters
+    ----------
+    specs : dictionary of tuples
+        (shared memory block name, shape, dtype string) for each array
+
+    Returns
+    -------
+    arrays : dictionary of numpy arrays
+        arrays backed by shared memory, keyed by name
+    handles : list of multiprocessing.shared_memory.SharedMemory objects
+        shared memory handles (keep them for as long as arrays are used)
+
+    Examples
+    --------
+    >>> # See share_arrays().
+
+    """
+    import numpy as np
+    from multiprocessing import shared_memory
+
+    arrays = {}
+    handles = []
+    for name, (block_name, shape, dtype) in specs.items():
+        try:
+            # Python 3.13+: only the creating process should unlink:
+            handle = shared_memory.SharedMemory(name=block_name, track=False)
+        except TypeError:
+            handle = shared_memory.SharedMemory(name=block_name)
+        handles.append(handle)
+        arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype),
+                                  buffer=handle.buf)
+
+    return arrays, handles
+
+
+def release_arrays(blocks, unlink=True):
+    """
+    Close (and by default unlink) shared memory blocks.
+
+    Parameters
+    ----------
+    blocks : list of multiprocessing.shared_memory.SharedMemory objects
+        shared memory blocks from share_arrays() or attach_arrays()
+    unlink : bool
+        free the blocks (only for the process that created them)?
+
+    Examples
+    --------
+    >>> # See share_arrays().
+
+    """
+    for block in blocks:
+        block.close()
+        if unlink:
+            try:
+                block.unlink()
+            except FileNotFoundError:
+                pass
+
+
+def limit_blas_threads(nthreads=1):
+    """
+    Limit the number of threads used by BLAS/OpenMP libraries.
+
+    Call this in each worker process of a pool (for example, as part of the
+    pool initializer), so that libraries such as OpenBLAS or MKL used by
+    numpy and scipy do not start one thread per processor in every worker.
+    The environment variables only affect libraries loaded afterwards
+    (as in spawned workers); libraries that are already loaded (as in forked
+    workers) are limited with threadpoolctl, if it is installed.
+
+    Parameters
+    ----------
+    nthreads : integer
+        maximum number of threads per library
+
+    Returns
+    -------
+    limits : threadpoolctl.threadpool_limits object or None
+        active limits (keep a reference for as long as they should apply)
+
+    Examples
+    --------
+    >>> # See mindboggle.shapes.laplace_beltrami.spectrum_per_label().
+
+    """
+    import os
+
+    for variable in ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+                     'MKL_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS',
+                     'NUMEXPR_NUM_THREADS']:
+        os.environ[variable] = str(nthreads)
+
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        limits = None
+    else:
+        limits = threadpool_limits(limits=nthreads)
+
+    return limits
+
+
 # ============================================================================
 # Doctests
 # ============================================================================
@@ -44,9 +44,15 @@ Authors:
 Copyright 2016,  Mindboggle team (http://mindboggle.info), Apache v2.0 License
 
 """
+from collections import OrderedDict
 
 
-def computeAB(points, faces):
+# Local (per-face) FEM entries keyed by (mesh hash, dtype),
+# most recently used last (see cached_local_AB):
+_local_AB_cache = OrderedDict()
+
+
+def computeAB(points, faces, dtype='float64'):
     """
     Compute matrices for the Laplace-Beltrami operator.
 
@@ -63,6 +69,8 @@ def computeAB(points, faces):
 
     faces : list of lists of 3 integers
         each list contains indices to vertices that form a triangle on a mesh
+    dtype : string
+        floating-point type of the matrices ('float32' to halve memory)
 
     Returns
     -------
@@ -99,99 +107,450 @@ def computeAB(points, faces):
      [ 0.       0.       0.       0.04167  0.       0.04167  0.08333  0.     ]
      [ 0.04167  0.04167  0.       0.       0.       0.       0.       0.08333]]
 
+    """
+    from mindboggle.shapes.laplace_beltrami import local_AB, assemble_AB
+
+    localA, localB = local_AB(points, faces, dtype)
+    A, B = assemble_AB(faces, localA, localB)
+
+    return A, B
+
+
+def local_AB(points, faces, dtype='float64'):
+    """
+    Compute the local (per-face) entries of the Laplace-Beltrami matrices.
+
+    The 3x3 local stiffness and mass matrices of the linear finite elements
+    are computed for all faces at once by broadcasting the matrices on the
+    unit triangle.  Entry (r, c) of a face's local matrices is stored in
+    column 3*r + c, and is added to entry (face[c], face[r]) of A or B
+    by assemble_AB().  The local entries do not depend on which other faces
+    are present, so they may be computed once for a whole surface and
+    assembled for any subset of its faces.
+
+    Parameters
+    ----------
+    points : list of lists of 3 floats
+        x,y,z coordinates for each vertex
+    faces : list of lists of 3 integers
+        each list contains indices to vertices that form a triangle on a mesh
+    dtype : string
+        floating-point type of the local entries
+
+    Returns
+    -------
+    localA : numpy array of floats
+        nine local stiffness matrix entries for each face (nfaces x 9)
+    localB : numpy array of floats
+        nine local mass matrix entries for each face (nfaces x 9)
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> from mindboggle.shapes.laplace_beltrami import local_AB
+    >>> points = [[0,0,0], [1,0,0], [0,1,0]]
+    >>> localA, localB = local_AB(points, [[0,1,2]])
+    >>> [float(x) for x in localA[0]]
+    [1.0, -0.5, -0.5, -0.5, 0.5, 0.0, -0.5, 0.0, 0.5]
+    >>> [round(float(x), 5) for x in localB[0, 0:3]]
+    [0.08333, 0.04167, 0.04167]
+
     """
     import numpy as np
-    from scipy import sparse
 
-    points = np.array(points)
-    faces = np.array(faces)
-    nfaces = faces.shape[0]
+    points = np.asarray(points, dtype=dtype)
+    faces = np.asarray(faces, dtype=int).reshape(-1, 3)
 
-    # Linear local matrices on unit triangle:
-    tB = (np.ones((3,3)) + np.eye(3)) / 24.0
+    # Linear local matrices on unit triangle (flattened, row-major):
+    tB = ((np.ones((3,3)) + np.eye(3)) / 24.0).astype(dtype).ravel()
 
     tA00 = np.array([[ 0.5,-0.5, 0.0],
                      [-0.5, 0.5, 0.0],
-                     [ 0.0, 0.0, 0.0]])
+                     [ 0.0, 0.0, 0.0]], dtype=dtype).ravel()
 
     tA11 = np.array([[ 0.5, 0.0,-0.5],
                      [ 0.0, 0.0, 0.0],
-                     [-0.5, 0.0, 0.5]])
+                     [-0.5, 0.0, 0.5]], dtype=dtype).ravel()
 
     tA0110 = np.array([[ 1.0,-0.5,-0.5],
                        [-0.5, 0.0, 0.5],
-                       [-0.5, 0.5, 0.0]])
-
-    # Replicate into third dimension for each triangle
-    # (for tB, 1st index is the 3rd index in MATLAB):
-    tB = np.array([np.tile(tB, (1, 1)) for i in range(nfaces)])
-    tA00 = np.array([np.tile(tA00, (1, 1)) for i in range(nfaces)])
-    tA11 = np.array([np.tile(tA11, (1, 1)) for i in range(nfaces)])
-    tA0110 = np.array([np.tile(tA0110,(1, 1)) for i in range(nfaces)])
+                       [-0.5, 0.5, 0.0]], dtype=dtype).ravel()
 
-    # Compute vertex coordinates and a difference vector for each triangle:
+    # Compute a difference vector for each triangle:
     v1 = points[faces[:, 0], :]
-    v2 = points[faces[:, 1], :]
-    v3 = points[faces[:, 2], :]
-    v2mv1 = v2 - v1
-    v3mv1 = v3 - v1
+    v2mv1 = points[faces[:, 1], :] - v1
+    v3mv1 = points[faces[:, 2], :] - v1
 
-    def reshape_and_repeat(A):
-        """
-        For a given 1-D array A, run the MATLAB code below.
-
-            M = reshape(M,1,1,nfaces);
-            M = repmat(M,3,3);
-
-        Please note that a0 is a 3-D matrix, but the 3rd index in NumPy
-        is the 1st index in MATLAB.  Fortunately, nfaces is the size of A.
-
-        """
-        return np.array([np.ones((3,3))*x for x in A])
-
-    # Compute length^2 of v3mv1 for each triangle:
-    a0 = np.sum(v3mv1 * v3mv1, axis=1)
-    a0 = reshape_and_repeat(a0)
-
-    # Compute length^2 of v2mv1 for each triangle:
-    a1 = np.sum(v2mv1 * v2mv1, axis=1)
-    a1 = reshape_and_repeat(a1)
-
-    # Compute dot product (v2mv1*v3mv1) for each triangle:
-    a0110 = np.sum(v2mv1 * v3mv1, axis=1)
-    a0110 = reshape_and_repeat(a0110)
+    # Compute length^2 of v3mv1, length^2 of v2mv1, and dot product
+    # (v2mv1*v3mv1) for each triangle (as columns to broadcast):
+    a0 = np.sum(v3mv1 * v3mv1, axis=1)[:, np.newaxis]
+    a1 = np.sum(v2mv1 * v2mv1, axis=1)[:, np.newaxis]
+    a0110 = np.sum(v2mv1 * v3mv1, axis=1)[:, np.newaxis]
 
     # Compute cross product and 2*vol for each triangle:
     cr  = np.cross(v2mv1,v3mv1)
     vol = np.sqrt(np.sum(cr*cr, axis=1))
     # zero vol will cause division by zero below, so set to small value:
-    vol_mean = 0.001*np.mean(vol)
-    vol = [vol_mean if x == 0 else x for x in vol]
-    vol = reshape_and_repeat(vol)
+    if vol.size:
+        vol[vol == 0] = 0.001*np.mean(vol)
+    vol = vol[:, np.newaxis]
 
-    # Construct all local A and B matrices (guess: for each triangle):
+    # Construct all local A and B matrices (for each triangle):
     localB = vol * tB
     localA = (1.0/vol) * (a0*tA00 + a1*tA11 - a0110*tA0110)
 
-    # Construct row and col indices.
-    # (Note: J in numpy is I in MATLAB after flattening,
-    #  because numpy is row-major while MATLAB is column-major.)
-    J = np.array([np.tile(x, (3,1)) for x in faces])
-    I = np.array([np.transpose(np.tile(x, (3,1))) for x in faces])
+    return localA, localB
+
 
-    # Flatten arrays and swap I and J:
-    J_new = I.flatten()
-    I_new = J.flatten()
-    localA = localA.flatten()
-    localB = localB.flatten()
+def assemble_AB(faces, localA, localB, npoints=None):
+    """
+    Assemble Laplace-Beltrami matrices from local (per-face) entries.
 
-    # Construct sparse matrix:
-    A = sparse.csr_matrix((localA, (I_new, J_new)))
-    B = sparse.csr_matrix((localB, (I_new, J_new)))
+    Parameters
+    ----------
+    faces : list of lists of 3 integers
+        each list contains indices to vertices that form a triangle on a mesh
+    localA : numpy array of floats
+        nine local stiffness matrix entries for each face (see local_AB())
+    localB : numpy array of floats
+        nine local mass matrix entries for each face (see local_AB())
+    npoints : integer (or None)
+        number of rows and columns (None: one more than the largest index)
+
+    Returns
+    -------
+    A : csr_matrix
+    B : csr_matrix
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> from mindboggle.shapes.laplace_beltrami import local_AB, assemble_AB
+    >>> points = [[0,0,0], [1,0,0], [0,1,0], [1,1,0]]
+    >>> faces = [[0,1,2], [1,3,2]]
+    >>> localA, localB = local_AB(points, faces)
+    >>> A, B = assemble_AB(faces, localA, localB)
+    >>> [float(x) for x in A.diagonal()]
+    [1.0, 1.0, 1.0, 1.0]
+
+    """
+    import numpy as np
+    from scipy import sparse
+
+    faces = np.asarray(faces, dtype=int).reshape(-1, 3)
+    if npoints is None:
+        npoints = int(faces.max()) + 1 if faces.size else 0
+
+    # Row and column indices of the local entries:
+    # (entry (r, c) of a face's local matrix goes to (face[c], face[r])):
+    index_type = np.int32 if npoints < 2**31 else np.int64
+    rows = np.empty((len(faces), 9), dtype=index_type)
+    cols = np.empty((len(faces), 9), dtype=index_type)
+    rows[...] = faces[:, [0, 1, 2, 0, 1, 2, 0, 1, 2]]
+    cols[...] = faces[:, [0, 0, 0, 1, 1, 1, 2, 2, 2]]
+    rows = rows.ravel()
+    cols = cols.ravel()
+
+    # Construct sparse matrices (summing entries shared by faces):
+    A = sparse.coo_matrix((np.ravel(localA), (rows, cols)),
+                          shape=(npoints, npoints)).tocsr()
+    B = sparse.coo_matrix((np.ravel(localB), (rows, cols)),
+                          shape=(npoints, npoints)).tocsr()
 
     return A, B
 
 
+def cached_local_AB(points, faces, dtype='float64', max_cached=4,
+                    verbose=False):
+    """
+    Compute (or reuse) the local (per-face) FEM entries of a surface mesh.
+
+    local_AB() entries for the whole mesh are kept in an in-process cache
+    keyed by a hash of the mesh (points, faces) and dtype, so that repeated
+    calls in the same Python process (such as spectrum_per_label() for
+    labels and then for sulci of one surface) compute them once.
+    Separate processes do not share the cache: in the mindboggle
+    command-line pipeline, the labels and sulci spectra nodes may run in
+    different processes, and each then computes the entries (a fraction of
+    a second for a few hundred thousand faces).  The least recently used
+    entries are dropped when there are more than max_cached.
+
+    Parameters
+    ----------
+    points : list of lists of 3 floats
+        x,y,z coordinates for each vertex
+    faces : list of lists of 3 integers
+        each list contains indices to vertices that form a triangle on a mesh
+    dtype : string
+        floating-point type of the local entries
+    max_cached : integer
+        maximum number of meshes to keep in the cache
+    verbose : bool
+        print statements?
+
+    Returns
+    -------
+    localA : numpy array of floats
+        nine local stiffness matrix entries for each face (do not modify)
+    localB : numpy array of floats
+        nine local mass matrix entries for each face (do not modify)
+
+    Examples
+    --------
+    >>> from mindboggle.shapes.laplace_beltrami import cached_local_AB
+    >>> points = [[0,0,0], [1,0,0], [0,1,0], [1,1,0]]
+    >>> faces = [[0,1,2], [1,3,2]]
+    >>> localA1, localB1 = cached_local_AB(points, faces)
+    >>> localA2, localB2 = cached_local_AB(points, faces)
+    >>> localA1 is localA2
+    True
+
+    """
+    import hashlib
+    import numpy as np
+
+    from mindboggle.shapes.laplace_beltrami import local_AB
+
+    mesh_hash = hashlib.sha1()
+    for array in (points, faces):
+        array = np.ascontiguousarray(array)
+        mesh_hash.update(str((array.dtype, array.shape)).encode())
+        mesh_hash.update(array.tobytes())
+    key = (mesh_hash.hexdigest(), dtype)
+
+    if key in _local_AB_cache:
+        if verbose:
+            print('Reuse cached local FEM entries')
+        _local_AB_cache.move_to_end(key)
+        return _local_AB_cache[key]
+
+    _local_AB_cache[key] = local_AB(points, faces, dtype)
+    while len(_local_AB_cache) > max_cached:
+        _local_AB_cache.popitem(last=False)
+
+    return _local_AB_cache[key]
+
+
+def factorize_AB(A, B, sigma=-0.01):
+    """
+    Factor the shifted matrix A - sigma*B for shift-invert eigensolving.
+
+    The factor can be reused to solve the generalized eigenvalue problem
+    A x = lambda B x for more eigenvalues (a larger spectrum_size) of the
+    same mesh, or as a preconditioner for LOBPCG (see eigensolve_AB()).
+    A sparse Cholesky factor is used if scikit-sparse is installed
+    (A - sigma*B is symmetric positive definite for sigma < 0),
+    otherwise a sparse LU (splu) factor.
+
+    Parameters
+    ----------
+    A : csr_matrix
+        stiffness matrix (see computeAB())
+    B : csr_matrix
+        mass matrix (see computeAB())
+    sigma : float
+        shift
+
+    Returns
+    -------
+    factor : LinearOperator
+        applies the inverse of A - sigma*B (with attribute sigma)
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> from mindboggle.shapes.laplace_beltrami import computeAB
+    >>> from mindboggle.shapes.laplace_beltrami import factorize_AB
+    >>> points = [[0,0,0], [0,1,0], [1,1,0], [1,0,0],
+    ...           [0,0,1], [0,1,1], [1,1,1], [1,0,1]]
+    >>> faces = [[0,1,2], [2,3,0], [4,5,6], [6,7,4], [0,4,7], [7,3,0],
+    ...          [0,4,5], [5,1,0], [1,5,6], [6,2,1], [3,7,6], [6,2,3]]
+    >>> A, B = computeAB(points, faces)
+    >>> factor = factorize_AB(A, B)
+    >>> x = np.ones(8)
+    >>> bool(np.allclose((A + 0.01 * B).dot(factor.matvec(x)), x))
+    True
+
+    """
+    from scipy.sparse.linalg import LinearOperator, splu
+
+    C = (A - sigma * B).tocsc()
+    try:
+        from sksparse.cholmod import cholesky
+        solve = cholesky(C).solve_A
+    except ImportError:
+        solve = splu(C).solve
+
+    factor = LinearOperator(C.shape, matvec=solve, matmat=solve,
+                            dtype=C.dtype)
+    factor.sigma = sigma
+
+    return factor
+
+
+def eigensolve_AB(A, B, spectrum_size=10, solver='auto', factor=None,
+                  init_vectors=None, sigma=-0.01, dense_max=500,
+                  maxiter=200, verbose=False):
+    """
+    Solve A x = lambda B x for the smallest eigenvalues.
+
+    Solvers:
+        - "shift-invert": ARPACK (eigsh) in shift-invert mode around sigma,
+          with an explicit (and reusable) factor of A - sigma*B
+        - "lobpcg": LOBPCG preconditioned by the factor if given
+          (otherwise by the inverse diagonal of A - sigma*B),
+          warm-started from init_vectors if given
+        - "dense": dense generalized eigh, for tiny meshes
+        - "auto": "dense" for at most dense_max vertices (or if the dense
+          solver fails because B is singular, such as for vertices
+          in no face), otherwise "shift-invert"; "auto" never selects
+          "lobpcg", which is less accurate and left to callers
+          as a fallback (see fem_laplacian())
+
+    Parameters
+    ----------
+    A : csr_matrix
+        stiffness matrix (see computeAB())
+    B : csr_matrix
+        mass matrix (see computeAB())
+    spectrum_size : integer
+        number of eigenvalues to be computed
+    solver : string
+        "auto", "shift-invert", "lobpcg", or "dense"
+    factor : LinearOperator (or None)
+        factor from factorize_AB() or a previous call, to be reused
+    init_vectors : numpy array (or None)
+        initial eigenvectors for "lobpcg" (such as those from a previous
+        call), one column per eigenvector; columns are added or dropped
+        to match spectrum_size
+    sigma : float
+        shift for a new factor
+    dense_max : integer
+        maximum number of vertices to use the "dense" solver for "auto"
+    maxiter : integer
+        maximum number of "lobpcg" iterations
+    verbose : bool
+        print statements?
+
+    Returns
+    -------
+    eigenvalues : numpy array of floats
+        spectrum_size smallest eigenvalues, in increasing order
+    eigenvectors : numpy array of floats
+        corresponding eigenvectors, one column per eigenvalue
+    factor : LinearOperator (or None)
+        factor used by "shift-invert" or "lobpcg" (for reuse)
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> from mindboggle.shapes.laplace_beltrami import computeAB
+    >>> from mindboggle.shapes.laplace_beltrami import eigensolve_AB
+    >>> points = [[0,0,0], [0,1,0], [1,1,0], [1,0,0],
+    ...           [0,0,1], [0,1,1], [1,1,1], [1,0,1]]
+    >>> faces = [[0,1,2], [2,3,0], [4,5,6], [6,7,4], [0,4,7], [7,3,0],
+    ...          [0,4,5], [5,1,0], [1,5,6], [6,2,1], [3,7,6], [6,2,3]]
+    >>> A, B = computeAB(points, faces)
+    >>> values, vectors, factor = eigensolve_AB(A, B, 3, 'dense')
+    >>> [round(float(x), 5) for x in values[1::]]
+    [4.58359, 4.8]
+    >>> values, vectors, factor = eigensolve_AB(A, B, 3, 'shift-invert')
+    >>> [round(float(x), 5) for x in values[1::]]
+    [4.58359, 4.8]
+    >>> # Reuse the factor for a longer spectrum:
+    >>> values, vectors, factor = eigensolve_AB(A, B, 4, 'shift-invert',
+    ...                                         factor)
+    >>> [round(float(x), 5) for x in values[1::]]
+    [4.58359, 4.8, 4.8]
+
+    """
+    import numpy as np
+    from scipy.sparse.linalg import eigsh, lobpcg, LinearOperator
+
+    from mindboggle.shapes.laplace_beltrami import factorize_AB
+
+    npoints = A.shape[0]
+    auto = solver == 'auto'
+    if auto:
+        if npoints <= dense_max:
+            solver = 'dense'
+        else:
+            solver = 'shift-invert'
+    if factor is not None and factor.shape[0] != npoints:
+        raise ValueError("The factor does not match the {0} vertices.".
+                         format(npoints))
+
+    # ------------------------------------------------------------------------
+    # Dense generalized eigensolver for tiny meshes:
+    # ------------------------------------------------------------------------
+    if solver == 'dense':
+        from scipy.linalg import eigh
+
+        try:
+            eigenvalues, eigenvectors = eigh(A.toarray(), B.toarray(),
+                subset_by_index=[0, spectrum_size - 1])
+        except np.linalg.LinAlgError:
+            if not auto:
+                raise
+            if verbose:
+                print("dense eigensolver failed. Now try shift-invert.")
+            solver = 'shift-invert'
+
+    # ------------------------------------------------------------------------
+    # Shift-invert ARPACK eigensolver with an explicit factor:
+    # ------------------------------------------------------------------------
+    if solver == 'shift-invert':
+        # Martin Reuter: "small sigma shift helps prevent numerical
+        #   instabilities with zero eigenvalue"
+        if factor is None:
+            factor = factorize_AB(A, B, sigma)
+        eigenvalues, eigenvectors = eigsh(A, k=spectrum_size, M=B,
+                                          sigma=factor.sigma, OPinv=factor)
+
+    # ------------------------------------------------------------------------
+    # Preconditioned, warm-started LOBPCG eigensolver:
+    # ------------------------------------------------------------------------
+    elif solver == 'lobpcg':
+        if verbose:
+            print("Warning: lobpcg can produce different results from "
+                  "Reuter (2006) shapeDNA-tria software.")
+
+        # Initial eigenvector values:
+        if init_vectors is None:
+            init_vectors = np.random.random((npoints, spectrum_size))
+        else:
+            init_vectors = np.asarray(init_vectors, dtype=float)
+            init_vectors = init_vectors.reshape(npoints, -1)[:, :spectrum_size]
+            nmissing = spectrum_size - init_vectors.shape[1]
+            if nmissing > 0:
+                init_vectors = np.hstack((init_vectors,
+                    np.random.random((npoints, nmissing))))
+
+        # Preconditioner:
+        if factor is not None:
+            preconditioner = factor
+        else:
+            diagonal = (A - sigma * B).diagonal()
+            inverse = 1.0 / np.where(diagonal > 0, diagonal, 1.0)
+            preconditioner = LinearOperator((npoints, npoints),
+                matvec=lambda x: inverse * x.ravel(),
+                matmat=lambda x: inverse[:, np.newaxis] * x,
+                dtype=A.dtype)
+
+        eigenvalues, eigenvectors = lobpcg(A, init_vectors, B=B,
+                                           M=preconditioner, largest=False,
+                                           maxiter=maxiter)
+        # Extract the real parts:
+        eigenvalues = eigenvalues.real
+    elif solver != 'dense':
+        raise ValueError("Unknown eigensolver: {0}".format(solver))
+
+    # The eigenvalues are not always sorted:
+    order = np.argsort(eigenvalues, kind='mergesort')
+
+    return eigenvalues[order], eigenvectors[:, order], factor
+
+
 def area_normalize(points, faces, spectrum):
     """
     Normalize a spectrum using areas as suggested in Reuter et al. (2006)
@@ -347,7 +706,8 @@ def wesd(EVAL1, EVAL2, Vol1, Vol2, show_error=False, N=3):
 
 
 def fem_laplacian(points, faces, spectrum_size=10, normalization="areaindex",
-                  verbose=False):
+                  verbose=False, local_entries=None, solver='auto',
+                  factor=None, return_factor=False):
     """
     Compute linear finite-element method Laplace-Beltrami spectrum
     after Martin Reuter's MATLAB code.
@@ -416,11 +776,25 @@ def fem_laplacian(points, faces, spectrum_size=10, normalization="areaindex",
         if "areaindex", do both (default)
     verbose : bool
         print statements?
+    local_entries : tuple of two numpy arrays (or None)
+        local_AB() entries (localA, localB) for faces, if already computed
+        (for example, selected from the entries of a whole surface)
+    solver : string
+        eigensolver: "auto", "shift-invert", "lobpcg", or "dense"
+        (see eigensolve_AB(); "lobpcg" is tried if another solver fails,
+        including for a singular mass matrix B)
+    factor : LinearOperator (or None)
+        factor of the shifted stiffness matrix from a previous call
+        with return_factor=True, to be reused (see factorize_AB())
+    return_factor : bool
+        also return the factor?
 
     Returns
     -------
     spectrum : list
         first spectrum_size eigenvalues for Laplace-Beltrami spectrum
+    factor : LinearOperator (or None)
+        factor used by the eigensolver (if return_factor)
 
     Examples
     --------
@@ -439,6 +813,26 @@ def fem_laplacian(points, faces, spectrum_size=10, normalization="areaindex",
     ...                          normalization="area", verbose=False)
     >>> [np.float("{0:.{1}f}".format(x, 5)) for x in spectrum[1::]]
     [27.50155, 28.8]
+    >>> # Extend the spectrum, reusing the shift-invert factor:
+    >>> spectrum, factor = fem_laplacian(points, faces, spectrum_size=3,
+    ...     normalization=None, solver='shift-invert', return_factor=True)
+    >>> spectrum = fem_laplacian(points, faces, spectrum_size=4,
+    ...     normalization=None, solver='shift-invert', factor=factor)
+    >>> [round(x, 5) for x in spectrum[1::]]
+    [4.58359, 4.8, 4.8]
+    >>> # A grid with a vertex in no face (a singular mass matrix),
+    >>> # for which the dense and shift-invert solvers fail:
+    >>> nx, ny = 10, 8
+    >>> points = [[x, y, 0] for y in range(ny) for x in range(nx)]
+    >>> faces = [[y*nx+x, y*nx+x+1, (y+1)*nx+x] for y in range(ny-1)
+    ...          for x in range(nx-1)]
+    >>> faces += [[y*nx+x+1, (y+1)*nx+x+1, (y+1)*nx+x] for y in range(ny-1)
+    ...           for x in range(nx-1)]
+    >>> faces = [x for x in faces if 15 not in x]
+    >>> spectrum = fem_laplacian(points, faces, spectrum_size=4,
+    ...                          normalization=None, verbose=False)
+    >>> [round(x, 4) for x in spectrum[1::]]
+    [0.0916, 0.2127, 0.2941]
     >>> # Spectrum for entire left hemisphere of Twins-2-1:
     >>> from mindboggle.mio.vtks import read_vtk
     >>> from mindboggle.mio.fetch_data import prep_tests
@@ -465,56 +859,44 @@ def fem_laplacian(points, faces, spectrum_size=10, normalization="areaindex",
     [2.69259, 8.97865, 20.44857, 32.74477, 36.739]
 
     """
-    from scipy.sparse.linalg import eigsh, lobpcg
-    import numpy as np
-
-    from mindboggle.shapes.laplace_beltrami import computeAB
+    from numpy.linalg import LinAlgError
+    from mindboggle.shapes.laplace_beltrami import computeAB, assemble_AB, \
+        eigensolve_AB
 
     # ----------------------------------------------------------------
     # Compute A and B matrices (from Reuter et al., 2009):
     # ----------------------------------------------------------------
-    A, B = computeAB(points, faces)
+    if local_entries is None:
+        A, B = computeAB(points, faces)
+    else:
+        A, B = assemble_AB(faces, local_entries[0], local_entries[1])
     if A.shape[0] <= spectrum_size:
         if verbose:
             print("The 3D shape has too few vertices ({0} <= {1}). Skip.".
                   format(A.shape[0], spectrum_size))
+        if return_factor:
+            return None, factor
         return None
 
     # ----------------------------------------------------------------
-    # Use the eigsh eigensolver:
+    # Use the chosen eigensolver:
     # ----------------------------------------------------------------
-    try :
-
-        # eigs is for nonsymmetric matrices while
-        # eigsh is for real-symmetric or complex-Hermitian matrices:
-        # Martin Reuter: "small sigma shift helps prevent numerical
-        #   instabilities with zero eigenvalue"
-        eigenvalues, eigenvectors = eigsh(A, k=spectrum_size, M=B,
-                                          sigma=-0.01)
-        spectrum = eigenvalues.tolist()
+    try:
+        eigenvalues, eigenvectors, factor = eigensolve_AB(A, B,
+            spectrum_size, solver, factor, verbose=verbose)
 
     # ----------------------------------------------------------------
     # Use the lobpcg eigensolver:
     # ----------------------------------------------------------------
-    except RuntimeError:     
-           
+    except (RuntimeError, LinAlgError):
+        if solver == 'lobpcg':
+            raise
         if verbose:
-            print("eigsh() failed. Now try lobpcg.")
-            print("Warning: lobpcg can produce different results from "
-                  "Reuter (2006) shapeDNA-tria software.")
-        # Initial eigenvector values:
-        init_eigenvecs = np.random.random((A.shape[0], spectrum_size))
+            print("{0} eigensolver failed. Now try lobpcg.".format(solver))
+        eigenvalues, eigenvectors, factor = eigensolve_AB(A, B,
+            spectrum_size, 'lobpcg', verbose=verbose)
 
-        # maxiter = 40 forces lobpcg to use 20 iterations.
-        # Strangely, largest=false finds largest eigenvalues
-        # and largest=True gives the smallest eigenvalues:
-        eigenvalues, eigenvectors = lobpcg(A, init_eigenvecs, B=B,
-                                           largest=True, maxiter=40)
-        # Extract the real parts:
-        spectrum = [value.real for value in eigenvalues]
-
-        # For some reason, the eigenvalues from lobpcg are not sorted:
-        spectrum.sort()
+    spectrum = eigenvalues.tolist()
 
     # ----------------------------------------------------------------
     # Normalize by area:
@@ -539,11 +921,14 @@ def fem_laplacian(points, faces, spectrum_size=10, normalization="areaindex",
         if verbose:
             print("Compute linear FEM Laplace-Beltrami spectrum")
 
+    if return_factor:
+        return spectrum, factor
     return spectrum
 
 
 def spectrum_of_largest(points, faces, spectrum_size=10, exclude_labels=[-1],
-                        normalization="areaindex", areas=None, verbose=False):
+                        normalization="areaindex", areas=None, verbose=False,
+                        local_entries=None):
     """
     Compute Laplace-Beltrami spectrum on largest connected segment.
 
@@ -570,6 +955,8 @@ def spectrum_of_largest(points, faces, spectrum_size=10, exclude_labels=[-1],
         surface area scalar values for all vertices
     verbose : bool
         print statements?
+    local_entries : tuple of two numpy arrays (or None)
+        local_AB() entries (localA, localB) for faces, if already computed
 
     Returns
     -------
@@ -637,8 +1024,11 @@ def spectrum_of_largest(points, faces, spectrum_size=10, exclude_labels=[-1],
         # --------------------------------------------------------------------
         # Select the largest segment (connected set of indices):
         # --------------------------------------------------------------------
-        points, faces = select_largest(points, faces, exclude_labels, areas,
-                                       reindex=True)
+        points, faces, face_indices = select_largest(points, faces,
+            exclude_labels, areas, reindex=True, return_face_indices=True)
+        if local_entries is not None:
+            local_entries = (local_entries[0][face_indices],
+                             local_entries[1][face_indices])
 
         # Alert if the number of indices is small:
         if len(points) < min_points_faces:
@@ -651,7 +1041,7 @@ def spectrum_of_largest(points, faces, spectrum_size=10, exclude_labels=[-1],
             # Compute spectrum:
             # ----------------------------------------------------------------
             spectrum = fem_laplacian(points, faces, spectrum_size,
-                                     normalization, verbose)
+                                     normalization, verbose, local_entries)
             return spectrum
         else:
             return None
@@ -726,7 +1116,7 @@ def spectrum_from_file(vtk_file, spectrum_size=10, exclude_labels=[-1],
 
 def spectrum_per_label(vtk_file, spectrum_size=10, exclude_labels=[-1],
                        normalization='areaindex', area_file='',
-                       largest_segment=True, verbose=False):
+                       largest_segment=True, verbose=False, n_jobs=1):
     """
     Compute Laplace-Beltrami spectrum per labeled region in a file.
 
@@ -750,6 +1140,10 @@ def spectrum_per_label(vtk_file, spectrum_size=10, exclude_labels=[-1],
         compute spectrum only for largest segment with a given label?
     verbose : bool
         print statements?
+    n_jobs : integer
+        number of worker processes for computing spectra of separate labels,
+        largest labels first, with one BLAS thread each
+        (None or < 1: use all processors)
 
     Returns
     -------
@@ -781,10 +1175,12 @@ def spectrum_per_label(vtk_file, spectrum_size=10, exclude_labels=[-1],
     [1029, 1005, 1011, 1021, 1008, 1025, 999, 1013, 1007, 1022]
 
     """
+    import os
+    import numpy as np
+
     from mindboggle.mio.vtks import read_vtk, read_scalars
-    from mindboggle.guts.mesh import keep_faces, reindex_faces_points
-    from mindboggle.shapes.laplace_beltrami import fem_laplacian,\
-        spectrum_of_largest
+    from mindboggle.shapes.laplace_beltrami import spectrum_of_faces, \
+        cached_local_AB
 
     # Read VTK surface mesh file:
     points, indices, lines, faces, labels, scalar_names, npoints, \
@@ -796,43 +1192,194 @@ def spectrum_per_label(vtk_file, spectrum_size=10, exclude_labels=[-1],
     else:
         areas = None
 
+    # ------------------------------------------------------------------------
+    # Compute the local (per-face) stiffness and mass entries once for the
+    # whole surface (they do not depend on labels); each label's A and B
+    # matrices are assembled from the entries of the label's faces:
+    # ------------------------------------------------------------------------
+    localA, localB = cached_local_AB(points, faces, verbose=verbose)
+
+    # Group faces by label (faces whose three vertices share a label),
+    # keeping the order of faces within each label:
+    labels_array = np.asarray(labels)
+    faces_array = np.reshape(faces, (-1, 3))
+    face_labels = labels_array[faces_array]
+    labeled = (face_labels[:, 0] == face_labels[:, 1]) & \
+              (face_labels[:, 0] == face_labels[:, 2]) & \
+              (faces_array[:, 0] != faces_array[:, 1]) & \
+              (faces_array[:, 1] != faces_array[:, 2]) & \
+              (faces_array[:, 0] != faces_array[:, 2])
+    labeled_faces = np.nonzero(labeled)[0]
+    order = np.argsort(face_labels[labeled_faces, 0], kind='mergesort')
+    labeled_faces = labeled_faces[order]
+    face_label_values, face_starts, face_counts = \
+        np.unique(face_labels[labeled_faces, 0], return_index=True,
+                  return_counts=True)
+
+    # Unique labels in order of appearance, and their numbers of vertices:
+    label_values, first_indices, label_counts = \
+        np.unique(labels_array, return_index=True, return_counts=True)
+    label_order = np.argsort(first_indices)
+
     # Loop through labeled regions:
-    ulabels = []
-    [ulabels.append(int(x)) for x in labels if x not in ulabels
-     if x not in exclude_labels]
     label_list = []
-    spectrum_lists = []
-    for label in ulabels:
+    label_faces = []
+    for ilabel in label_order:
+        label = label_values[ilabel]
+        if label in exclude_labels:
+            continue
+        label = int(label)
       #if label == 22:
       #  print("DEBUG: COMPUTE FOR ONLY ONE LABEL")
 
-        # Determine the indices per label:
-        Ilabel = [i for i,x in enumerate(labels) if x == label]
+        # Determine the number of indices per label:
         if verbose:
-          print('{0} vertices for label {1}'.format(len(Ilabel), label))
+          print('{0} vertices for label {1}'.format(label_counts[ilabel],
+                                                    label))
 
         # Remove background faces:
-        pick_faces = keep_faces(faces, Ilabel)
-        pick_faces, pick_points, o1 = reindex_faces_points(pick_faces, points)
-
-        # Compute Laplace-Beltrami spectrum for the label:
-        if largest_segment:
-            exclude_labels_inner = [-1]
-            spectrum = spectrum_of_largest(pick_points, pick_faces,
-                                           spectrum_size,
-                                           exclude_labels_inner,
-                                           normalization, areas, verbose)
+        iface = np.searchsorted(face_label_values, label)
+        if iface < len(face_label_values) and \
+                face_label_values[iface] == label:
+            face_indices = labeled_faces[face_starts[iface]:
+                                         face_starts[iface] +
+                                         face_counts[iface]]
         else:
-            spectrum = fem_laplacian(pick_points, pick_faces, spectrum_size,
-                                     normalization, verbose)
-
-        # Append to a list of lists of spectra:
-        spectrum_lists.append(spectrum)
+            face_indices = labeled_faces[0:0]
+        label_faces.append(face_indices)
         label_list.append(label)
 
+    # ------------------------------------------------------------------------
+    # Compute Laplace-Beltrami spectrum for each label:
+    # ------------------------------------------------------------------------
+    if n_jobs is None or n_jobs < 1:
+        n_jobs = os.cpu_count() or 1
+    n_jobs = min(n_jobs, len(label_list))
+
+    if n_jobs > 1:
+        import multiprocessing as mp
+        from mindboggle.guts.utilities import share_arrays, release_arrays
+
+        # Share the surface arrays and local entries with the workers:
+        arrays = {'points': np.asarray(points, dtype=float),
+                  'faces': faces_array, 'localA': localA, 'localB': localB}
+        if areas is not None:
+            arrays['areas'] = np.asarray(areas)
+        specs, blocks = share_arrays(arrays)
+        try:
+            # Start the largest labels first (longest processing time
+            # first), and collect spectra in label order:
+            with mp.Pool(n_jobs, initializer=_mp_spectra_init,
+                         initargs=(specs,)) as pool:
+                results = {}
+                for i in np.argsort([len(x) for x in label_faces],
+                                    kind='mergesort')[::-1]:
+                    results[i] = pool.apply_async(_mp_spectra_worker,
+                        args=(label_faces[i], spectrum_size, normalization,
+                              largest_segment, verbose))
+                spectrum_lists = [results[i].get()
+                                  for i in range(len(label_list))]
+        finally:
+            release_arrays(blocks)
+    else:
+        spectrum_lists = [spectrum_of_faces(points, faces_array, x,
+                                            (localA, localB), spectrum_size,
+                                            normalization, areas,
+                                            largest_segment, verbose)
+                          for x in label_faces]
+
     return spectrum_lists, label_list
 
 
+def spectrum_of_faces(points, faces, face_indices, local_entries,
+                      spectrum_size=10, normalization='areaindex',
+                      areas=None, largest_segment=True, verbose=False):
+    """
+    Compute Laplace-Beltrami spectrum of a subset of a surface's faces.
+
+    (See spectrum_per_label().)
+
+    Parameters
+    ----------
+    points : list of lists of 3 floats
+        x,y,z coordinates for each vertex of the surface
+    faces : numpy array of integers
+        3 indices to vertices for each face of the surface
+    face_indices : numpy array of integers
+        indices to the faces of the subset (such as a labeled region)
+    local_entries : tuple of two numpy arrays
+        local_AB() entries (localA, localB) for all faces of the surface
+    spectrum_size : integer
+        number of eigenvalues to be computed (the length of the spectrum)
+    normalization : string
+        the method used to normalize eigenvalues (see fem_laplacian())
+    areas : numpy array or list of floats (or None)
+        surface area scalar values for all vertices
+    largest_segment :  bool
+        compute spectrum only for largest segment of the subset?
+    verbose : bool
+        print statements?
+
+    Returns
+    -------
+    spectrum : list
+        first spectrum_size eigenvalues for Laplace-Beltrami spectrum
+
+    Examples
+    --------
+    >>> # See spectrum_per_label().
+
+    """
+    from mindboggle.guts.mesh import reindex_faces_points
+    from mindboggle.shapes.laplace_beltrami import fem_laplacian,\
+        spectrum_of_largest
+
+    # Remove background faces:
+    pick_faces = faces[face_indices].tolist()
+    pick_faces, pick_points, o1 = reindex_faces_points(pick_faces, points)
+    local_entries = (local_entries[0][face_indices],
+                     local_entries[1][face_indices])
+
+    # Compute Laplace-Beltrami spectrum for the faces:
+    if largest_segment:
+        exclude_labels_inner = [-1]
+        spectrum = spectrum_of_largest(pick_points, pick_faces,
+                                       spectrum_size,
+                                       exclude_labels_inner,
+                                       normalization, areas, verbose,
+                                       local_entries)
+    else:
+        spectrum = fem_laplacian(pick_points, pick_faces, spectrum_size,
+                                 normalization, verbose, local_entries)
+
+    return spectrum
+
+
+# Surface arrays shared with spectrum_per_label's worker processes:
+_mp_spectra_arrays = {}
+
+
+def _mp_spectra_init(specs):
+    from mindboggle.guts.utilities import attach_arrays, limit_blas_threads
+
+    # One BLAS thread per worker (the workers already run in parallel):
+    _mp_spectra_arrays['limits'] = limit_blas_threads(1)
+
+    arrays, handles = attach_arrays(specs)
+    _mp_spectra_arrays.update(arrays)
+    _mp_spectra_arrays['handles'] = handles
+    _mp_spectra_arrays['points'] = arrays['points'].tolist()
+
+
+def _mp_spectra_worker(face_indices, spectrum_size, normalization,
+                       largest_segment, verbose):
+    A = _mp_spectra_arrays
+    return spectrum_of_faces(A['points'], A['faces'], face_indices,
+                             (A['localA'], A['localB']), spectrum_size,
+                             normalization, A.get('areas'), largest_segment,
+                             verbose)
+
+
 # ============================================================================
 # Doctests
 # ============================================================================
@@ -29,6 +29,11 @@ fit_normals_to_histogram():
     This Estimation-Maximization method returns estimated means, sigmas
     (standard deviations) and weights from a distribution of values.
 
+For cohort-scale training, estimate_distribution(..., streaming=True)
+instead reduces each training file to counts of its scalar values
+(sulcus_scalar_counts()), merged across files (merge_value_counts()),
+and fits the distributions to the counts.
+
 
 Authors:
 Yrjo Hame, 2012-2013  .  yrjo.hame@gmail.com
@@ -177,7 +182,8 @@ def compute_likelihood(trained_file, depth_file, curvature_file, folds,
 
 
 def estimate_distribution(scalar_files, scalar_range, fold_files, label_files,
-                          background_value=-1, verbose=False):
+                          background_value=-1, verbose=False, streaming=False,
+                          bin_width=None, n_jobs=1, tol=None):
     """
     Estimate sulcus label border scalar distributions from VTK files.
 
@@ -188,6 +194,15 @@ def estimate_distribution(scalar_files, scalar_range, fold_files, label_files,
 
     Note : The number of classes, k, is currently hard-coded.
 
+    With streaming, the scalar values of each training file are reduced to
+    counts of binned values as soon as they are read, in parallel, so that
+    memory is bounded by the number of distinct values rather than by the
+    number of training files.  Binning moves each value by at most half the
+    bin width, so the fitted means and sigmas differ from those without
+    streaming by about that much at most (see fit_normals_to_histogram());
+    with a bin_width of 0, values are counted exactly and the fitted
+    distributions are the same as without streaming.
+
     Parameters
     ----------
     scalar_files : list of strings
@@ -202,6 +217,17 @@ def estimate_distribution(scalar_files, scalar_range, fold_files, label_files,
         background value
     verbose : bool
         print statements?
+    streaming : bool
+        fit distributions to counts of values accumulated per file?
+    bin_width : float (or None)
+        round values to multiples of bin_width when streaming
+        (None: a thousandth of the extent of scalar_range;
+        0: count exact values)
+    n_jobs : integer
+        number of worker processes reading training files when streaming
+        (None or < 1: use all processors)
+    tol : float (or None)
+        convergence tolerance (see fit_normals_to_histogram())
 
     Returns
     -------
@@ -260,6 +286,11 @@ def estimate_distribution(scalar_files, scalar_range, fold_files, label_files,
     >>> verbose = False
     >>> depth_border, depth_nonborder = estimate_distribution(scalar_files,
     ...     scalar_range, fold_files, label_files, background_value, verbose)
+    >>> depth_border2, depth_nonborder2 = estimate_distribution(scalar_files,
+    ...     scalar_range, fold_files, label_files, background_value, verbose,
+    ...     streaming=True, bin_width=0)
+    >>> bool(np.allclose(depth_border2['means'], depth_border['means']))
+    True
     >>> scalar_files = curv_files
     >>> scalar_range = np.linspace(-1, 1, 101, endpoint=True) # (-1 to 1 by 0.02)
     >>> curv_border, curv_nonborder = estimate_distribution(scalar_files,
@@ -276,23 +307,67 @@ def estimate_distribution(scalar_files, scalar_range, fold_files, label_files,
     ...     open("depth_curv_border_nonborder_parameters.pkl", "wb"))
 
     """
+    import os
+
     from mindboggle.shapes.likelihood import concatenate_sulcus_scalars, \
-        fit_normals_to_histogram
+        fit_normals_to_histogram, sulcus_scalar_counts, merge_value_counts
 
     if not scalar_files or not fold_files or not label_files:
         raise IOError("Input file lists cannot be empty.")
 
-    # Concatenate scalars across multiple training files:
-    border_scalars, nonborder_scalars = concatenate_sulcus_scalars(scalar_files,
-        fold_files, label_files, background_value)
+    if streaming:
+        if bin_width is None:
+            bin_width = (max(scalar_range) - min(scalar_range)) / 1000.0
+
+        # Accumulate counts of scalar values, one training file at a time:
+        border_counts = None
+        nonborder_counts = None
+        args = [(scalar_file, fold_files[ifile], label_files[ifile],
+                 background_value, bin_width)
+                for ifile, scalar_file in enumerate(scalar_files)]
+        if n_jobs is None or n_jobs < 1:
+            n_jobs = os.cpu_count() or 1
+        n_jobs = min(n_jobs, len(args))
+        if n_jobs > 1:
+            import multiprocessing as mp
+
+            pool = mp.Pool(n_jobs)
+            results = pool.imap_unordered(_mp_scalar_counts_worker, args)
+        else:
+            pool = None
+            results = (sulcus_scalar_counts(*x) for x in args)
+        try:
+            for border, nonborder in results:
+                border_counts = merge_value_counts(border_counts, border)
+                nonborder_counts = merge_value_counts(nonborder_counts,
+                                                      nonborder)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        # Estimate distribution parameters:
+        border_means, border_sigmas, \
+            border_weights = fit_normals_to_histogram(border_counts[0],
+                scalar_range, verbose, tol, counts=border_counts[1])
+        nonborder_means, nonborder_sigmas, \
+            nonborder_weights = fit_normals_to_histogram(nonborder_counts[0],
+                scalar_range, verbose, tol, counts=nonborder_counts[1])
 
-    # Estimate distribution parameters:
-    border_means, border_sigmas, \
-        border_weights = fit_normals_to_histogram(border_scalars,
-                                                  scalar_range, verbose)
-    nonborder_means, nonborder_sigmas, \
-        nonborder_weights = fit_normals_to_histogram(nonborder_scalars,
-                                                     scalar_range, verbose)
+    else:
+        # Concatenate scalars across multiple training files:
+        border_scalars, nonborder_scalars = concatenate_sulcus_scalars(
+            scalar_files, fold_files, label_files, background_value)
+
+        # Estimate distribution parameters:
+        border_means, border_sigmas, \
+            border_weights = fit_normals_to_histogram(border_scalars,
+                                                      scalar_range, verbose,
+                                                      tol)
+        nonborder_means, nonborder_sigmas, \
+            nonborder_weights = fit_normals_to_histogram(nonborder_scalars,
+                                                         scalar_range,
+                                                         verbose, tol)
 
     # Store outputs in dictionaries:
     border_parameters = {
@@ -411,7 +486,145 @@ def concatenate_sulcus_scalars(scalar_files, fold_files, label_files,
     return border_scalars, nonborder_scalars
 
 
-def fit_normals_to_histogram(data, x, verbose=False):
+def sulcus_scalar_counts(scalar_file, fold_file, label_file,
+                         background_value=-1, bin_width=None):
+    """
+    Count scalar values along and outside sulcus label borders in one file.
+
+    These counts are sufficient statistics for fit_normals_to_histogram(),
+    so training files can be reduced to counts one at a time
+    (see estimate_distribution()).
+
+    Parameters
+    ----------
+    scalar_file : string
+        surface mesh VTK file with scalar values
+    fold_file : string
+        VTK file with fold numbers as scalars (-1 for non-fold vertices)
+    label_file : string
+        VTK file with label numbers (-1 for unlabeled vertices)
+    background_value : integer or float
+        background value
+    bin_width : float (or None)
+        round values to multiples of bin_width (None: count exact values)
+
+    Returns
+    -------
+    border_counts : tuple of two numpy arrays
+        unique scalar values within folds along sulcus label boundaries,
+        and their counts
+    nonborder_counts : tuple of two numpy arrays
+        unique scalar values within folds outside sulcus label boundaries,
+        and their counts
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> from mindboggle.shapes.likelihood import sulcus_scalar_counts
+    >>> from mindboggle.mio.fetch_data import prep_tests
+    >>> urls, fetch_data = prep_tests()
+    >>> depth_file = fetch_data(urls['left_travel_depth'], '', '.vtk')
+    >>> labels_file = fetch_data(urls['left_freesurfer_labels'], '', '.vtk')
+    >>> folds_file = fetch_data(urls['left_folds'], '', '.vtk')
+    >>> border, nonborder = sulcus_scalar_counts(depth_file, folds_file,
+    ...     labels_file, -1, 0.5)
+    >>> [float(x) for x in border[0][0:5]]
+    [0.0, 0.5, 1.0, 1.5, 2.0]
+
+    """
+    from mindboggle.shapes.likelihood import concatenate_sulcus_scalars, \
+        value_counts
+
+    border_scalars, nonborder_scalars = concatenate_sulcus_scalars(
+        [scalar_file], [fold_file], [label_file], background_value)
+
+    return value_counts(border_scalars, bin_width), \
+           value_counts(nonborder_scalars, bin_width)
+
+
+def value_counts(values, bin_width=None):
+    """
+    Count unique (binned) values.
+
+    Parameters
+    ----------
+    values : list or numpy array of floats
+        values to count
+    bin_width : float (or None)
+        round values to multiples of bin_width (None: count exact values)
+
+    Returns
+    -------
+    unique_values : numpy array of floats
+        unique (binned) values, in increasing order
+    counts : numpy array of integers
+        number of each of unique_values
+
+    Examples
+    --------
+    >>> from mindboggle.shapes.likelihood import value_counts
+    >>> unique_values, counts = value_counts([0.1, 0.3, 0.1, 0.74], 0.5)
+    >>> unique_values.tolist(), counts.tolist()
+    ([0.0, 0.5], [2, 2])
+
+    """
+    import numpy as np
+
+    values = np.asarray(values, dtype=float)
+    if bin_width:
+        values = np.round(values / bin_width) * bin_width
+
+    return np.unique(values, return_counts=True)
+
+
+def merge_value_counts(counts1, counts2):
+    """
+    Merge two sets of counts of unique values from value_counts().
+
+    Parameters
+    ----------
+    counts1 : tuple of two numpy arrays (or None)
+        unique values and their counts (None for no values)
+    counts2 : tuple of two numpy arrays (or None)
+        unique values and their counts (None for no values)
+
+    Returns
+    -------
+    counts : tuple of two numpy arrays (or None)
+        unique values of both and their summed counts
+
+    Examples
+    --------
+    >>> from mindboggle.shapes.likelihood import merge_value_counts
+    >>> values, counts = merge_value_counts(([0.0, 0.5], [2, 2]),
+    ...                                     ([0.5, 1.0], [1, 3]))
+    >>> values.tolist(), counts.tolist()
+    ([0.0, 0.5, 1.0], [2, 3, 3])
+
+    """
+    import numpy as np
+
+    if counts1 is None:
+        return counts2
+    if counts2 is None:
+        return counts1
+
+    unique_values, inverse = np.unique(np.concatenate([counts1[0],
+                                                       counts2[0]]),
+                                       return_inverse=True)
+    counts = np.bincount(np.ravel(inverse),
+                         np.concatenate([counts1[1], counts2[1]]),
+                         minlength=len(unique_values))
+
+    return unique_values, counts.astype(np.asarray(counts1[1]).dtype)
+
+
+def _mp_scalar_counts_worker(args):
+    return sulcus_scalar_counts(*args)
+
+
+def fit_normals_to_histogram(data, x, verbose=False, tol=None,
+                             max_iterations=25, counts=None):
     """
     This Estimation-Maximization method returns estimated means, sigmas
     (standard deviations) and weights, each of length k (number of classes).
@@ -422,6 +635,15 @@ def fit_normals_to_histogram(data, x, verbose=False):
         data to estimate distribution means, sigmas, and weights
     x : list of floats
         range of values used to initialize distribution means and sigmas
+    verbose : bool
+        print statements?
+    tol : float (or None)
+        stop when no mean or sigma changes by more than tol
+        (None: run max_iterations iterations)
+    max_iterations : integer
+        maximum number of iterations
+    counts : list or numpy array of integers (or None)
+        number of times each data value occurs (such as from value_counts())
 
     Returns
     -------
@@ -431,13 +653,40 @@ def fit_normals_to_histogram(data, x, verbose=False):
         estimated standard deviation for each class
     weights : list of floats
         weight for each class
-    verbose : bool
-        print statements?
 
     Examples
     --------
+    Synthetic data with three separated modes, converging on a tolerance:
+
     >>> import numpy as np
     >>> from mindboggle.shapes.likelihood import fit_normals_to_histogram
+    >>> x = np.linspace(0, 1, 51, endpoint=True)
+    >>> rng = np.random.RandomState(0)
+    >>> data = np.concatenate([rng.normal(0.1, 0.03, 300),
+    ...                        rng.normal(0.5, 0.05, 400),
+    ...                        rng.normal(0.9, 0.03, 300)])
+    >>> means, sigmas, weights = fit_normals_to_histogram(data, x, False,
+    ...     tol=1e-6, max_iterations=1000)
+    >>> [round(float(x), 1) for x in sorted(means)]
+    [0.1, 0.5, 0.9]
+    >>> [round(float(x), 2) for x in sorted(weights)]
+    [0.3, 0.3, 0.4]
+
+    Fitting to counts of values rounded to a bin width (as when streaming
+    in estimate_distribution()) changes means and sigmas by less than
+    half the bin width:
+
+    >>> from mindboggle.shapes.likelihood import value_counts
+    >>> values, counts = value_counts(data, 0.01)
+    >>> means2, sigmas2, weights2 = fit_normals_to_histogram(values, x,
+    ...     False, tol=1e-6, max_iterations=1000, counts=counts)
+    >>> bool(np.allclose(means2, means, atol=0.005))
+    True
+    >>> bool(np.allclose(sigmas2, sigmas, atol=0.005))
+    True
+
+    Depth values of a surface mesh:
+
     >>> from mindboggle.mio.vtks import read_scalars
     >>> from mindboggle.mio.fetch_data import prep_tests
     >>> urls, fetch_data = prep_tests()
@@ -452,6 +701,13 @@ def fit_normals_to_histogram(data, x, verbose=False):
     [5.80721, 2.58297, 0.10209]
     >>> [np.float("{0:.{1}f}".format(x, 5)) for x in weights]
     [0.43959, 0.39286, 0.16755]
+    >>> # Fit to counts of unique values:
+    >>> from mindboggle.shapes.likelihood import value_counts
+    >>> values, counts = value_counts(scalars)
+    >>> means2, sigmas2, weights2 = fit_normals_to_histogram(values, x,
+    ...     verbose, counts=counts)
+    >>> bool(np.allclose(means2, means))
+    True
 
     """
     import numpy as np
@@ -460,11 +716,9 @@ def fit_normals_to_histogram(data, x, verbose=False):
     # Initialize variables:
     k = 3
     tiny = 0.000000001
-    probs = np.zeros((len(data), k))
-    W = np.zeros((len(data), k))
+    data = np.asarray(data, dtype=float)
     means = np.zeros(k)
     sigmas = np.zeros(k)
-    weights = np.zeros(k)
 
     # Initialize distribution means and sigmas:
     rangex = max(x) - min(x)
@@ -475,30 +729,36 @@ def fit_normals_to_histogram(data, x, verbose=False):
     if verbose:
         print('Fitting normals to histograms...')
 
-    # Iteratively compute probabilities, weights, means and sigmas:
+    # Iteratively compute probabilities, weights, means and sigmas
+    # (for all classes at once; data x classes):
     iter = 0
-    while iter < 25:
+    while iter < max_iterations:
         iter += 1
 
-        for i in range(k):
-            m1 = 1 / (sigmas[i] * np.sqrt(2*pi) + tiny)
-            m2 = -((data-means[i])**2) / (2 *(sigmas[i]**2) + tiny)
-            probs[:,i] = m1 * np.exp(m2)
+        m1 = 1 / (sigmas * np.sqrt(2*pi) + tiny)
+        differences = data[:, np.newaxis] - means
+        m2 = -(differences**2) / (2 * (sigmas**2) + tiny)
+        probs = m1 * np.exp(m2)
 
-        for i in range(k):
-            W[:,i] = probs[:,i] / (np.sum(probs, axis=1) + tiny)
+        W = probs / (np.sum(probs, axis=1)[:, np.newaxis] + tiny)
+        if counts is not None:
+            W *= np.asarray(counts, dtype=float)[:, np.newaxis]
 
-        for i in range(k):
-            n1 = sum(W[:,i] * (data - means[i])**2)
-            d1 = sum(W[:,i]) + tiny
-            sigmas[i] =  np.sqrt(n1 / d1)
-            means[i] = sum(W[:,i] * data) / d1
+        n1 = np.sum(W * differences**2, axis=0)
+        d1 = np.sum(W, axis=0) + tiny
+        previous = np.concatenate([means, sigmas])
+        sigmas = np.sqrt(n1 / d1)
+        means = np.dot(data, W) / d1
 
         if verbose:
             print('    means: {0}; sigmas: {1}'.format(means, sigmas))
 
-    for i in range(k):
-        weights[i] = sum(W[:,i]) / (np.sum(W) + tiny)
+        if tol is not None and \
+                np.max(np.abs(np.concatenate([means, sigmas]) -
+                              previous)) <= tol:
+            break
+
+    weights = np.sum(W, axis=0) / (np.sum(W) + tiny)
 
     if verbose:
         print('    weights: {0}'.format(weights))
@@ -1,4 +1,6 @@
-from . import zernike
+from .zernike import zernike_moments as zernike
+from .pipelines import PIPELINES, ENGINE_VARIABLE
+from .benchmark import benchmark_engines
 #from .test.multiproc import MultiprocPipeline
 from mindboggle.mio.vtks import read_vtk
 import numpy as np
@@ -39,6 +41,13 @@ def main():
     parser.add_argument('-p', '--profile', nargs='?', default=None, const='stdout')
     parser.add_argument('-t', '--timecall', default=False, action='store_true')
     parser.add_argument('-v', '--validate', default=False, action='store_true')
+    parser.add_argument('-e', '--zernike-engine', default=None,
+                        choices=list(PIPELINES),
+                        help='Zernike pipeline (default: ${0} or '
+                             'default)'.format(ENGINE_VARIABLE))
+    parser.add_argument('-b', '--benchmark', default=False,
+                        action='store_true',
+                        help='time all engines on synthetic meshes')
     ns = parser.parse_args()
 
     if ns.debug is not None:
@@ -53,13 +62,17 @@ def main():
 #    if ns.timecall:
 #        zernike_fn = profilehooks.timecall(zernike_fn)
 
-    if ns.vtk_file is not None:
+    if ns.benchmark:
+        benchmark_engines()
+    elif ns.vtk_file is not None:
         points, indices, lines, faces, depths, scalar_names, npoints, \
             input_vtk = read_vtk(ns.vtk_file)
         print('{0} {1}'.format(len(faces), len(points)))
-        X = zernike_fn(points, faces, order=ns.order, scale_input=True)
+        X = zernike_fn(points, faces, order=ns.order, scale_input=True,
+                       engine=ns.zernike_engine, use_cache=False)
         if ns.validate:
-            Y = zernike_fn(points, faces, order=ns.order, scale_input=True, pl_cls=MultiprocPipeline)
+            Y = zernike_fn(points, faces, order=ns.order, scale_input=True,
+                           engine='serial', use_cache=False)
             assert np.allclose(X, Y)
     else:
         example1()
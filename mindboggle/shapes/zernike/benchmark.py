@@ -0,0 +1,165 @@
+#!/usr/bin/python
+"""
+Time and compare the registered Zernike pipelines (engines).
+
+Copyright 2016,  Mindboggle team (http://mindboggle.info), Apache v2.0 License
+
+"""
+
+
+def sphere_mesh(resolution=8):
+    """
+    Triangulated bumpy sphere for benchmarking.
+
+    Parameters
+    ----------
+    resolution : integer
+        number of latitude bands (there are twice as many longitudes)
+
+    Returns
+    -------
+    points : numpy array of floats
+        x,y,z coordinates for each vertex
+    faces : numpy array of integers
+        3 indices to vertices for each triangle (4 * resolution *
+        (resolution - 1) faces)
+
+    Examples
+    --------
+    >>> from mindboggle.shapes.zernike.benchmark import sphere_mesh
+    >>> points, faces = sphere_mesh(4)
+    >>> points.shape, faces.shape
+    ((26, 3), (48, 3))
+
+    """
+    import numpy as np
+
+    nlat, nlon = resolution, 2 * resolution
+    theta, phi = np.meshgrid(np.arange(1, nlat) * np.pi / nlat,
+                             np.arange(nlon) * 2 * np.pi / nlon,
+                             indexing='ij')
+    radius = 1 + 0.1 * np.sin(3 * theta) * np.cos(2 * phi)
+    ring_points = np.column_stack([(radius * np.sin(theta) *
+                                    np.cos(phi)).ravel(),
+                                   (radius * np.sin(theta) *
+                                    np.sin(phi)).ravel(),
+                                   (radius * np.cos(theta)).ravel()])
+    npoles = len(ring_points)
+    points = np.vstack([ring_points, [[0, 0, 1], [0, 0, -1]]])
+
+    # Faces between rings, and fans around each pole:
+    ring = lambda i: i * nlon + np.arange(nlon)
+    faces = []
+    for i in range(nlat - 2):
+        a, b = ring(i), ring(i + 1)
+        a1, b1 = np.roll(a, -1), np.roll(b, -1)
+        faces.extend(np.column_stack([a, b, b1]).tolist())
+        faces.extend(np.column_stack([a, b1, a1]).tolist())
+    first, last = ring(0), ring(nlat - 2)
+    faces.extend(np.column_stack([np.full(nlon, npoles), first,
+                                  np.roll(first, -1)]).tolist())
+    faces.extend(np.column_stack([np.full(nlon, npoles + 1),
+                                  np.roll(last, -1), last]).tolist())
+
+    return points, np.array(faces)
+
+
+def benchmark_engines(resolutions=(4, 8, 16), orders=(3, 6), engines=None,
+                      reference='serial', max_seconds=30, verbose=True):
+    """
+    Time every registered Zernike engine on meshes of growing size and order.
+
+    Each engine computes zernike_moments() for bumpy spheres of growing
+    resolution, for each order (without cached geometric moments);
+    descriptors are checked against those of the reference engine.  An
+    engine that takes longer than max_seconds is skipped for larger meshes
+    of the same order.
+
+    Parameters
+    ----------
+    resolutions : list of integers
+        sphere_mesh() resolutions, in increasing order
+    orders : list of integers
+        orders of the moments
+    engines : list of strings (or None)
+        names of registered engines (None for all of them)
+    reference : string
+        engine whose descriptors the others are compared with
+    max_seconds : float
+        time after which an engine is not run on larger meshes
+    verbose : bool
+        print a table of times and the fastest engine per mesh?
+
+    Returns
+    -------
+    rows : list of dictionaries
+        "order", "resolution", "faces", "engine", "seconds", and "agree"
+        (whether descriptors match the reference engine's, or None)
+        for each run
+
+    Examples
+    --------
+    >>> from mindboggle.shapes.zernike.benchmark import benchmark_engines
+    >>> rows = benchmark_engines([3], [2], ['serial', 'default'],
+    ...                          verbose=False)
+    >>> [(row['engine'], row['agree']) for row in rows]
+    [('serial', True), ('default', True)]
+
+    """
+    import time
+    import numpy as np
+
+    from mindboggle.shapes.zernike.pipelines import PIPELINES
+    from mindboggle.shapes.zernike.zernike import zernike_moments
+    from mindboggle.shapes.zernike.benchmark import sphere_mesh
+
+    if engines is None:
+        engines = list(PIPELINES)
+    if reference in engines:
+        engines = [reference] + [x for x in engines if x != reference]
+
+    rows = []
+    for order in orders:
+        too_slow = set()
+        for resolution in resolutions:
+            points, faces = sphere_mesh(resolution)
+            descriptors = {}
+            mesh_rows = []
+            for engine in engines:
+                if engine in too_slow:
+                    continue
+                start = time.time()
+                descriptors[engine] = zernike_moments(points, faces, order,
+                                                      engine=engine,
+                                                      use_cache=False)
+                seconds = time.time() - start
+                if seconds > max_seconds:
+                    too_slow.add(engine)
+                agree = None
+                if reference in descriptors:
+                    agree = bool(np.allclose(descriptors[engine],
+                                             descriptors[reference],
+                                             rtol=1e-6, atol=1e-12))
+                mesh_rows.append({'order': order, 'resolution': resolution,
+                                  'faces': len(faces), 'engine': engine,
+                                  'seconds': seconds, 'agree': agree})
+            rows.extend(mesh_rows)
+
+            if verbose:
+                for row in mesh_rows:
+                    print('order {order:3d}  faces {faces:7d}  '
+                          '{engine:>16s}  {seconds:9.4f} s  '
+                          'agree: {agree}'.format(**row))
+                fastest = min(mesh_rows, key=lambda row: row['seconds'])
+                print('order {0:3d}  faces {1:7d}  fastest: {2}'.
+                      format(order, len(faces), fastest['engine']))
+
+    return rows
+
+
+# ============================================================================
+# Doctests
+# ============================================================================
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod(verbose=True)  # py.test --doctest-modules
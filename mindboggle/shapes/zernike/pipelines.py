@@ -1,10 +1,18 @@
 from __future__ import division
 
+import os
+import hashlib
+from collections import OrderedDict
+
 import numpy as np
-import scipy
-from scipy.misc import (factorial,
-                        comb as nchoosek,
-                        )
+try:
+    from scipy.misc import (factorial,
+                            comb as nchoosek,
+                            )
+except ImportError:
+    from scipy.special import (factorial,
+                               comb as nchoosek,
+                               )
 
 from mindboggle.shapes.zernike.helpers import nest, autocat
 
@@ -18,9 +26,9 @@ LOG = logging.getLogger(__name__)
 #    LOG.debug(fn.__name__)
 #    return fn(*args, **dargs)
 
-IMAG_CONST = scipy.sqrt(-1)
+IMAG_CONST = np.sqrt(-1 + 0j)
 PI_CONST = np.pi
-NAN_CONST = np.NaN
+NAN_CONST = np.nan
 
 
 class Pipeline(object):
@@ -183,7 +191,7 @@ class SerialPipeline(Pipeline):
         return y
 
     def Qklnu(self, k, l, nu):
-        aux_1 = np.power(-1, k + nu) / np.float(np.power(4, k))
+        aux_1 = np.power(-1, k + nu) / float(np.power(4, k))
         aux_2 = np.sqrt((2 * l + 4 * k + 3) / 3.0)
         aux_3 = self.trinomial(
             nu, k - nu, l + nu + 1) * nchoosek(2 * (l + nu + 1 + k), l + nu + 1 + k)
@@ -360,10 +368,458 @@ class KoehlMultiproc(KoehlOptimizations):
         return self.factorial_scalar(N) * moments_array
 
 
+class KoehlBatched(KoehlOptimizations):
+    """
+    Koehl's recursion evaluated for many faces at once.
+
+    Faces are processed in chunks along a leading face axis
+    (at most max_chunk_bytes per moment array), with per-face volumes
+    from one batched determinant and facet contributions reduced
+    with einsum.  geometric_moments_per_label() reduces the facet
+    contributions of many labeled regions at once, reusing the first
+    recursion term of each vertex, computed for blocks of vertices
+    (at most max_vertex_bytes per block).
+    """
+    max_chunk_bytes = 2**26
+    max_vertex_bytes = 2**28
+
+    def geometric_moments_exact(self, points_array, faces_array, N):
+        n_facets, n_vertices = faces_array.shape[:2]
+        assert n_vertices == 3
+        moments_array = np.zeros([N+1, N+1, N+1])
+        indices = self.recursion_indices(N)
+        chunk_size = max(1, self.max_chunk_bytes // (8 * (N+1)**3))
+        for start in range(0, n_facets, chunk_size):
+            vertices = points_array[faces_array[start:start + chunk_size]]
+            moments_array += np.einsum('f,fijk->ijk',
+                                       self.facet_volumes(vertices),
+                                       self.facet_terms(vertices, N, indices))
+        return self.factorial_scalar(N) * moments_array
+
+    def facet_volumes(self, vertices):
+        # vertices: faces x 3 vertices x 3 coordinates
+        return np.linalg.det(vertices.transpose(0, 2, 1))
+
+    def geometric_moments_per_label(self, points_array, faces_array,
+                                    face_labels, n_labels, N,
+                                    vertex_terms=None):
+        # face_labels: index (0 to n_labels-1) of the label of each face;
+        # vertex_terms: vertex_terms() of all points (or None to compute
+        # them for blocks of the vertices used as third facet vertices)
+        from scipy.sparse import coo_matrix
+
+        n_facets, n_vertices = faces_array.shape[:2]
+        assert n_vertices == 3
+        moments_array = np.zeros([n_labels, (N+1)**3])
+        indices = self.recursion_indices(N)
+        chunk_size = max(1, self.max_chunk_bytes // (8 * (N+1)**3))
+
+        # Blocks of faces (sorted by third vertex) whose third vertices'
+        # terms take at most max_vertex_bytes:
+        if vertex_terms is None:
+            used, third = np.unique(faces_array[:, 2], return_inverse=True)
+            block_size = max(1, self.max_vertex_bytes // (8 * (N+1)**3))
+            if len(used) <= block_size:
+                blocks = [(np.arange(n_facets), 0)]
+            else:
+                order = np.argsort(third, kind='mergesort')
+                bounds = np.searchsorted(third[order],
+                                         np.arange(0, len(used) + block_size,
+                                                   block_size))
+                blocks = [(order[bounds[i]:bounds[i+1]], i * block_size)
+                          for i in range(len(bounds) - 1)
+                          if bounds[i] < bounds[i+1]]
+        else:
+            blocks = [(np.arange(n_facets), None)]
+
+        for block, offset in blocks:
+            if offset is not None:
+                block_used = used[offset:offset + block_size]
+                block_terms = self.vertex_terms(points_array[block_used], N,
+                                                indices)
+            for start in range(0, len(block), chunk_size):
+                chunk = block[start:start + chunk_size]
+                faces = faces_array[chunk]
+                vertices = points_array[faces]
+                if offset is None:
+                    Cf = vertex_terms[faces[:, 2]]
+                else:
+                    Cf = block_terms[third[chunk] - offset]
+                terms = self.facet_terms(vertices, N, indices, Cf)
+                groups = coo_matrix((self.facet_volumes(vertices),
+                                     (face_labels[chunk],
+                                      np.arange(len(faces)))),
+                                    shape=(n_labels, len(faces))).tocsr()
+                moments_array += groups.dot(terms.reshape(len(faces), -1))
+        return self.factorial_scalar(N) * \
+            moments_array.reshape(n_labels, N+1, N+1, N+1)
+
+    def vertex_terms(self, points_array, N, indices=None):
+        # First recursion term of the facets at each vertex:
+        return self.work_loop_batch(points_array, N, None, indices)
+
+    def facet_terms(self, vertices, N, indices=None, Cf=None):
+        if Cf is None:
+            Cf = self.work_loop_batch(vertices[:, 2], N, None, indices)
+        Df = self.work_loop_batch(vertices[:, 1], N, Cf, indices)
+        return self.work_loop_batch(vertices[:, 0], N, Df, indices)
+
+    def recursion_indices(self, N):
+        # Flat indices to the terms of each order n+1 and to the terms
+        # they are computed from (as np.roll() along each axis):
+        i, j, k = np.mgrid[:N+1, :N+1, :N+1]
+        order = (i+j+k).ravel()
+        shape = (N+1, N+1, N+1)
+        indices = []
+        for n in range(N):
+            mask = np.flatnonzero(order == n+1)
+            ijk = np.unravel_index(mask, shape)
+            rolled = []
+            for axis in range(3):
+                _ijk = list(ijk)
+                _ijk[axis] = (_ijk[axis] - 1) % (N+1)
+                rolled.append(np.ravel_multi_index(_ijk, shape))
+            indices.append((mask, rolled))
+        return indices
+
+    def work_loop_batch(self, vertices, N, prev=None, indices=None):
+        if indices is None:
+            indices = self.recursion_indices(N)
+        n_facets = vertices.shape[0]
+        Q = np.zeros([n_facets, (N+1)**3])
+        Q[:, 0] = 1.0
+        R = None
+        if prev is not None:
+            R = prev.reshape(n_facets, -1)
+        x, y, z = [vertices[:, [_i]] for _i in range(3)]
+        for mask, (ix, iy, iz) in indices:
+            _Q = Q[:, ix]*x + Q[:, iy]*y + Q[:, iz]*z
+            if R is not None:
+                _Q += R[:, mask]
+            Q[:, mask] = _Q
+        return Q.reshape(n_facets, N+1, N+1, N+1)
+
+
+# Coefficient tables per order (see zernike_tables()):
+_zernike_tables = {}
+
+
+def zernike_tables(N, cache_dir=None):
+    """
+    Coefficient tables that depend only on the order N, computed once.
+
+    The transform from geometric moments G to Zernike moments Z in
+    SerialPipeline.zernike() is linear (G is real), so its five nested
+    loops are composed into one sparse matrix, stored as index and
+    coefficient arrays.  Tables are cached in-process and, if cache_dir
+    is given, in a .npz file per order; the sparse matrix itself is
+    assembled once per order and only cached in-process.
+
+    Parameters
+    ----------
+    N : integer
+        order of the moments
+    cache_dir : string (or None)
+        directory of .npz table files to read or write
+
+    Returns
+    -------
+    tables : dictionary of numpy arrays
+        "factorial_scalar", "trinomial": (N+1)^3 arrays
+        (as from SerialPipeline);
+        "z_rows", "z_cols", "z_coefs": G to Z sparse matrix entries
+        (flat indices to Z and G);
+        "G_to_Z": G to Z sparse matrix (scipy.sparse csr matrix);
+        "f_rows", "f_cols", "f_coefs": |Z|^2 to squared descriptor
+        sparse matrix entries (flat indices to Z)
+    """
+    import os
+    from scipy.sparse import coo_matrix
+
+    tables = _zernike_tables.get(N)
+    if tables is not None:
+        return tables
+
+    table_file = None
+    if cache_dir:
+        table_file = os.path.join(cache_dir,
+                                  'zernike_tables_{0}.npz'.format(N))
+        if os.path.exists(table_file):
+            with np.load(table_file) as npz:
+                tables = dict(npz)
+    if tables is None:
+        tables = _compute_zernike_tables(N)
+        if table_file:
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            np.savez(table_file, **tables)
+
+    size = (N + 1)**3
+    tables['G_to_Z'] = coo_matrix((tables['z_coefs'], (tables['z_rows'],
+                                                       tables['z_cols'])),
+                                  shape=(size, size)).tocsr()
+
+    _zernike_tables[N] = tables
+    return tables
+
+
+def _compute_zernike_tables(N):
+    from scipy.sparse import coo_matrix, diags
+
+    pl = SerialPipeline()
+    shape = (N + 1, N + 1, N + 1)
+    size = (N + 1)**3
+    flat = lambda *ijk: np.ravel_multi_index(ijk, shape)
+
+    def matrix(entries):
+        rows, cols, coefs = zip(*entries) if entries else ((), (), ())
+        return coo_matrix((np.array(coefs, dtype=complex), (rows, cols)),
+                          shape=(size, size)).tocsr()
+
+    # Same loops as SerialPipeline.zernike(), as sparse matrices:
+    entries = []
+    for a, b, c, alpha in nest(lambda: range(int(N / 2) + 1),
+                               lambda _a: range(N - 2 * _a + 1),
+                               lambda _a, _b: range(N - 2 * _a - _b + 1),
+                               lambda _a, _b, _c: range(_a + _c + 1),
+                               ):
+        entries.append((flat(a, b, c), flat(2 * a + c - alpha, alpha, b),
+                        np.power(IMAG_CONST, alpha) *
+                        nchoosek(a + c, alpha)))
+    M = matrix(entries)
+
+    entries = []
+    for a, b, c, alpha in nest(lambda: range(int(N / 2) + 1),
+                               lambda _a: range(N - 2 * _a + 1),
+                               lambda _a, _b: range(N - 2 * _a - _b + 1),
+                               lambda _a, _b, _c: range(_a + 1),
+                               ):
+        entries.append((flat(a, b, c), flat(a - alpha, b, c + 2 * alpha),
+                        np.power(-1, alpha) * np.power(2, a - alpha) *
+                        nchoosek(a, alpha)))
+    M = matrix(entries).dot(M)
+
+    entries = []
+    for a, b, c, alpha in nest(lambda: range(int(N / 2) + 1),
+                               lambda _a: range(N - 2 * _a + 1),
+                               lambda _a, _b: range(N - 2 * _a - _b + 1),
+                               lambda _a, _b, _c: range(_a + 1),
+                               ):
+        entries.append((flat(a, b, c), flat(a - alpha, b + 2 * alpha, c),
+                        nchoosek(a, alpha)))
+    M = matrix(entries).dot(M)
+
+    entries = []
+    for l, nu, m, j in nest(lambda: range(N + 1),
+                            lambda _l: range(int((N - _l) / 2) + 1),
+                            lambda _l, _nu: range(_l + 1),
+                            lambda _l, _nu, _m: range(int((_l - _m) / 2) + 1),
+                            ):
+        entries.append((flat(l, nu, m), flat(nu + j, l - m - 2 * j, m),
+                        pl.Yljm(l, j, m)))
+    M = matrix(entries).dot(M)
+
+    entries = []
+    for n, l, m, nu, in nest(lambda: range(N + 1),
+                             lambda _n: range(_n + 1),
+                             lambda _n, _l: range(_l + 1),
+                             lambda _n, _l, _m: range(int((_n - _l) / 2) + 1),
+                             ):
+        k = int((n - l) / 2)
+        entries.append((flat(n, l, m), flat(l, nu, m),
+                        (3 / (4 * PI_CONST)) * pl.Qklnu(k, l, nu)))
+    Q = matrix(entries)
+
+    # Z = Q conj(Y) (Q is real), then conjugated and negated for odd n+l+m
+    # for the same (n, l, m) as visited by SerialPipeline.zernike(), whose
+    # inner ranges follow the values of n and l left by its loop variables:
+    sign = np.zeros(size)
+    n = l = N
+    for n, l, m in nest(lambda: range(N + 1),
+                        lambda _n: range(n + 1),
+                        lambda _n, _l: range(l + 1),
+                        ):
+        sign[flat(n, l, m)] = 1 - 2 * np.mod(n + l + m, 2)
+    keep = (sign == 0).astype(float)
+    G_to_Z = (diags(sign).dot(Q).dot(M) +
+              diags(keep).dot(Q).dot(M.conj())).tocoo()
+
+    # Descriptors: norms of Z[n, l, -l:l+1] for even n-l, with the
+    # entries for -m having the same moduli as those for m,
+    # in the order of SerialPipeline.feature_extraction():
+    f_rows, f_cols, f_coefs = [], [], []
+    nl = [(n, l) for l in range(N + 1) for n in range(l, N + 1)
+          if np.mod(n - l, 2) == 0]
+    for row, (n, l) in enumerate(nl):
+        for m in range(l + 1):
+            f_rows.append(row)
+            f_cols.append(flat(n, l, m))
+            f_coefs.append(1.0 if m == 0 else 2.0)
+
+    i, j, k = np.mgrid[0:N + 1, 0:N + 1, 0:N + 1]
+    return {'factorial_scalar': factorial(i) * factorial(j) * factorial(k) /
+                                (factorial(i + j + k + 2) * (i + j + k + 3)),
+            'trinomial': (i + j + k <= N) * factorial(i + j + k) /
+                         (factorial(i) * factorial(j) * factorial(k)),
+            'z_rows': G_to_Z.row, 'z_cols': G_to_Z.col,
+            'z_coefs': G_to_Z.data,
+            'f_rows': np.array(f_rows), 'f_cols': np.array(f_cols),
+            'f_coefs': np.array(f_coefs)}
+
+
+class TabulatedZernike(Pipeline):
+    """
+    Zernike transform and descriptors from per-order tables.
+
+    See zernike_tables(); set table_dir to also cache tables on disk.
+    """
+    table_dir = None
+
+    def tables(self, N):
+        return zernike_tables(N, self.table_dir)
+
+    def factorial_scalar(self, N):
+        return self.tables(N)['factorial_scalar']
+
+    def trinomial_precalc(self, N):
+        return self.tables(N)['trinomial']
+
+    def zernike(self, G, N):
+        G_to_Z = self.tables(N)['G_to_Z']
+        return G_to_Z.dot(np.ravel(G)).reshape(G.shape)
+
+    def feature_extraction(self, Z, N):
+        T = self.tables(N)
+        F = np.zeros(T['f_rows'].max() + 1)
+        np.add.at(F, T['f_rows'],
+                  T['f_coefs'] * np.abs(np.ravel(Z)[T['f_cols']])**2)
+        return np.sqrt(F)
+
+
 #DefaultPipeline = type('DefaultPipeline', (SerialPipeline,), {})
 #DefaultPipeline = type(
 #     'DefaultPipeline', (NumpyOptimizations, MultiprocPipeline,), {})
 #DefaultPipeline = type(
 #    'DefaultPipeline', (KoehlOptimizations, SerialPipeline), {})
+#DefaultPipeline = type(
+#    'DefaultPipeline', (KoehlMultiproc, SerialPipeline), {})
+#DefaultPipeline = type(
+#    'DefaultPipeline', (KoehlBatched, SerialPipeline), {})
 DefaultPipeline = type(
-    'DefaultPipeline', (KoehlMultiproc, SerialPipeline), {})
+    'DefaultPipeline', (KoehlBatched, TabulatedZernike, SerialPipeline), {})
+
+# Geometric moments by pipeline and mesh content hash (with their order),
+# most recently used last (see cached_moments()):
+_moments_cache = OrderedDict()
+
+# Maximum number of bytes of cached geometric moments:
+MOMENTS_CACHE_BYTES = 2**27
+
+
+def cached_moments(arrays, N, compute, max_bytes=None, pipeline=None):
+    """
+    Geometric moments of order N, reusing those of a higher order.
+
+    Geometric moments of order N are the moments of a higher order with
+    indices i+j+k <= N, so moments are cached by a hash of the arrays
+    that determine them (such as points and faces) and by the pipeline
+    that computes them, along with their order.
+    A request for the same arrays and a lower order slices the cached
+    moments, and a higher order replaces them.  The least recently used
+    moments are dropped when the cache exceeds max_bytes.
+
+    Parameters
+    ----------
+    arrays : list of numpy arrays
+        arrays whose content determines the moments
+    N : integer
+        order of the moments
+    compute : function
+        computes the moments for an order, as an array whose last three
+        dimensions are N+1 (such as geometric_moments_exact())
+    max_bytes : integer (or None)
+        maximum size of the cache (None: MOMENTS_CACHE_BYTES)
+    pipeline : class (or None)
+        pipeline (engine) that computes the moments, so that moments
+        from different pipelines are cached separately
+
+    Returns
+    -------
+    moments : numpy array
+        geometric moments of order N
+    """
+    if max_bytes is None:
+        max_bytes = MOMENTS_CACHE_BYTES
+
+    content_hash = hashlib.sha1()
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        content_hash.update(str((array.dtype, array.shape)).encode())
+        content_hash.update(array.tobytes())
+    key = (pipeline, content_hash.hexdigest())
+
+    cached = _moments_cache.get(key)
+    if cached is not None and cached[0] >= N:
+        _moments_cache.move_to_end(key)
+        moments = cached[1][..., :N+1, :N+1, :N+1]
+        i, j, k = np.mgrid[:N+1, :N+1, :N+1]
+        return np.where(i+j+k <= N, moments, 0.0)
+
+    moments = np.asarray(compute(N))
+    _moments_cache.pop(key, None)
+    if moments.nbytes <= max_bytes:
+        _moments_cache[key] = (N, moments)
+        while sum(x[1].nbytes for x in _moments_cache.values()) > max_bytes:
+            _moments_cache.popitem(last=False)
+
+    return moments.copy()
+
+# Registered pipelines ("engines") by name (see register_pipeline()):
+PIPELINES = OrderedDict()
+
+# Environment variable naming the engine when none is given:
+ENGINE_VARIABLE = 'MINDBOGGLE_ZERNIKE_ENGINE'
+DEFAULT_ENGINE = 'default'
+
+
+def register_pipeline(name, pl_cls):
+    """
+    Register a pipeline class under an engine name.
+
+    The class needs geometric_moments_exact(), zernike() and
+    feature_extraction(); it may also define
+    geometric_moments_per_label() (see KoehlBatched).
+    """
+    PIPELINES[name] = pl_cls
+    return pl_cls
+
+
+def get_pipeline(engine=None):
+    """
+    Pipeline class for an engine name (or class).
+
+    If engine is None, use the engine named by the environment variable
+    MINDBOGGLE_ZERNIKE_ENGINE, or else the default engine.
+    """
+    if engine is None:
+        engine = os.environ.get(ENGINE_VARIABLE) or DEFAULT_ENGINE
+    if isinstance(engine, type):
+        return engine
+    if engine not in PIPELINES:
+        raise ValueError("Unknown Zernike engine {0!r} (choose from {1})".
+                         format(engine, ', '.join(PIPELINES)))
+    return PIPELINES[engine]
+
+
+register_pipeline('default', DefaultPipeline)
+SerialEngine = register_pipeline('serial', type(
+    'SerialEngine', (SerialPipeline,), {}))
+NumpyEngine = register_pipeline('numpy', type(
+    'NumpyEngine', (NumpyOptimizations, SerialPipeline), {}))
+register_pipeline('multiproc', MultiprocPipeline)
+KoehlEngine = register_pipeline('koehl', type(
+    'KoehlEngine', (KoehlOptimizations, SerialPipeline), {}))
+KoehlMultiprocEngine = register_pipeline('koehl_multiproc', type(
+    'KoehlMultiprocEngine', (KoehlMultiproc, SerialPipeline), {}))
+KoehlBatchedEngine = register_pipeline('koehl_batched', type(
+    'KoehlBatchedEngine', (KoehlBatched, SerialPipeline), {}))
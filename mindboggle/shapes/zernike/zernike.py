@@ -14,7 +14,8 @@ Copyright 2013,  Mindboggle team (http://mindboggle.info), Apache v2.0 License
 
 
 def zernike_moments(points, faces, order=10, scale_input=True,
-                    decimate_fraction=0, decimate_smooth=0, verbose=False):
+                    decimate_fraction=0, decimate_smooth=0, verbose=False,
+                    engine=None, use_cache=True):
     """
     Compute the Zernike moments of a surface patch of points and faces.
 
@@ -41,6 +42,12 @@ def zernike_moments(points, faces, order=10, scale_input=True,
         number of smoothing steps for decimation
     verbose : bool
         print statements?
+    engine : string (or None)
+        name of a registered pipeline (see pipelines.PIPELINES);
+        if None, use $MINDBOGGLE_ZERNIKE_ENGINE or the default pipeline
+    use_cache : bool
+        reuse (and cache) geometric moments of the same mesh and engine
+        (see pipelines.cached_moments)?
 
     Returns
     -------
@@ -64,6 +71,10 @@ def zernike_moments(points, faces, order=10, scale_input=True,
     ...     decimate_fraction, decimate_smooth, verbose)
     >>> [np.float("{0:.{1}f}".format(x, 5)) for x in descriptors]
     [0.09189, 0.09357, 0.04309, 0.06466, 0.0382, 0.04138]
+    >>> descriptors = zernike_moments(points, faces, order, scale_input,
+    ...     decimate_fraction, decimate_smooth, verbose, engine='serial')
+    >>> [round(x, 5) for x in descriptors]
+    [0.09189, 0.09357, 0.04309, 0.06466, 0.0382, 0.04138]
 
     Example 2: Twins-2-1 left postcentral pial surface -- NO decimation:
                (zernike_moments took 142 seconds for order = 3 with no decimation)
@@ -120,7 +131,8 @@ def zernike_moments(points, faces, order=10, scale_input=True,
 
     from mindboggle.guts.mesh import reindex_faces_0to1
     from mindboggle.guts.mesh import decimate
-    from mindboggle.shapes.zernike.pipelines import DefaultPipeline as Pipeline
+    from mindboggle.shapes.zernike.pipelines import get_pipeline, \
+        cached_moments
 
     # Convert 0-indices (Python) to 1-indices (Matlab) for all face indices:
     index1 = False  # already done elsewhere in the code
@@ -155,14 +167,19 @@ def zernike_moments(points, faces, order=10, scale_input=True,
         faces = np.array(faces)
 
     # ------------------------------------------------------------------------
-    # Multiprocessor pipeline:
+    # Pipeline (engine):
     # ------------------------------------------------------------------------
-    pl = Pipeline()
+    pl = get_pipeline(engine)()
 
     # ------------------------------------------------------------------------
-    # Geometric moments:
+    # Geometric moments (or those of a higher order, cached):
     # ------------------------------------------------------------------------
-    G = pl.geometric_moments_exact(points, faces, order)
+    if use_cache:
+        G = cached_moments([points, faces], order,
+            lambda N: pl.geometric_moments_exact(points, faces, N),
+            pipeline=type(pl))
+    else:
+        G = pl.geometric_moments_exact(points, faces, order)
 
     # ------------------------------------------------------------------------
     # ------------------------------------------------------------------------
@@ -181,12 +198,18 @@ def zernike_moments(points, faces, order=10, scale_input=True,
 
 def zernike_moments_per_label(vtk_file, order=10, exclude_labels=[-1],
                               scale_input=True, decimate_fraction=0,
-                              decimate_smooth=25, verbose=False):
+                              decimate_smooth=25, verbose=False, n_jobs=1,
+                              engine=None):
     """
     Compute the Zernike moments per labeled region in a file.
 
     Optionally decimate the input mesh.
 
+    Without decimation, the moments of all labeled regions are computed
+    together: the first recursion term of each vertex is computed once
+    for the surface, and facet contributions are summed per label
+    in a single grouped reduction (or by a pool of worker processes).
+
     Parameters
     ----------
     vtk_file : string
@@ -204,6 +227,11 @@ def zernike_moments_per_label(vtk_file, order=10, exclude_labels=[-1],
         number of smoothing steps for decimation
     verbose : bool
         print statements?
+    n_jobs : integer
+        number of worker processes sharing the labeled regions
+        (None or < 1: use all processors; no effect with decimation)
+    engine : string (or None)
+        name of a registered pipeline (see zernike_moments())
 
     Returns
     -------
@@ -242,10 +270,14 @@ def zernike_moments_per_label(vtk_file, order=10, exclude_labels=[-1],
     [0.00043, 0.0003, 0.00095, 0.00051, 0.00115, 0.00116]
 
     """
+    import os
     import numpy as np
     from mindboggle.mio.vtks import read_vtk
     from mindboggle.guts.mesh import keep_faces
-    from mindboggle.shapes.zernike.zernike import zernike_moments
+    from mindboggle.shapes.zernike.zernike import zernike_moments, \
+        _moments_per_label
+    from mindboggle.shapes.zernike.pipelines import get_pipeline, \
+        cached_moments
 
     min_points_faces = 4
 
@@ -255,12 +287,90 @@ def zernike_moments_per_label(vtk_file, order=10, exclude_labels=[-1],
     points, indices, lines, faces, labels, scalar_names, npoints, \
             input_vtk = read_vtk(vtk_file)
 
-    # ------------------------------------------------------------------------
-    # Loop through labeled regions:
-    # ------------------------------------------------------------------------
     ulabels = [x for x in np.unique(labels) if x not in exclude_labels]
     label_list = []
     descriptors_lists = []
+
+    # ------------------------------------------------------------------------
+    # Compute moments of all labeled regions together (without decimation):
+    # ------------------------------------------------------------------------
+    Pipeline = get_pipeline(engine)
+    if not 0 < decimate_fraction < 1 and \
+            hasattr(Pipeline, 'geometric_moments_per_label'):
+        points = np.array(points, dtype=float)
+        faces = np.reshape(np.array(faces, dtype=int), (-1, 3))
+        labels = np.asarray(labels)
+
+        # Translate and scale all points as in zernike_moments():
+        if scale_input:
+            points = points - np.mean(points, axis=0)
+            points /= np.max(np.sqrt(np.sum(points**2, axis=1)))
+
+        # Faces whose three vertices have the same label:
+        ulabels_all, label_counts = np.unique(labels, return_counts=True)
+        face_labels = labels[faces[:, 0]]
+        labeled = (face_labels == labels[faces[:, 1]]) & \
+                  (face_labels == labels[faces[:, 2]])
+        faces = faces[labeled]
+        face_labels = face_labels[labeled]
+
+        # Labels with enough vertices and faces, in increasing order:
+        face_ulabels, face_counts = np.unique(face_labels,
+                                              return_counts=True)
+        for label in ulabels:
+            nvertices = label_counts[np.searchsorted(ulabels_all, label)]
+            if verbose:
+                print('  {0} vertices for label {1}'.format(nvertices, label))
+            iface = np.searchsorted(face_ulabels, label)
+            if nvertices > min_points_faces and \
+                    iface < len(face_ulabels) and \
+                    face_ulabels[iface] == label and \
+                    face_counts[iface] > min_points_faces:
+                label_list.append(label)
+        if not label_list:
+            return descriptors_lists, label_list
+
+        # Sort the faces of these labels by label:
+        label_index = np.searchsorted(label_list, face_labels)
+        label_index[label_index == len(label_list)] = 0
+        keep = np.asarray(label_list)[label_index] == face_labels
+        order_faces = np.argsort(label_index[keep], kind='mergesort')
+        faces = faces[keep][order_faces]
+        label_index = label_index[keep][order_faces]
+
+        # Only keep vertices of labeled faces:
+        used = np.unique(faces)
+        faces = np.searchsorted(used, faces)
+        points = points[used]
+
+        # --------------------------------------------------------------------
+        # Geometric moments per label (or those of a higher order, cached):
+        # --------------------------------------------------------------------
+        pl = Pipeline()
+        if n_jobs is None or n_jobs < 1:
+            n_jobs = os.cpu_count() or 1
+        n_jobs = min(n_jobs, len(label_list))
+        moments = cached_moments([points, faces, label_index], order,
+            lambda N: _moments_per_label(Pipeline, points, faces,
+                                         label_index, len(label_list), N,
+                                         n_jobs),
+            pipeline=Pipeline)
+
+        # --------------------------------------------------------------------
+        # Zernike descriptors per label:
+        # --------------------------------------------------------------------
+        for G in moments:
+            Z = pl.zernike(G, order)
+            descriptors = pl.feature_extraction(Z, order).tolist()
+            if verbose:
+                print("Zernike moments: {0}".format(descriptors))
+            descriptors_lists.append(descriptors)
+
+        return descriptors_lists, label_list
+
+    # ------------------------------------------------------------------------
+    # Loop through labeled regions:
+    # ------------------------------------------------------------------------
     for label in ulabels:
       #if label == 1022:  # 22:
       #    print("DEBUG: COMPUTE FOR ONLY ONE LABEL")
@@ -286,7 +396,8 @@ def zernike_moments_per_label(vtk_file, order=10, exclude_labels=[-1],
                 descriptors = zernike_moments(points, pick_faces,
                                               order, scale_input,
                                               decimate_fraction,
-                                              decimate_smooth, verbose)
+                                              decimate_smooth, verbose,
+                                              Pipeline)
 
                 # ------------------------------------------------------------
                 # Append to a list of lists of spectra:
@@ -297,6 +408,66 @@ def zernike_moments_per_label(vtk_file, order=10, exclude_labels=[-1],
     return descriptors_lists, label_list
 
 
+def _moments_per_label(pl_cls, points, faces, label_index, n_labels, order,
+                       n_jobs=1):
+    # Geometric moments of faces sorted by label (label_index), per label:
+    import numpy as np
+
+    pl = pl_cls()
+
+    if n_jobs > 1:
+        import multiprocessing as mp
+        from mindboggle.guts.utilities import share_arrays, release_arrays
+
+        label_starts = np.searchsorted(label_index, np.arange(n_labels))
+        label_stops = np.append(label_starts[1:], len(faces))
+        arrays = {'points': points, 'faces': faces}
+        # Share the first recursion term of each vertex if small enough
+        # (otherwise each worker computes those of its label's vertices):
+        if len(points) * 8 * (order+1)**3 <= pl.max_vertex_bytes:
+            arrays['vertex_terms'] = pl.vertex_terms(points, order)
+        specs, blocks = share_arrays(arrays)
+        try:
+            # Start the largest labels first, and collect moments
+            # in label order:
+            with mp.Pool(n_jobs, initializer=_mp_zernike_init,
+                         initargs=(specs, pl_cls)) as pool:
+                results = {}
+                for i in np.argsort(label_stops - label_starts,
+                                    kind='mergesort')[::-1]:
+                    results[i] = pool.apply_async(_mp_zernike_worker,
+                        args=(label_starts[i], label_stops[i], order))
+                return np.array([results[i].get() for i in range(n_labels)])
+        finally:
+            release_arrays(blocks)
+
+    return pl.geometric_moments_per_label(points, faces, label_index,
+                                          n_labels, order)
+
+
+# Surface arrays shared with zernike_moments_per_label's worker processes:
+_mp_zernike_arrays = {}
+
+
+def _mp_zernike_init(specs, pl_cls):
+    from mindboggle.guts.utilities import attach_arrays
+
+    arrays, handles = attach_arrays(specs)
+    _mp_zernike_arrays.update(arrays)
+    _mp_zernike_arrays['handles'] = handles
+    _mp_zernike_arrays['pipeline'] = pl_cls()
+
+
+def _mp_zernike_worker(start, stop, order):
+    import numpy as np
+
+    A = _mp_zernike_arrays
+    vertex_terms = A.get('vertex_terms')
+    return A['pipeline'].geometric_moments_per_label(A['points'],
+        A['faces'][start:stop], np.zeros(stop - start, dtype=int), 1, order,
+        vertex_terms)[0]
+
+
 # ============================================================================
 # Doctests
 # ============================================================================